@@ -0,0 +1,218 @@
+import concurrent.futures
+import itertools
+import random
+import threading
+import time
+
+from BackupSocket import (
+    BackupSocket,
+    RecievingError,
+    Request,
+    SendingError,
+    make_request,
+)
+
+INITIAL_BACKOFF = 0.5
+MAX_BACKOFF = 30
+CONNECT_TIMEOUT = 5
+"""
+Seconds a connection attempt gets, kept short since retrying with backoff
+beats waiting out the full timeout on a bad network
+"""
+
+
+class BackupSession:
+    """
+    A long lived connection to backup_server.py that many commands share
+
+    Requests are tagged with a RequestID so several can be in flight at once,
+    responses are matched back to the Future returned by request().
+    If the connection drops, it is reopened with exponential backoff the next
+    time there is something to send and unanswered requests are sent again.
+    Requests are given up on once they're cancelled or older than timeout
+    """
+
+    def __init__(
+        self,
+        address: tuple[str, int],
+        username: str,
+        timeout: float | None = None,
+        max_backoff: float = MAX_BACKOFF,
+        connect_timeout: float = CONNECT_TIMEOUT,
+    ):
+        self.address = address
+        self.username = username
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_backoff = max_backoff
+
+        self.client: BackupSocket | None = None
+        self.closed = False
+        self.request_ids = itertools.count()
+        self.pending: dict[
+            int, tuple[Request, concurrent.futures.Future, float | None]
+        ] = {}
+        """Unanswered requests with the time they're given up at"""
+
+        # Guards self.client and self.pending so nothing is sent twice
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+
+        self.connection_thread = threading.Thread(
+            target=self.__run__, name="BackupSession", daemon=True
+        )
+        self.connection_thread.start()
+
+    def request(self, command: str, body: str = "", **metadata):
+        future: concurrent.futures.Future[Request] = concurrent.futures.Future()
+        request_id = next(self.request_ids)
+        request = make_request(
+            body,
+            sender=self.username,
+            reciever=self.address[0],
+            Command=command,
+            RequestID=request_id,
+            **metadata,
+        )
+
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+
+        with self.lock:
+            if self.closed:
+                future.set_exception(SendingError("Session is closed"))
+                return future
+
+            self.pending[request_id] = (request, future, deadline)
+            # Cancelled requests aren't sent again after a reconnect
+            future.add_done_callback(lambda _: self.__forget__(request_id))
+            if self.client is None:
+                # The connection thread sends it once it has reconnected
+                self.wakeup.notify()
+                return future
+
+            try:
+                self.client.send_prefix(request)
+            except (SendingError, OSError):
+                # The connection thread notices the broken socket and resends
+                pass
+
+        return future
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+            if self.client is not None:
+                self.client.close()
+
+            pending = list(self.pending.values())
+            self.pending.clear()
+
+        # Outside the lock since done callbacks take it
+        for _, future, _ in pending:
+            if not future.done():
+                future.set_exception(RecievingError("Session was closed"))
+
+    def set_address(self, address: tuple[str, int]):
+        """
+        Connects to address from now on, like once the hostname is looked up
+        """
+        with self.lock:
+            self.address = address
+            # Cuts the backoff short so the new address is tried right away
+            self.wakeup.notify()
+
+    def __forget__(self, request_id: int):
+        with self.lock:
+            self.pending.pop(request_id, None)
+
+    def __expire__(self):
+        """
+        Fails the requests that are past their deadline, returns whether any
+        are left to send
+        """
+        now = time.monotonic()
+        with self.lock:
+            expired = [
+                future
+                for _, future, deadline in self.pending.values()
+                if deadline is not None and deadline < now
+            ]
+        for future in expired:
+            if not future.done():
+                future.set_exception(TimeoutError("No response from the server"))
+
+        with self.lock:
+            return self.pending != {}
+
+    def __connect__(self):
+        backoff = INITIAL_BACKOFF
+
+        while not self.closed:
+            if not self.__expire__():
+                # Nothing left worth connecting for
+                return None
+
+            client = BackupSocket()
+            client.settimeout(self.connect_timeout)
+            try:
+                client.connect(self.address)
+                client.settimeout(self.timeout)
+                return client
+            except OSError:
+                client.socket.close()
+
+            with self.lock:
+                self.wakeup.wait(backoff + random.uniform(0, backoff / 2))
+            backoff = min(backoff * 2, self.max_backoff)
+
+        return None
+
+    def __run__(self):
+        while True:
+            # Only reconnect when there's something to send
+            with self.lock:
+                while not self.closed and self.pending == {}:
+                    self.wakeup.wait()
+                if self.closed:
+                    return
+
+            client = self.__connect__()
+            if client is None:
+                continue
+
+            with self.lock:
+                if self.closed:
+                    client.close()
+                    return
+
+                self.client = client
+                try:
+                    for request, _, _ in list(self.pending.values()):
+                        client.send_prefix(request)
+                except (SendingError, OSError):
+                    self.client = None
+                    client.close()
+                    continue
+
+            self.__read_responses__(client)
+
+            with self.lock:
+                self.client = None
+            client.close()
+
+    def __read_responses__(self, client: BackupSocket):
+        while not self.closed:
+            try:
+                response = client.recieve_prefix()
+            except (RecievingError, OSError):
+                return
+
+            request_id = response["metadata"].get("RequestID")
+            with self.lock:
+                _, future, _ = self.pending.pop(request_id, (None, None, None))
+
+            if future is not None and not future.done():
+                future.set_result(response)
@@ -1,10 +1,40 @@
 import json
 import socket
-from math import ceil, log
-from typing import Any, Literal, TypedDict, override
+import struct
+import time
+from typing import Any, BinaryIO, Literal, TypedDict, override
+
+from Compression import CODECS, AdaptiveLevel
 
 PREFIX_MAX = 1152921504606846975  # 0xFFFFFFFFFFFFFFF in decimal
 CHUNK_SIZE = 4098
+BUFFER_SIZE = 65536
+MAX_FRAME = 64 * 1024 * 1024
+"""
+Largest frame body that will be recieved, so a bogus length can't make the
+buffer allocate whatever the header claims
+"""
+
+FRAME_MAGIC = b"BI"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("!2sBBHQ")
+"""
+Every frame sent with send_frame starts with this 14 byte header:
+1. Magic (b"BI")
+2. Version
+3. Message type (MESSAGE_*)
+4. Flags (FLAG_*)
+5. Length of the body in bytes
+"""
+
+MESSAGE_REQUEST = 1
+MESSAGE_RESPONSE = 2
+MESSAGE_DATA = 3
+
+FLAG_JSON = 0x1
+"""The body is a JSON encoded Request"""
+FLAG_COMPRESSED = 0x2
+"""The body is compressed with the codec negotiated for this connection"""
 
 
 class Request(TypedDict):
@@ -31,11 +61,114 @@ class SendingError(Exception):
         return self.message
 
 
+class RecievingError(Exception):
+    """
+    Raised when the other end closes the connection during any of the recieve functions
+    """
+
+    def __init__(self, message=""):
+        if message == "":
+            message = "CONNECTION CLOSED WHILE RECIEVING"
+        self.message = message
+        super().__init__(message)
+
+    @override
+    def __str__(self):
+        return self.message
+
+
+def make_request(
+    body: str = "", sender: str = "", reciever: str = "", **metadata
+) -> Request:
+    return Request(
+        length=len(body),
+        body=body,
+        sender=sender,
+        reciever=reciever,
+        metadata=metadata,
+    )
+
+
+def decode_request(encoded_message: memoryview) -> Request:
+    # str() decodes straight out of the buffer without copying it into bytes first
+    plaintext_message = str(encoded_message, encoding="utf-8")
+    request: Request = json.JSONDecoder().decode(plaintext_message)
+
+    return request
+
+
+class RecieveBuffer:
+    """
+    A preallocated buffer that the socket reads into with recv_into
+
+    Recieved bytes live in buffer[start:end]. Frames are handed out as
+    memoryviews into the buffer so they are only valid until the next fill()
+    """
+
+    def __init__(self, size: int = BUFFER_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def reserve(self, amount: int):
+        if len(self.buffer) - self.end >= amount:
+            return
+
+        unread = len(self)
+        if len(self.buffer) - unread >= amount and self.start > 0:
+            # Enough room if the unread bytes are moved to the front
+            self.buffer[:unread] = self.buffer[self.start : self.end]
+        else:
+            new_size = max(len(self.buffer) * 2, unread + amount)
+            new_buffer = bytearray(new_size)
+            new_buffer[:unread] = self.view[self.start : self.end]
+            self.buffer = new_buffer
+            self.view = memoryview(self.buffer)
+
+        self.start = 0
+        self.end = unread
+
+    def fill(self, sock: socket.socket):
+        self.reserve(CHUNK_SIZE)
+        bytes_recieved = sock.recv_into(self.view[self.end :])
+        if bytes_recieved == 0:
+            raise RecievingError
+
+        self.end += bytes_recieved
+        return bytes_recieved
+
+    def find(self, delimiter: bytes, offset: int = 0):
+        index = self.buffer.find(delimiter, self.start + offset, self.end)
+        if index == -1:
+            return -1
+
+        return index - self.start
+
+    def take(self, length: int) -> memoryview:
+        frame = self.view[self.start : self.start + length]
+        self.start += length
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+            # Don't hold onto the memory of one huge message forever
+            if len(self.buffer) > BUFFER_SIZE * 16:
+                self.buffer = bytearray(BUFFER_SIZE)
+                self.view = memoryview(self.buffer)
+
+        return frame
+
+
 class BackupSocket:
     def __init__(
         self, socket_type: Literal["server", "client"] = "client", init_socket=True
     ):
         self.socket: socket.socket
+        self.recieve_buffer = RecieveBuffer()
+        self.compression: AdaptiveLevel | None = None
         if init_socket:
             self.init_socket()
         self.socket_type = socket_type
@@ -44,6 +177,8 @@ class BackupSocket:
 
     def init_socket(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Frames are written whole so there's nothing for Nagle to coalesce
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         return
 
     def bind(self, adress):
@@ -51,115 +186,175 @@ class BackupSocket:
             return
         self.socket.bind(adress)
 
+    def listen(self, backlog: int):
+        if self.socket_type == "client":
+            return
+        self.socket.listen(backlog)
+
+    def settimeout(self, timeout: float | None):
+        self.socket.settimeout(timeout)
+
     def accept(self):
         if self.socket_type == "client":
             return
         client_socket, client_addr = self.socket.accept()
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         client = BackupSocket(socket_type="client", init_socket=False)
         client.socket = client_socket
         self.client_list[client_addr] = client
         return client, client_addr
 
+    def use_codec(self, name: str):
+        """
+        Compresses frames sent with compress=True from now on
+        Only call once both ends have agreed on the codec
+        """
+        self.compression = AdaptiveLevel(CODECS[name]) if name != "" else None
+
     def connect(self, address):
         self.socket.connect(address)
 
     def close(self):
-        self.socket.shutdown(socket.SHUT_RDWR)
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # The other end already hung up
+            pass
         self.socket.close()
 
-    def send(self, request: Request):
-        plaintext_message = json.JSONEncoder().encode(request)
-        encoded_message = plaintext_message.encode(encoding="utf-8")
-
+    def send_bytes(self, data: bytes | bytearray | memoryview):
+        # Slicing a memoryview doesn't copy what's left to send on every partial send
+        message_view = memoryview(data)
         total_bytes_sent = 0
-        message_length = len(encoded_message)
+        message_length = len(message_view)
         while total_bytes_sent != message_length:
-            bytes_sent = self.socket.send(encoded_message[total_bytes_sent:])
+            bytes_sent = self.socket.send(message_view[total_bytes_sent:])
             if bytes_sent == 0:
                 raise SendingError
 
             total_bytes_sent += bytes_sent
 
-    def send_prefix(self, request: Request):
+    def send(self, request: Request):
         plaintext_message = json.JSONEncoder().encode(request)
         encoded_message = plaintext_message.encode(encoding="utf-8")
-        message_length = len(encoded_message)
-        if message_length > PREFIX_MAX:
-            raise SendingError("Message length is over PREFIX_MAX")
-
-        prefix_length = ceil(log(message_length, 16))
-        if self.socket.send(hex(prefix_length).encode()) == 0:
-            raise SendingError
-
-        total_bytes_sent = 0
-        prefix = hex(message_length).encode()
-        while total_bytes_sent != prefix_length:
-            bytes_sent = self.socket.send(prefix[total_bytes_sent:])
-            if bytes_sent == 0:
-                raise SendingError
-
-            total_bytes_sent += bytes_sent
-
-        total_bytes_sent = 0
-        while total_bytes_sent != message_length:
-            bytes_sent = self.socket.send(encoded_message[total_bytes_sent:])
-            if bytes_sent == 0:
-                raise SendingError
-
-            total_bytes_sent += bytes_sent
+        self.send_bytes(encoded_message)
+
+    def send_frame(
+        self,
+        message_type: int,
+        body: bytes | bytearray | memoryview,
+        flags: int = 0,
+        compress: bool = False,
+    ):
+        """
+        Returns how many bytes of body went over the network
+        """
+        if compress and self.compression is not None:
+            compressed = self.compression.compress(body)
+            if compressed is not None:
+                body = compressed
+                flags |= FLAG_COMPRESSED
+
+        body_length = len(body)
+        if body_length > MAX_FRAME:
+            raise SendingError("Message length is over MAX_FRAME")
+
+        header = FRAME_HEADER.pack(
+            FRAME_MAGIC, FRAME_VERSION, message_type, flags, body_length
+        )
+        start = time.perf_counter()
+        if body_length <= BUFFER_SIZE:
+            # Small frames go out in one send instead of two tiny packets
+            self.send_bytes(b"".join([header, body]))
+        else:
+            self.send_bytes(header)
+            self.send_bytes(body)
+
+        if compress and self.compression is not None:
+            self.compression.record_send(body_length, time.perf_counter() - start)
+
+        return body_length
+
+    def send_file_frame(
+        self, file: BinaryIO, offset: int, count: int, message_type: int = MESSAGE_DATA
+    ):
+        """
+        Sends count bytes of file starting at offset as the body of one frame
+        Uses sendfile where the OS has it so the data never enters Python
+        """
+        if count > MAX_FRAME:
+            raise SendingError("Message length is over MAX_FRAME")
+
+        header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, message_type, 0, count)
+        self.send_bytes(header)
+        if self.socket.sendfile(file, offset, count) != count:
+            raise SendingError("File ended before the whole frame was sent")
+
+    def send_prefix(self, request: Request, message_type: int = MESSAGE_REQUEST):
+        plaintext_message = json.JSONEncoder().encode(request)
+        encoded_message = plaintext_message.encode(encoding="utf-8")
+        self.send_frame(message_type, encoded_message, flags=FLAG_JSON)
 
     def send_delim(self, request: Request):
         plaintext_message = json.JSONEncoder().encode(request)
         plaintext_message = f"{plaintext_message}\0"
         encoded_message = plaintext_message.encode(encoding="utf-8")
+        self.send_bytes(encoded_message)
 
-        message_length = len(encoded_message)
-        total_bytes_sent = 0
-        while total_bytes_sent != message_length:
-            bytes_sent = self.socket.send(encoded_message[total_bytes_sent:])
-            if bytes_sent == 0:
-                raise SendingError
+    def recieve_exactly(self, length: int) -> memoryview:
+        self.recieve_buffer.reserve(length - len(self.recieve_buffer))
+        while len(self.recieve_buffer) < length:
+            self.recieve_buffer.fill(self.socket)
 
-            total_bytes_sent += bytes_sent
+        return self.recieve_buffer.take(length)
 
     def recieve(self, length: int) -> Request:
-        encoded_message = b""
-
-        total_bytes_recieved = 0
-        while total_bytes_recieved != length:
-            message_buffer = self.socket.recv(length - total_bytes_recieved)
-            encoded_message = b"".join([encoded_message, message_buffer])
-
-        plaintext_message = encoded_message.decode(encoding="utf-8")
-        request: Request = json.JSONDecoder().decode(plaintext_message)
-
-        return request
+        return decode_request(self.recieve_exactly(length))
+
+    def recieve_frame(self) -> tuple[int, int, memoryview]:
+        """
+        Returns the message type, flags and body of the next frame
+        The body is only valid until the next recieve
+        """
+        header = self.recieve_exactly(FRAME_HEADER.size)
+        magic, version, message_type, flags, body_length = FRAME_HEADER.unpack(header)
+        if magic != FRAME_MAGIC:
+            raise RecievingError("Recieved data is not a frame")
+        if version != FRAME_VERSION:
+            raise RecievingError(f"Unsupported frame version {version}")
+        if body_length > MAX_FRAME:
+            raise RecievingError(f"Frame of {body_length} bytes is over MAX_FRAME")
+
+        body = self.recieve_exactly(body_length)
+        if flags & FLAG_COMPRESSED:
+            if self.compression is None:
+                raise RecievingError("Recieved a compressed frame without a codec")
+            try:
+                body = memoryview(self.compression.codec.decompress(body, MAX_FRAME))
+            except ValueError as e:
+                raise RecievingError(f"Recieved frame can't be decompressed: {e}")
+
+        return message_type, flags, body
 
     def recieve_prefix(self) -> Request:
-        prefix_length = int(self.socket.recv(1).decode(encoding="utf-8"), base=16)
-
-        encoded_prefix = b""
-        total_bytes_recieved = 0
-        while total_bytes_recieved != prefix_length:
-            message_buffer = self.socket.recv(prefix_length - total_bytes_recieved)
-            total_bytes_recieved += len(message_buffer)
-            encoded_prefix = b"".join([encoded_prefix, message_buffer])
-
-        message_length = int(encoded_prefix.decode(encoding="utf-8"), base=16)
-        encoded_message = b""
-        total_bytes_recieved = 0
-        while total_bytes_recieved != message_length:
-            message_buffer = self.socket.recv(message_length - total_bytes_recieved)
-            total_bytes_recieved += len(message_buffer)
-            encoded_message = b"".join([encoded_message, message_buffer])
-
-        plaintext_message = encoded_message.decode(encoding="utf-8")
-        request: Request = json.JSONDecoder().decode(plaintext_message)
+        _, flags, body = self.recieve_frame()
+        if not flags & FLAG_JSON:
+            raise RecievingError("Recieved frame does not contain a request")
 
-        return request
+        return decode_request(body)
 
     def recieve_delim(self, delimiter: bytes = b"\0") -> Request:
-        encoded_message = b""
-
+        # Only scan the bytes that arrived since the last attempt
+        scanned = 0
         while True:
-            message_buffer = self.socket.recv(CHUNK_SIZE)
+            message_length = self.recieve_buffer.find(delimiter, scanned)
+            if message_length != -1:
+                break
+
+            scanned = max(0, len(self.recieve_buffer) - len(delimiter) + 1)
+            self.recieve_buffer.fill(self.socket)
+
+        request = decode_request(self.recieve_buffer.take(message_length))
+        self.recieve_buffer.take(len(delimiter))
+
+        return request
@@ -4,21 +4,56 @@ import json
 import pathlib
 import platform
 import shutil
-import socket
+import time
 from tkinter import *
 from tkinter import filedialog, messagebox, ttk
 from typing import cast
 
 import misc_tools as tools
 import settings
-import socket_io as sio
+import startup_timing
+from BandwidthScheduler import BandwidthScheduler
+from BackupSession import BackupSession
+from BackupSocket import RecievingError, SendingError
+from ChangeJournal import ChangeJournal
 from DirectoryView import DirectoryView
+from NativeTransfer import NativeBackupClient, TransferError, TransferStats
+from PathTrie import PathTrie
+from RsyncBackup import BackupError, RsyncBackup
 from RsyncTracker import RsyncTracker
 
 
 class BackupWindow:
+    SAVE_DELAY = 500
+    """Milliseconds without edits before backup.json is written"""
+    MAX_SAVE_DELAY = 5000
+    """Longest a stream of edits can put off writing backup.json"""
+
     def __init__(self, parent, menubar: Menu):
         self.last_modified = ""
+        self.conf_dirty = False
+        """Edits that aren't in backup.json yet"""
+        self.save_after: str | None = None
+        self.first_unsaved = 0.0
+        self.synced_backup_conf: dict = {}
+        """The server's copy of backup.json as of the last sync"""
+        self.synced_version = ""
+        """The server's version of that copy, for conditional requests"""
+        self.rsync_backup: RsyncBackup | None = None
+        self.rsync_progress: RsyncTracker | None = None
+        self.journal: ChangeJournal | None = None
+        """What changed since the last backup, where inotify is available"""
+        if ChangeJournal.available():
+            try:
+                self.journal = ChangeJournal()
+            except OSError:
+                pass
+        # One connection to the server that every command goes through
+        self.session = BackupSession(
+            (settings.settings["Host"], settings.settings["Port"]),
+            username=settings.settings["Username"],
+            timeout=settings.settings["TimeoutLength"],
+        )
         self.mainframe = ttk.Frame(parent, padding="5 10")
         self.mainframe.grid(column=0, row=0, sticky="NSEW")
 
@@ -81,11 +116,14 @@ class BackupWindow:
             500, tools.non_blocking_executor_shutdown, self.mainframe, executor, future
         )
         self.dir_view.view.after(100, self.dir_view.populate)
+        self.dir_view.view.bind(
+            "<<PopulateDone>>",
+            lambda _: startup_timing.mark("Folders shown"),
+            add="+",
+        )
 
         # Kickstart the backup.json autoupdater
-        self.mainframe.after(
-            10, self.update_remote_backup_conf, datetime.datetime.now()
-        )
+        self.mainframe.after(self.__remote_interval__(), self.update_remote_backup_conf)
 
     def populate_menubar(self):
         file_menu = Menu(self.menubar)
@@ -124,106 +162,114 @@ class BackupWindow:
         remote_backup_conf = self.get_remote_backup_conf()
         local_backup_conf = self.get_local_backup_conf()
 
-        remote_last_modified = remote_backup_conf.get("LastModified") or ""
-        local_last_modified = local_backup_conf.get("LastModified")
-
-        backup_conf = (
-            local_backup_conf
-            if local_last_modified is not None
-            and local_last_modified >= remote_last_modified
-            else remote_backup_conf
-        )
+        backup_conf = settings.newest_backup_conf(local_backup_conf, remote_backup_conf)
 
         self.last_modified = backup_conf.get("LastModified") or ""
         self.dir_view.directories = cast(
             list[str], backup_conf.get("BackupDirectories")
         )
         deselected = backup_conf.get("DeselectedDirectories") or []
-        self.dir_view.deselected = set(deselected)
+        self.dir_view.deselected = PathTrie(deselected)
         removed = backup_conf.get("RemovedDirectories") or []
-        self.dir_view.removed = set(removed)
+        self.dir_view.removed = PathTrie(removed)
+        self.watch_backup_dirs()
+        startup_timing.mark("Backup conf loaded")
 
     def get_remote_backup_conf(self):
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.settimeout(settings.settings["TimeoutLength"])
-        client.connect((settings.settings["Host"], settings.settings["Port"]))
-        sio.send(client, "RequestBackupConf", type="delim")
-        backup_conf_string = sio.recv_delim(client, settings.settings["Host"])
-        client.shutdown(socket.SHUT_RDWR)
-        client.close()
-
-        if backup_conf_string == "":
+        response = self.session.request(
+            "RequestBackupConf", IfNoneMatch=self.synced_version
+        )
+        response = response.result(settings.settings["TimeoutLength"])
+
+        if response["metadata"].get("Status") == "NotModified":
+            return self.synced_backup_conf
+
+        if response["body"] == "":
             return {}
 
-        return json.loads(backup_conf_string)
+        self.synced_backup_conf = json.loads(response["body"])
+        self.synced_version = response["metadata"].get("Version") or ""
+        return self.synced_backup_conf
 
     def get_local_backup_conf(self):
-        if pathlib.Path("backup.json").exists():
-            backup_json = open("backup.json", mode="r")
-        else:
-            backup_json = open("backup_json", mode="x")
-
-        backup_json.close()
+        return settings.read_backup_conf()
 
-        backup_json = open("backup.json", mode="r")
-        try:
-            backup_conf: dict = json.load(backup_json)
-        except json.JSONDecodeError:
-            backup_conf = {}
+    def backup_conf_contents(self):
+        json_contents = {}
+        json_contents["LastModified"] = self.last_modified
+        json_contents["BackupDirectories"] = list(self.dir_view.directories)
+        json_contents["DeselectedDirectories"] = list(self.dir_view.deselected)
+        json_contents["RemovedDirectories"] = list(self.dir_view.removed)
 
-        return backup_conf
+        return json_contents
 
     def save_backup_conf(self):
+        """
+        Marks backup.json as edited. It's written once edits stop for
+        SAVE_DELAY so a burst of clicks costs one write
+        """
         self.last_modified = datetime.datetime.now(datetime.timezone.utc)
         self.last_modified = tools.datetime_to_ISO8601(self.last_modified)
-        json_contents = {}
 
-        json_contents["LastModified"] = self.last_modified
-        json_contents["BackupDirectories"] = self.dir_view.directories
-        json_contents["DeselectedDirectories"] = list(self.dir_view.deselected)
-        json_contents["RemovedDirectories"] = list(self.dir_view.removed)
+        now = time.monotonic()
+        if self.save_after is None:
+            self.first_unsaved = now
+        else:
+            self.mainframe.after_cancel(self.save_after)
+        waited = int((now - self.first_unsaved) * 1000)
+        delay = max(min(self.SAVE_DELAY, self.MAX_SAVE_DELAY - waited), 0)
+        self.conf_dirty = True
+        self.save_after = self.mainframe.after(delay, self.flush_backup_conf)
+
+    def flush_backup_conf(self):
+        """Writes backup.json now if it has edits that aren't in it yet"""
+        self.save_after = None
+        if not self.conf_dirty:
+            return
 
-        with open("backup.json", mode="w") as backup_json:
-            json.dump(json_contents, backup_json)
+        self.conf_dirty = False
+        json_contents = self.backup_conf_contents()
+        tools.atomic_write(pathlib.Path("backup.json"), json.dumps(json_contents))
 
-        return
+    def update_remote_backup_conf(self):
+        self.mainframe.after(self.__remote_interval__(), self.update_remote_backup_conf)
 
-    # Interval is in minutes
-    def update_remote_backup_conf(self, last_update_time: datetime.datetime):
-        INTERVAL = settings.settings["RemoteUpdateInterval"]
-        now = datetime.datetime.now()
-        time_since_last_update = now - last_update_time
-        if time_since_last_update < datetime.timedelta(minutes=INTERVAL):
-            self.mainframe.after(10, self.update_remote_backup_conf, last_update_time)
+        # Read here since the tree is only safe to touch from the UI thread
+        json_contents = self.backup_conf_contents()
+        if json_contents == self.synced_backup_conf:
             return
 
         executor = concurrent.futures.ThreadPoolExecutor()
-        future = executor.submit(self.send_backup_conf)
+        future = executor.submit(self.send_backup_conf, json_contents)
         self.mainframe.after(
             10, tools.non_blocking_executor_shutdown, self.mainframe, executor, future
         )
 
-        # If updated start another countdown but with the current time as the last updated time
-        self.mainframe.after(10, self.update_remote_backup_conf, now)
-
-        return
-
-    def send_backup_conf(self):
-        json_contents = {}
-        json_contents["LastModified"] = self.last_modified
-        json_contents["BackupDirectories"] = self.dir_view.directories
-        json_contents["DeselectedDirectories"] = list(self.dir_view.deselected)
-        json_contents["RemovedDirectories"] = list(self.dir_view.removed)
-
-        json_string = json.dumps(json_contents)
-
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.settimeout(settings.settings["TimeoutLength"])
-        client.connect((settings.settings["Host"], settings.settings["Port"]))
-        sio.send(client, "UpdateBackupConf", type="delim")
-        sio.send(client, json_string, type="delim")
-        client.shutdown(socket.SHUT_RDWR)
-        client.close()
+    def __remote_interval__(self):
+        # RemoteUpdateInterval is in minutes
+        return int(settings.settings["RemoteUpdateInterval"] * 60 * 1000)
+
+    def send_backup_conf(self, json_contents: dict):
+        # Only send what changed since the server's copy when we know what it has
+        if self.synced_backup_conf != {}:
+            patch = tools.diff_backup_conf(self.synced_backup_conf, json_contents)
+            response = self.session.request(
+                "PatchBackupConf",
+                json.dumps(patch),
+                BaseVersion=self.synced_version,
+            )
+            response = response.result(settings.settings["TimeoutLength"])
+            if response["metadata"].get("Status") == "OK":
+                self.synced_backup_conf = json_contents
+                self.synced_version = response["metadata"].get("Version") or ""
+                return
+
+        # Server's copy changed under us (or we never had it) so send everything
+        response = self.session.request("UpdateBackupConf", json.dumps(json_contents))
+        response = response.result(settings.settings["TimeoutLength"])
+        if response["metadata"].get("Status") == "OK":
+            self.synced_backup_conf = json_contents
+            self.synced_version = response["metadata"].get("Version") or ""
 
         return
 
@@ -244,6 +290,7 @@ class BackupWindow:
             return
 
         self.dir_view.add_item(pathlib.Path(dir), base=True)
+        self.watch_backup_dirs()
         self.save_backup_conf()
 
     def add_file(self):
@@ -253,12 +300,14 @@ class BackupWindow:
             return
 
         self.dir_view.add_item(pathlib.Path(filename), base=True)
+        self.watch_backup_dirs()
         self.save_backup_conf()
 
     def remove_item(self):
         selected_items = self.dir_view.last_selection
         for item in selected_items:
             self.dir_view.remove_item(item)
+        self.watch_backup_dirs()
         self.save_backup_conf()
 
     def select_all(self):
@@ -271,8 +320,8 @@ class BackupWindow:
         include_dirs = self.dir_view.directories.copy()
 
         exclude_dirs = []
-        exclude_dirs.extend(self.dir_view.deselected.copy())
-        exclude_dirs.extend(self.dir_view.removed.copy())
+        exclude_dirs.extend(self.dir_view.deselected)
+        exclude_dirs.extend(self.dir_view.removed)
 
         self.__backup__(include_dirs=include_dirs, exclude_dirs=exclude_dirs)
 
@@ -297,97 +346,202 @@ class BackupWindow:
         self.menubar.entryconfigure("Backup", state=DISABLED)
         self.buttons["Backup"].state(["disabled"])
 
-        include_file = self.__create_files_from_file__(include_dirs)
-        exclude_file = self.__create_exclude_file__(exclude_dirs)
-
-        if platform.system() == "Windows":
-            include_file = tools.win_to_rsync_readable_posix(include_file)
-            exclude_file = tools.win_to_rsync_readable_posix(exclude_file)
+        if settings.settings["TransferMode"] == "native":
+            return self.__native_backup__(include_dirs, exclude_dirs)
 
         rsync_path = shutil.which("rsync")
         if rsync_path == None:
             return 1
 
-        rsync_user = settings.settings.get("ServerUser") or "user"
+        self.__skip_journal__(include_dirs, exclude_dirs)
 
-        out_format = "| %f | %b"
-        ssh_port = settings.settings["SSHPort"]
-        ssh_command = f"ssh -p {ssh_port}"
-        rsync_command: list[str] = [
+        # Sizes are looked up by prepare() off the UI thread, as a root that
+        # isn't scanned yet gets scanned then
+        self.rsync_backup = RsyncBackup(
+            self.session,
             rsync_path,
-            "-e",
-            ssh_command,
-            "--archive",
-            "--recursive",
-            "--compress",
-            "--partial",
-            f"--exclude-from={exclude_file}",
-            f"--files-from={include_file}",
-            f"--out-format={out_format}",
-            "/",
-            f"{rsync_user}@{settings.settings["Host"]}:~/Backups/",
-        ]
-
-        total_to_backup = self.total_files_to_backup(include_dirs, exclude_dirs)
-        rsync_progress = RsyncTracker(
+            include_dirs,
+            exclude_dirs,
+            self.dir_view.scanner.lookup,
+        )
+
+        # Every run gets its own snapshot folder from the server. The session
+        # gives up on the request by itself after TimeoutLength
+        future = self.rsync_backup.begin()
+        self.mainframe.after(100, self.__snapshot_begun__, future, include_dirs)
+
+        return 0
+
+    def __snapshot_begun__(
+        self, future: concurrent.futures.Future, include_dirs: list[str]
+    ):
+        if not future.done():
+            self.mainframe.after(100, self.__snapshot_begun__, future, include_dirs)
+            return
+
+        rsync_backup = cast(RsyncBackup, self.rsync_backup)
+        try:
+            rsync_backup.snapshot_begun(future.result())
+        except (OSError, SendingError, RecievingError, BackupError) as e:
+            return self.__rsync_failed__(f"The server couldn't start a snapshot: {e}")
+
+        # The plan compares every file with the previous snapshot so it runs
+        # off the UI thread
+        executor = concurrent.futures.ThreadPoolExecutor()
+        future = executor.submit(rsync_backup.prepare)
+        self.mainframe.after(
+            100, self.__start_transfer__, executor, future, include_dirs
+        )
+
+    def __start_transfer__(
+        self,
+        executor: concurrent.futures.Executor,
+        future: concurrent.futures.Future,
+        include_dirs: list[str],
+    ):
+        if not future.done():
+            self.mainframe.after(
+                100, self.__start_transfer__, executor, future, include_dirs
+            )
+            return
+
+        executor.shutdown()
+        rsync_backup = cast(RsyncBackup, self.rsync_backup)
+        try:
+            plan = future.result()
+        except (OSError, SendingError, RecievingError, ValueError) as e:
+            return self.__rsync_failed__(f"Could not prepare the transfer: {e}")
+        if plan is not None:
+            total_to_backup, bytes_to_backup = plan.files, plan.bytes
+        else:
+            total_to_backup = self.total_files_to_backup(
+                include_dirs, rsync_backup.exclude_dirs
+            )
+            bytes_to_backup = None
+        self.rsync_progress = RsyncTracker(
             self.mainframe,
             HOST=settings.settings["Host"],
-            rsync_command=rsync_command,
+            rsync_commands=rsync_backup.rsync_commands,
             total_to_backup=total_to_backup,
+            bytes_to_backup=bytes_to_backup,
+            scheduler=rsync_backup.scheduler,
         )
 
-        rsync_progress.window.bind(
+        self.rsync_progress.window.bind(
             "<<RsyncCompleted>>", lambda e: self.__end_backup__(e)
         )
 
-        return 0
+    def __rsync_failed__(self, detail: str):
+        # A snapshot that was begun is ended so the server doesn't keep it open
+        rsync_backup = cast(RsyncBackup, self.rsync_backup)
+        if rsync_backup.snapshot != "":
+            rsync_backup.end(False)
+
+        messagebox.showerror(
+            title="Backup Failed",
+            message=f"Could not back up files to {settings.settings["Host"]}",
+            detail=detail,
+        )
+        self.menubar.entryconfigure("Backup", state=NORMAL)
+        self.buttons["Backup"].state(["!disabled"])
 
     def __end_backup__(self, e: Event):
-        pathlib.Path("ExcludeFrom.tmp").resolve().unlink()
-        pathlib.Path("FilesFrom.tmp").resolve().unlink()
         e.widget.destroy()
 
+        completed = cast(RsyncTracker, self.rsync_progress).returncode == 0
+        cast(RsyncBackup, self.rsync_backup).end(completed)
+
         self.menubar.entryconfigure("Backup", state=NORMAL)
         self.buttons["Backup"].state(["!disabled"])
         return
 
-    def __create_files_from_file__(self, include_dirs: list[str]):
-        if platform.system() == "Windows":
-            include_dirs = list(
-                map(tools.win_to_rsync_readable_posix, map(pathlib.Path, include_dirs))
-            )
+    def __native_backup__(self, include_dirs: list[str], exclude_dirs: list[str]):
+        executor = concurrent.futures.ThreadPoolExecutor()
+        future = executor.submit(self.__run_native_backup__, include_dirs, exclude_dirs)
+        self.mainframe.after(100, self.__end_native_backup__, executor, future)
 
-        file_contents = "\n".join(include_dirs)
-        with open("FilesFrom.tmp", mode="w") as include_file:
-            if include_file.write(file_contents) != len(file_contents):
-                messagebox.showwarning(
-                    title="Write Error",
-                    message="Could not fully write the contents of FilesFrom.tmp",
-                )
+        return 0
 
-        return pathlib.Path("FilesFrom.tmp").resolve()
+    def __run_native_backup__(self, include_dirs: list[str], exclude_dirs: list[str]):
+        client = NativeBackupClient(
+            (settings.settings["Host"], settings.settings["Port"]),
+            username=settings.settings["Username"],
+            timeout=settings.settings["TimeoutLength"],
+            bucket=BandwidthScheduler.from_settings(settings.settings).bucket(),
+        )
+        changes = None
+        if self.journal is not None:
+            changes = self.journal.take(include_dirs, exclude_dirs)
+        try:
+            return client.backup(include_dirs, exclude_dirs, changes=changes)
+        except BaseException:
+            # Whatever stopped it, the changes taken from the journal weren't
+            # all sent. It's raised again for __end_native_backup__
+            self.__invalidate_journal__()
+            raise
+        finally:
+            client.close()
+
+    def __end_native_backup__(
+        self, executor: concurrent.futures.Executor, future: concurrent.futures.Future
+    ):
+        if not future.done():
+            self.mainframe.after(100, self.__end_native_backup__, executor, future)
+            return
 
-    def __create_exclude_file__(self, exclude_dirs: list[str]):
-        if platform.system() == "Windows":
-            exclude_dirs = list(
-                map(tools.win_to_rsync_readable_posix, map(pathlib.Path, exclude_dirs))
+        executor.shutdown()
+        self.menubar.entryconfigure("Backup", state=NORMAL)
+        self.buttons["Backup"].state(["!disabled"])
+
+        # A server that drops the connection or falls out of step with the
+        # protocol surfaces as any of these, and a reply that isn't JSON as
+        # a ValueError
+        try:
+            stats: TransferStats = future.result()
+        except (
+            OSError,
+            TransferError,
+            BackupError,
+            SendingError,
+            RecievingError,
+            ValueError,
+        ) as e:
+            messagebox.showerror(
+                title="Backup Failed",
+                message=f"Could not back up files to {settings.settings["Host"]}",
+                detail=str(e),
             )
+            return
+
+        messagebox.showinfo(
+            title="Backup Completed",
+            message=f"Successfully backed up files to {settings.settings["Host"]}",
+            detail=stats.summary(),
+        )
+
+    def watch_backup_dirs(self):
+        if self.journal is not None:
+            self.journal.watch_only(self.dir_view.directories)
 
-        file_contents = "\n".join(exclude_dirs)
-        with open("ExcludeFrom.tmp", mode="w") as exclude_file:
-            if exclude_file.write(file_contents) != len(file_contents):
-                messagebox.showwarning(
-                    title="Write Error",
-                    message="Could not fully write the contents of ExcludeFrom.tmp",
-                )
+    def __skip_journal__(self, include_dirs: list[str], exclude_dirs: list[str]):
+        # rsync compares every file itself so what the journal wrote down is
+        # dropped. The next native backup can't use it either, as its previous
+        # snapshot is older than this backup
+        if self.journal is not None:
+            self.journal.take(include_dirs, exclude_dirs)
+            self.journal.invalidate()
 
-        return pathlib.Path("ExcludeFrom.tmp").resolve()
+    def __invalidate_journal__(self):
+        # What this backup didn't send still has to go in the next one
+        if self.journal is not None:
+            self.journal.invalidate()
 
     def total_files_to_backup(self, include_dirs: list[str], exclude_dirs: list[str]):
+        # Reuses the scans the directory view already did
         total_include = map(pathlib.Path, include_dirs)
-        total_include = sum(map(tools.how_many_files_in, total_include))
+        total_include = sum(map(self.dir_view.count_of, total_include))
 
         total_exclude = map(pathlib.Path, exclude_dirs)
-        total_exclude = sum(map(tools.how_many_files_in, total_exclude))
+        total_exclude = sum(map(self.dir_view.count_of, total_exclude))
 
         return total_include - total_exclude
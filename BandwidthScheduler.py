@@ -0,0 +1,137 @@
+"""
+Caps how fast backups send, with different caps at different times of day
+
+settings.json can have:
+- BandwidthLimit: KiB/s used outside every window, 0 for no cap
+- BandwidthWindows: a list of {"Start": "09:00", "End": "17:30",
+  "Limit": 256, "Days": [0, 1, 2, 3, 4]}. Days are optional, Monday is 0,
+  and windows that end before they start run past midnight. The first
+  window that matches wins
+
+rsync gets the cap as --bwlimit when it starts, split between its streams.
+A window can start during a backup, so RsyncTracker also checks how fast
+rsync sends against the cap and pauses rsync for as long as it got ahead.
+Native backups take the cap through a TokenBucket that follows the windows
+"""
+
+import datetime
+import threading
+import time
+
+KIB = 1024
+BURST_SECONDS = 0.5
+"""How far ahead of the cap a bucket lets a sender get"""
+MIN_BURST = 256 * KIB
+"""Big enough that one chunk always fits"""
+MAX_PAUSE = 5.0
+"""Longest pause_for() asks for, so one bad measurement can't stall a backup"""
+
+
+def parse_time(text: str):
+    hours, minutes = text.split(":")
+    return datetime.time(int(hours), int(minutes))
+
+
+class BandwidthScheduler:
+    def __init__(self, limit: int = 0, windows: list[dict] | None = None):
+        self.limit = limit
+        self.windows = [
+            (
+                parse_time(window["Start"]),
+                parse_time(window["End"]),
+                window["Limit"],
+                set(window.get("Days") or range(7)),
+            )
+            for window in windows or []
+        ]
+
+    @staticmethod
+    def from_settings(settings: dict):
+        return BandwidthScheduler(
+            settings.get("BandwidthLimit") or 0, settings.get("BandwidthWindows")
+        )
+
+    def limit_at(self, when: datetime.datetime):
+        """Returns the cap at when in bytes a second, or None if there isn't one"""
+        limit = self.limit
+        now = when.time()
+        for start, end, window_limit, days in self.windows:
+            if start <= end:
+                inside = start <= now < end and when.weekday() in days
+            else:
+                # Runs past midnight, so the early hours belong to yesterday
+                day = when.weekday() if now >= start else (when.weekday() - 1) % 7
+                inside = (now >= start or now < end) and day in days
+            if inside:
+                limit = window_limit
+                break
+
+        return limit * KIB if limit > 0 else None
+
+    def rsync_limit(self, streams: int):
+        """
+        Returns the --bwlimit option for each of streams rsyncs, if any
+        """
+        limit = self.limit_at(datetime.datetime.now())
+        if limit is None:
+            return []
+
+        return [f"--bwlimit={max(limit // KIB // streams, 1)}"]
+
+    def pause_for(self, speed: float, seconds: float):
+        """
+        Returns how long to pause senders that averaged speed over the last
+        seconds so they're back under the cap. speed has to be what went over
+        the network, as that's what the cap is for
+        """
+        limit = self.limit_at(datetime.datetime.now())
+        if limit is None or speed <= limit:
+            return 0.0
+
+        return min((speed - limit) * seconds / limit, MAX_PAUSE)
+
+    def bucket(self):
+        return TokenBucket(self)
+
+
+class TokenBucket:
+    """
+    Lets bytes through at the scheduler's current cap. Senders consume what
+    they sent and are put to sleep once they're further ahead than the burst
+    """
+
+    def __init__(self, scheduler: BandwidthScheduler):
+        self.scheduler = scheduler
+        self.lock = threading.Lock()
+        self.rate: int | None = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.checked = 0.0
+        self.__check_rate__(self.updated)
+
+    def consume(self, size: int):
+        with self.lock:
+            now = time.monotonic()
+            # Windows only change on the minute so checking often is a waste
+            if now - self.checked >= 1:
+                self.__check_rate__(now)
+            if self.rate is None:
+                return
+
+            burst = max(self.rate * BURST_SECONDS, MIN_BURST)
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, burst)
+            self.updated = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def __check_rate__(self, now: float):
+        self.checked = now
+        rate = self.scheduler.limit_at(datetime.datetime.now())
+        if rate != self.rate:
+            # A new cap starts from an empty bucket
+            self.rate = rate
+            self.tokens = 0.0
+            self.updated = now
@@ -0,0 +1,315 @@
+"""
+A journal of what changed under the backed up folders since the last backup
+
+On Linux the folders are watched with inotify, through ctypes so nothing
+has to be installed, and every path that changes is written down. The next
+backup then only looks at those paths instead of walking every folder.
+
+Whenever the journal might have missed something, take() returns None and
+the backup falls back to a full scan. That happens when the journal was
+just started, when the kernel's event queue overflowed, when a watch
+couldn't be added and when the folders backed up or excluded aren't the
+ones the previous take() was for
+"""
+
+import ctypes
+import ctypes.util
+import os
+import platform
+import queue
+import select
+import struct
+import threading
+
+from PathTrie import PathTrie
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+EVENT = struct.Struct("iIII")
+"""Watch descriptor, mask, cookie and length of the name that follows"""
+READ_SIZE = 64 * 1024
+
+
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.libc = libc
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path: str) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+
+        return wd
+
+    def rm_watch(self, wd: int):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self) -> list[tuple[int, int, str]]:
+        """
+        Returns the watch descriptor, mask and name of every waiting event
+        """
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset : offset + name_length].rstrip(b"\0")
+            offset += name_length
+            events.append((wd, mask, os.fsdecode(name)))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ChangeJournal:
+    def __init__(self):
+        self.inotify = Inotify()
+        self.lock = threading.Lock()
+        self.roots: set[str] = set()
+        self.watches: dict[int, str] = {}
+        """Watch descriptor to the folder it watches"""
+        self.changed: set[str] = set()
+        self.removed: set[str] = set()
+        self.complete = False
+        """Whether every change since the last take() was written down"""
+        self.selection: tuple[frozenset[str], frozenset[str]] | None = None
+        """The roots and excluded folders the last take() was for"""
+        self.failed = False
+        """A watch couldn't be added, so the journal can never be complete"""
+
+        self.requests: queue.Queue[set[str]] = queue.Queue()
+        self.pending = 0
+        """watch_only() calls whose watches aren't all added yet"""
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.running = True
+        self.thread = threading.Thread(target=self.__run__, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def available():
+        return (
+            platform.system() == "Linux" and ctypes.util.find_library("c") is not None
+        )
+
+    def close(self):
+        self.running = False
+        os.write(self.wakeup_write, b"\0")
+        self.thread.join()
+        self.inotify.close()
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+
+    def watch_only(self, roots: list[str]):
+        """
+        Watches roots and stops watching everything else
+        Adding watches walks every folder so it happens on the journal's thread
+        """
+        with self.lock:
+            self.pending += 1
+        self.requests.put({os.path.normpath(root) for root in roots})
+        os.write(self.wakeup_write, b"\0")
+
+    def take(self, roots: list[str], exclude_dirs: list[str]):
+        """
+        Returns the paths under roots that changed and the ones that were
+        removed since the last take(), or None if the journal might have
+        missed some of them. Changes under other roots are kept
+        """
+        taken_roots = {os.path.normpath(root) for root in roots}
+        selection = (
+            frozenset(taken_roots),
+            frozenset(os.path.normpath(path) for path in exclude_dirs),
+        )
+        with self.lock:
+            settled = self.pending == 0 and taken_roots <= self.roots
+            changed = {path for path in self.changed if under(path, taken_roots)}
+            removed = {path for path in self.removed if under(path, taken_roots)}
+            self.changed -= changed
+            self.removed -= removed
+
+            # Files in a root or under an exclude that's new since the last
+            # take() were never written down, and the previous snapshot
+            # doesn't have them either
+            changes = None
+            if self.complete and settled and selection == self.selection:
+                changes = (changed, removed)
+
+            self.selection = selection
+            self.complete = settled and not self.failed
+
+        return changes
+
+    def invalidate(self):
+        """Makes the next take() fall back to a full scan"""
+        with self.lock:
+            self.complete = False
+
+    def __run__(self):
+        while self.running:
+            readable, _, _ = select.select([self.inotify.fd, self.wakeup_read], [], [])
+            if self.wakeup_read in readable:
+                os.read(self.wakeup_read, READ_SIZE)
+                while not self.requests.empty():
+                    self.__set_roots__(self.requests.get())
+                    with self.lock:
+                        self.pending -= 1
+
+            if self.inotify.fd in readable:
+                for wd, mask, name in self.inotify.read_events():
+                    self.__record__(wd, mask, name)
+
+    def __set_roots__(self, roots: set[str]):
+        with self.lock:
+            added = roots - self.roots
+            self.roots = roots
+            # Nothing in the new roots was written down before they're watched
+            if added:
+                self.complete = False
+            # Folders of roots that are files are watched for that file's sake
+            file_folders = {os.path.dirname(root) for root in roots}
+            for wd, path in list(self.watches.items()):
+                if not under(path, roots) and path not in file_folders:
+                    self.inotify.rm_watch(wd)
+                    del self.watches[wd]
+
+        for root in added:
+            if os.path.isdir(root):
+                self.__watch_tree__(root, record=False)
+            else:
+                self.__add_watch__(os.path.dirname(root))
+
+    def __add_watch__(self, path: str):
+        try:
+            wd = self.inotify.add_watch(path)
+        except OSError:
+            # Usually fs.inotify.max_user_watches being too low
+            with self.lock:
+                self.failed = True
+                self.complete = False
+            return
+
+        with self.lock:
+            self.watches[wd] = path
+
+    def __watch_tree__(self, root: str, record: bool):
+        """
+        Watches every folder under root. With record every file found is
+        written down as changed since it could have been made before the watch
+        """
+        for dir_path, dir_names, file_names in os.walk(root):
+            self.__add_watch__(dir_path)
+            if record:
+                with self.lock:
+                    for name in file_names:
+                        self.changed.add(os.path.join(dir_path, name))
+
+    def __record__(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            self.invalidate()
+            return
+
+        with self.lock:
+            folder = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            if folder is None or mask & IN_IGNORED:
+                return
+
+            path = os.path.join(folder, name) if name else folder
+            if not under(path, self.roots):
+                return
+
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self.removed.add(path)
+                self.changed.discard(path)
+                if mask & IN_ISDIR:
+                    # A moved folder keeps its watches, which would still
+                    # report it under the old path
+                    for moved_wd, moved in list(self.watches.items()):
+                        if moved == path or moved.startswith(path + os.sep):
+                            self.inotify.rm_watch(moved_wd)
+                            del self.watches[moved_wd]
+                return
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                return
+
+            self.changed.add(path)
+            self.removed.discard(path)
+
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self.__watch_tree__(path, record=True)
+
+
+def under(path: str, roots: set[str]):
+    return any(path == root or path.startswith(root + os.sep) for root in roots)
+
+
+def changed_files(paths: set[str], include_dirs: list[str], exclude_dirs: list[str]):
+    """
+    Returns the paths that are still files inside include_dirs and outside
+    exclude_dirs, sorted
+    """
+    included = PathTrie(include_dirs)
+    excluded = PathTrie(exclude_dirs)
+    return sorted(
+        path
+        for path in paths
+        if included.covers(path) and not excluded.covers(path) and os.path.isfile(path)
+    )
+
+
+def removed_paths(paths: set[str], include_dirs: list[str], exclude_dirs: list[str]):
+    included = PathTrie(include_dirs)
+    excluded = PathTrie(exclude_dirs)
+    return sorted(
+        path for path in paths if included.covers(path) and not excluded.covers(path)
+    )
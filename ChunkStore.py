@@ -0,0 +1,329 @@
+"""
+Content addressed storage for the chunks sent by NativeBackupClient
+
+Every chunk is stored once no matter how many files, clients or backups
+contain it. Chunks are appended to pack files and found through an index
+laid out like git's pack indexes: records sorted by digest behind a fan-out
+table of the first byte, so a lookup is a short binary search over a mmap
+instead of a dict that holds millions of digests in memory
+
+A store opened read only, like by backups_exporter.py while the server is
+running, only maps the index and opens packs to read from them
+"""
+
+import heapq
+import io
+import itertools
+import json
+import mmap
+import os
+import pathlib
+import struct
+import threading
+from typing import Iterable
+
+DIGEST_SIZE = 32
+INDEX_MAGIC = b"BIDX"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("!4sIQ")
+"""Magic, version and amount of records"""
+FANOUT = struct.Struct("!256Q")
+"""fanout[b] is the amount of records whose digest starts with a byte <= b"""
+INDEX_RECORD = struct.Struct("!32sIQI")
+"""Digest, pack number, offset in the pack and length of a chunk"""
+RECORDS_START = INDEX_HEADER.size + FANOUT.size
+
+PACK_SIZE = 256 * 1024 * 1024
+"""A new pack file is started once the current one is bigger than this"""
+COMPACT_AT = 65536
+"""Records in index.log before they're merged into the sorted index"""
+RECORDS_PER_READ = 4096
+
+
+class ChunkStore:
+    def __init__(self, root: pathlib.Path, read_only: bool = False):
+        self.root = root
+        self.read_only = read_only
+        self.pack_dir = root / "packs"
+        if not read_only:
+            self.pack_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = root / "index"
+        self.log_path = root / "index.log"
+        # index.log while it's being merged, new records go to a fresh index.log
+        self.merging_path = root / "index.log.merging"
+        self.stats_path = root / "stats.json"
+
+        self.lock = threading.RLock()
+        self.compact_lock = threading.Lock()
+        self.index_map: mmap.mmap | None = None
+        self.index_count = 0
+        self.fanout = [0] * 256
+        self.__open_index__()
+
+        # Records that aren't in the sorted index yet
+        self.recent: dict[bytes, tuple[int, int, int]] = {}
+        self.uncommitted: list[bytes] = []
+        for log_path in (self.merging_path, self.log_path):
+            if not log_path.exists():
+                continue
+            log = log_path.read_bytes()
+            usable = len(log) - len(log) % INDEX_RECORD.size
+            for digest, pack, offset, length in INDEX_RECORD.iter_unpack(log[:usable]):
+                self.recent[digest] = (pack, offset, length)
+
+        self.stats = {"LogicalBytes": 0, "StoredBytes": 0, "Chunks": 0}
+        if self.stats_path.exists():
+            self.stats.update(json.loads(self.stats_path.read_text()))
+
+        packs = sorted(int(pack.stem) for pack in self.pack_dir.glob("*.pack"))
+        self.pack_number = packs[-1] if packs != [] else 0
+        if not read_only:
+            self.pack_file = open(self.__pack_path__(self.pack_number), mode="ab")
+
+    def close(self):
+        # Waits for a running compact() as it reads the index outside the lock
+        with self.compact_lock, self.lock:
+            if not self.read_only:
+                self.commit()
+                self.pack_file.close()
+            if self.index_map is not None:
+                self.index_map.close()
+
+    def __pack_path__(self, pack: int):
+        return self.pack_dir / f"{pack:06}.pack"
+
+    def __open_index__(self):
+        if self.index_map is not None:
+            self.index_map.close()
+            self.index_map = None
+
+        self.index_count = 0
+        self.fanout = [0] * 256
+        if not self.index_path.exists() or self.index_path.stat().st_size == 0:
+            return
+
+        with open(self.index_path, mode="rb") as index_file:
+            self.index_map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count = INDEX_HEADER.unpack_from(self.index_map, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"{self.index_path} is not a chunk index")
+
+        self.index_count = count
+        self.fanout = list(FANOUT.unpack_from(self.index_map, INDEX_HEADER.size))
+
+    def __digest_at__(self, position: int):
+        start = RECORDS_START + position * INDEX_RECORD.size
+        return self.index_map[start : start + DIGEST_SIZE]
+
+    def lookup(self, digest: bytes) -> tuple[int, int, int] | None:
+        """
+        Returns the pack, offset and length of a chunk or None if it isn't stored
+        """
+        with self.lock:
+            location = self.recent.get(digest)
+            if location is not None or self.index_map is None:
+                return location
+
+            # The fan-out table narrows the search to digests with the same first byte
+            first_byte = digest[0]
+            low = self.fanout[first_byte - 1] if first_byte > 0 else 0
+            high = self.fanout[first_byte]
+            while low < high:
+                middle = (low + high) // 2
+                found = self.__digest_at__(middle)
+                if found < digest:
+                    low = middle + 1
+                elif found > digest:
+                    high = middle
+                else:
+                    start = RECORDS_START + middle * INDEX_RECORD.size
+                    _, pack, offset, length = INDEX_RECORD.unpack_from(
+                        self.index_map, start
+                    )
+                    return pack, offset, length
+
+            return None
+
+    def contains(self, digest: bytes):
+        return self.lookup(digest) is not None
+
+    def get(self, digest: bytes):
+        location = self.lookup(digest)
+        if location is None:
+            raise KeyError(digest.hex())
+
+        pack, offset, length = location
+        if pack == self.pack_number and not self.read_only:
+            # Might still be sitting in the write buffer
+            with self.lock:
+                self.pack_file.flush()
+
+        with open(self.__pack_path__(pack), mode="rb") as pack_file:
+            pack_file.seek(offset)
+            return pack_file.read(length)
+
+    def put(self, digest: bytes, data: bytes | memoryview):
+        """
+        Stores a chunk unless it's already stored
+        Returns whether it was new. Call commit() to make new chunks durable,
+        once for many files rather than after every one
+        """
+        self.__check_writable__()
+        with self.lock:
+            if self.contains(digest):
+                return False
+
+            if self.pack_file.tell() >= PACK_SIZE:
+                self.__write_log__()
+                self.pack_file.close()
+                self.pack_number += 1
+                self.pack_file = open(self.__pack_path__(self.pack_number), mode="ab")
+
+            offset = self.pack_file.tell()
+            self.pack_file.write(data)
+            self.recent[digest] = (self.pack_number, offset, len(data))
+            self.uncommitted.append(digest)
+
+            self.stats["StoredBytes"] += len(data)
+            self.stats["Chunks"] += 1
+            return True
+
+    def __check_writable__(self):
+        if self.read_only:
+            raise io.UnsupportedOperation(f"{self.root} was opened read only")
+
+    def add_logical(self, logical_bytes: int):
+        """
+        Counts logical_bytes of backed up data as stored, saved by commit()
+        """
+        self.__check_writable__()
+        with self.lock:
+            self.stats["LogicalBytes"] += logical_bytes
+
+    def commit(self):
+        """
+        Makes every chunk put so far durable
+        """
+        self.__check_writable__()
+        with self.lock:
+            self.__write_log__()
+
+            stats_temp = self.stats_path.with_suffix(".tmp")
+            stats_temp.write_text(json.dumps(self.stats))
+            os.replace(stats_temp, self.stats_path)
+
+            should_compact = len(self.recent) >= COMPACT_AT
+
+        if should_compact:
+            self.compact(wait=False)
+
+    def __write_log__(self):
+        if self.uncommitted == []:
+            return
+
+        # Chunk data has to be on disk before the index points at it
+        self.pack_file.flush()
+        os.fsync(self.pack_file.fileno())
+
+        records = b"".join(
+            INDEX_RECORD.pack(digest, *self.recent[digest])
+            for digest in self.uncommitted
+        )
+        with open(self.log_path, mode="ab") as log:
+            log.write(records)
+            log.flush()
+            os.fsync(log.fileno())
+        self.uncommitted = []
+
+    def compact(self, wait: bool = True):
+        """
+        Merges index.log into the sorted index
+        Only the log is sorted, the index is merged with it as it's read. The
+        lock is only held to swap logs and indexes so puts and lookups carry on
+        meanwhile. Without wait it gives up if another compact() is running
+        """
+        self.__check_writable__()
+        if not self.compact_lock.acquire(blocking=wait):
+            return
+
+        try:
+            with self.lock:
+                self.__write_log__()
+                if self.recent == {}:
+                    return
+
+                merging = sorted(self.recent.items())
+                if self.log_path.exists():
+                    os.replace(self.log_path, self.merging_path)
+                index_map = self.index_map
+                index_count = self.index_count
+
+            temp_path = self.__write_index_file__(
+                heapq.merge(
+                    self.__iter_index__(index_map, index_count),
+                    ((digest, *location) for digest, location in merging),
+                )
+            )
+
+            with self.lock:
+                os.replace(temp_path, self.index_path)
+                self.__open_index__()
+                # Anything put during the merge is only in the new index.log
+                for digest, _ in merging:
+                    self.recent.pop(digest, None)
+                self.merging_path.unlink(missing_ok=True)
+        finally:
+            self.compact_lock.release()
+
+    def __iter_index__(self, index_map: mmap.mmap | None, count: int):
+        if index_map is None:
+            return
+
+        for first in range(0, count, RECORDS_PER_READ):
+            start = RECORDS_START + first * INDEX_RECORD.size
+            end = (
+                RECORDS_START + min(first + RECORDS_PER_READ, count) * INDEX_RECORD.size
+            )
+            yield from INDEX_RECORD.iter_unpack(index_map[start:end])
+
+    def write_index(self, records: Iterable[tuple[bytes, int, int, int]]):
+        # records has to be sorted by digest
+        self.__check_writable__()
+        with self.compact_lock, self.lock:
+            os.replace(self.__write_index_file__(records), self.index_path)
+            self.__open_index__()
+
+    def __write_index_file__(self, records: Iterable[tuple[bytes, int, int, int]]):
+        """
+        Writes sorted records to a temporary index and returns its path
+        A digest that's in there twice, like after a crash between writing the
+        index and removing the merged log, is only kept once
+        """
+        counts = [0] * 256
+        previous = None
+        temp_path = self.index_path.with_suffix(".tmp")
+        with open(temp_path, mode="wb") as index_file:
+            # The header and fan-out table are filled in once the records are counted
+            index_file.seek(RECORDS_START)
+            for record in records:
+                if record[0] == previous:
+                    continue
+                previous = record[0]
+                counts[previous[0]] += 1
+                index_file.write(INDEX_RECORD.pack(*record))
+
+            fanout = list(itertools.accumulate(counts))
+            index_file.seek(0)
+            index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, fanout[255]))
+            index_file.write(FANOUT.pack(*fanout))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+
+        return temp_path
+
+    def dedup_ratio(self):
+        if self.stats["StoredBytes"] == 0:
+            return 1.0
+
+        return self.stats["LogicalBytes"] / self.stats["StoredBytes"]
@@ -0,0 +1,72 @@
+from tkinter import *
+from tkinter import messagebox
+
+import settings
+import startup_timing
+from BackupWindow import BackupWindow
+
+HOST_LOOKUP_POLL = 50
+"""Milliseconds between checks on the hostname lookup"""
+
+
+class ClientWindow:
+    def __init__(self):
+        self.root = Tk()
+
+        self.root.option_add("*tearOff", FALSE)
+        self.root.title("Backup-inator")
+        self.root.minsize(width=800, height=400)
+
+        self.root.columnconfigure(index=0, weight=1)
+        self.root.rowconfigure(index=0, weight=1)
+
+        menubar = Menu(self.root)
+        self.root["menu"] = menubar
+
+        self.backup_win = BackupWindow(self.root, menubar)
+        startup_timing.mark("Window built")
+        # Idle callbacks run once everything queued so far is drawn
+        self.root.after_idle(startup_timing.mark, "Interactive")
+        if settings.host_lookup is not None:
+            self.root.after(HOST_LOOKUP_POLL, self.__check_host_lookup__)
+
+        if settings.settings["Host"] == "no hostname":
+            messagebox.showerror(
+                title="No hostname in settings",
+                message="No hostname listed in settings",
+                detail="Please enter a hostname into settings",
+            )
+
+        # TODO: Let them type in their username instead of just the error message
+        if settings.settings["Username"] == "no username":
+            messagebox.showerror(
+                title="No username in settings",
+                message="No username listed in settings",
+                detail="Please enter a username into settings",
+            )
+
+        # TODO: Check if any setting var is missing and set it up
+
+    def __check_host_lookup__(self):
+        lookup = settings.host_lookup
+        if lookup is None or not lookup.done():
+            self.root.after(HOST_LOOKUP_POLL, self.__check_host_lookup__)
+            return
+
+        startup_timing.mark("Host resolved")
+        if settings.settings["Host"] == "socket.gaierror":
+            messagebox.showerror(
+                title="getaddrinfo failed",
+                message="Failed to get the server's IP",
+                detail="Please check if the server exists",
+            )
+            return
+
+        self.backup_win.session.set_address(
+            (settings.settings["Host"], settings.settings["Port"])
+        )
+
+    def run(self):
+        self.root.mainloop()
+        # Edits made just before closing are still waiting to be written
+        self.backup_win.flush_backup_conf()
@@ -0,0 +1,248 @@
+"""
+Compression for BackupSocket frames
+
+Both ends agree on a codec with the NegotiateCompression command. From then
+on every frame can be compressed on its own, marked with FLAG_COMPRESSED, at
+whatever level the sender's AdaptiveLevel thinks gets it across the fastest.
+Codecs other than zlib and lzma can be added with register_codec()
+"""
+
+import abc
+import collections
+import lzma
+import math
+import os
+import pathlib
+import random
+import time
+import zlib
+from typing import BinaryIO
+
+INCOMPRESSIBLE_SUFFIXES = {
+    # Archives
+    ".7z", ".bz2", ".gz", ".lz4", ".rar", ".tgz", ".xz", ".zip", ".zst",
+    # Images
+    ".avif", ".gif", ".heic", ".jpeg", ".jpg", ".png", ".webp",
+    # Audio and video
+    ".aac", ".flac", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".ogg", ".opus",
+    ".webm",
+    # Documents and packages that are zip files underneath
+    ".apk", ".docx", ".epub", ".jar", ".odt", ".pptx", ".xlsx",
+}  # fmt: skip
+SAMPLE_SIZE = 64 * 1024
+"""Bytes read from the start and the middle of a file to guess its entropy"""
+INCOMPRESSIBLE_ENTROPY = 7.5
+"""Bits per byte above which compressing isn't worth it"""
+MIN_COMPRESS_SIZE = 512
+"""Frames smaller than this are never compressed"""
+PROBE_EVERY = 64
+"""Frames between retrying a random level in case the data has changed"""
+DECAY = 0.9
+
+
+class Codec(abc.ABC):
+    """
+    A way of compressing frames. levels are the ones AdaptiveLevel picks
+    from, fastest first
+    """
+
+    name = ""
+    levels: tuple[int, ...] = ()
+
+    @abc.abstractmethod
+    def compress(self, data: bytes | memoryview, level: int) -> bytes: ...
+
+    @abc.abstractmethod
+    def decompress(self, data: bytes | memoryview, max_length: int) -> bytes:
+        """
+        Raises ValueError if data isn't exactly one compressed stream or it
+        decompresses to more than max_length bytes
+        """
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+    levels = (1, 3, 6, 9)
+
+    def compress(self, data: bytes | memoryview, level: int):
+        return zlib.compress(data, level)
+
+    def decompress(self, data: bytes | memoryview, max_length: int):
+        decompressor = zlib.decompressobj()
+        try:
+            # One byte over the limit is enough to tell it's too much
+            decompressed = decompressor.decompress(data, max_length + 1)
+        except zlib.error as e:
+            raise ValueError(str(e))
+
+        if len(decompressed) > max_length:
+            raise ValueError(f"Decompresses to over {max_length} bytes")
+        if not decompressor.eof or decompressor.unused_data != b"":
+            raise ValueError("Not exactly one compressed stream")
+
+        return decompressed
+
+
+class LzmaCodec(Codec):
+    name = "lzma"
+    levels = (0, 1, 3, 6)
+
+    def compress(self, data: bytes | memoryview, level: int):
+        return lzma.compress(data, preset=level)
+
+    def decompress(self, data: bytes | memoryview, max_length: int):
+        decompressor = lzma.LZMADecompressor()
+        try:
+            decompressed = decompressor.decompress(data, max_length + 1)
+        except lzma.LZMAError as e:
+            raise ValueError(str(e))
+
+        if len(decompressed) > max_length:
+            raise ValueError(f"Decompresses to over {max_length} bytes")
+        if not decompressor.eof or decompressor.unused_data != b"":
+            raise ValueError("Not exactly one compressed stream")
+
+        return decompressed
+
+
+CODECS: dict[str, Codec] = {}
+"""Every codec this end supports, most preferred first"""
+
+
+def register_codec(codec: Codec):
+    CODECS[codec.name] = codec
+
+
+register_codec(ZlibCodec())
+register_codec(LzmaCodec())
+
+
+def negotiate(offered: list[str]):
+    """
+    Returns the first of the other end's codecs that this end supports
+    or "" if there isn't one
+    """
+    for name in offered:
+        if name in CODECS:
+            return name
+
+    return ""
+
+
+class AdaptiveLevel:
+    """
+    Picks the level that gets a frame across the fastest
+
+    Sending n bytes at a level takes n / compression speed plus
+    n * ratio / send speed, all of which are measured as frames are sent.
+    On a fast link that means little or no compression, on a slow one as
+    much as the CPU can keep up with. Level None sends frames as they are
+
+    The send speed is how fast the socket takes frames. Once the kernel's
+    send buffer is full that's the link's speed, but while it has room it's
+    only the time to copy into it, so a link looks faster than it is until
+    the buffer fills up and it errs towards compressing less
+    """
+
+    def __init__(self, codec: Codec):
+        self.codec = codec
+        self.levels: list[int | None] = [None, *codec.levels]
+        # Decaying totals so old measurements fade out
+        self.compressed_in = {level: 0.0 for level in codec.levels}
+        self.compressed_out = {level: 0.0 for level in codec.levels}
+        self.compress_time = {level: 0.0 for level in codec.levels}
+        self.link_bytes = 0.0
+        self.link_time = 0.0
+        self.frames = 0
+
+    def pick(self) -> int | None:
+        self.frames += 1
+        if self.link_time == 0:
+            return None
+
+        for level in self.codec.levels:
+            if self.compressed_in[level] == 0:
+                return level
+
+        if self.frames % PROBE_EVERY == 0:
+            return random.choice(self.levels)
+
+        return min(self.levels, key=self.cost)
+
+    def cost(self, level: int | None):
+        """Seconds per byte to get data across at level"""
+        link_speed = self.link_bytes / self.link_time
+        if level is None:
+            return 1 / link_speed
+
+        ratio = self.compressed_out[level] / self.compressed_in[level]
+        compress_speed = self.compressed_in[level] / max(
+            self.compress_time[level], 1e-9
+        )
+        return 1 / compress_speed + ratio / link_speed
+
+    def record_compression(
+        self, level: int, size: int, compressed: int, seconds: float
+    ):
+        self.compressed_in[level] = self.compressed_in[level] * DECAY + size
+        self.compressed_out[level] = self.compressed_out[level] * DECAY + compressed
+        self.compress_time[level] = self.compress_time[level] * DECAY + seconds
+
+    def record_send(self, size: int, seconds: float):
+        self.link_bytes = self.link_bytes * DECAY + size
+        self.link_time = self.link_time * DECAY + seconds
+
+    def compress(self, data: bytes | memoryview) -> bytes | None:
+        """
+        Returns data compressed at the picked level or None if it should be
+        sent as is
+        """
+        level = self.pick() if len(data) >= MIN_COMPRESS_SIZE else None
+        if level is None:
+            return None
+
+        start = time.perf_counter()
+        compressed = self.codec.compress(data, level)
+        self.record_compression(
+            level, len(data), len(compressed), time.perf_counter() - start
+        )
+
+        return compressed if len(compressed) < len(data) else None
+
+
+def entropy_of(sample: bytes):
+    """Shannon entropy of sample in bits per byte"""
+    if sample == b"":
+        return 0.0
+
+    entropy = 0.0
+    for count in collections.Counter(sample).values():
+        probability = count / len(sample)
+        entropy -= probability * math.log2(probability)
+
+    return entropy
+
+
+def looks_incompressible(path: pathlib.Path, file: BinaryIO | None = None):
+    """
+    Guesses from the extension, or failing that a sample of the contents,
+    whether compressing a file would only waste CPU
+    """
+    if path.suffix.lower() in INCOMPRESSIBLE_SUFFIXES:
+        return True
+
+    if file is None:
+        with open(path, mode="rb") as file:
+            return looks_incompressible(pathlib.Path(), file)
+
+    size = os.fstat(file.fileno()).st_size
+    position = file.tell()
+    try:
+        sample = file.read(SAMPLE_SIZE)
+        if size > SAMPLE_SIZE * 2:
+            file.seek(size // 2)
+            sample += file.read(SAMPLE_SIZE)
+    finally:
+        file.seek(position)
+
+    return entropy_of(sample) > INCOMPRESSIBLE_ENTROPY
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import pathlib
+import threading
+import time
+import urllib.parse
+
+import misc_tools as tools
+
+CONFIG_DIR = "BackupConfs"
+MTIME_CHECK_INTERVAL = 1.0
+"""Seconds a cached config is trusted before its mtime is checked again"""
+MISSING = -1
+
+
+def version_of(contents: str):
+    """
+    The config's version for conditional requests, a hash of its contents
+    so that two edits within the same second still differ
+    """
+    if contents == "":
+        return ""
+
+    return hashlib.sha256(contents.encode("utf-8")).hexdigest()[:32]
+
+
+class CachedConfig:
+    def __init__(self, contents: str, mtime_ns: int):
+        self.contents = contents
+        self.mtime_ns = mtime_ns
+        self.checked_at = time.monotonic()
+
+        self.version = version_of(contents)
+
+
+class ConfigStore:
+    """
+    Keeps every client's backup.json in memory, keyed by Username
+
+    Configs are reloaded from disk only when their file's mtime changes
+    and are written with a temporary file plus a rename so that a reader
+    never sees a half written config
+    """
+
+    def __init__(self, config_dir: pathlib.Path | str = CONFIG_DIR):
+        self.config_dir = pathlib.Path(config_dir)
+        self.config_dir.mkdir(parents=True, exist_ok=True)
+
+        self.cache: dict[str, CachedConfig] = {}
+        self.locks: dict[str, threading.RLock] = {}
+        self.locks_lock = threading.Lock()
+
+    def path_of(self, username: str):
+        # Usernames come from the network so they can't be trusted as file names
+        file_name = urllib.parse.quote(username, safe="")
+        if file_name == "" or file_name.startswith("."):
+            file_name = f"_{file_name}"
+
+        return self.config_dir / f"{file_name}.json"
+
+    def lock_of(self, username: str):
+        with self.locks_lock:
+            return self.locks.setdefault(username, threading.RLock())
+
+    def get(self, username: str) -> str:
+        return self.lookup(username).contents
+
+    def lookup(self, username: str) -> CachedConfig:
+        cached = self.cache.get(username)
+        if (
+            cached is not None
+            and time.monotonic() - cached.checked_at < MTIME_CHECK_INTERVAL
+        ):
+            return cached
+
+        with self.lock_of(username):
+            path = self.path_of(username)
+            try:
+                mtime_ns = path.stat().st_mtime_ns
+            except FileNotFoundError:
+                # Remember that there's nothing so polling doesn't hit the disk either
+                mtime_ns = MISSING
+
+            cached = self.cache.get(username)
+            if cached is None or cached.mtime_ns != mtime_ns:
+                contents = "" if mtime_ns == MISSING else path.read_text("utf-8")
+                cached = CachedConfig(contents, mtime_ns)
+                self.cache[username] = cached
+            else:
+                cached.checked_at = time.monotonic()
+
+            return cached
+
+    def put(self, username: str, contents: str):
+        """
+        Returns the new version. Raises ValueError before anything is written
+        if contents isn't a JSON object
+        """
+        if not isinstance(json.loads(contents), dict):
+            raise ValueError("A backup config has to be a JSON object")
+
+        with self.lock_of(username):
+            path = self.path_of(username)
+            tools.atomic_write(path, contents)
+            cached = CachedConfig(contents, path.stat().st_mtime_ns)
+            self.cache[username] = cached
+
+        return cached.version
+
+    def patch(self, username: str, base_version: str, patch: dict):
+        """
+        Applies a patch made by misc_tools.diff_backup_conf and returns the
+        new version. Returns None without changing anything if the stored
+        config is no longer the one the patch was made against, and raises
+        ValueError if patch isn't shaped like one
+        """
+        if not is_patch(patch):
+            raise ValueError("Not a backup config patch")
+
+        with self.lock_of(username):
+            cached = self.lookup(username)
+            if cached.version != base_version:
+                return None
+
+            backup_conf = json.loads(cached.contents) if cached.contents else {}
+            backup_conf = tools.apply_backup_conf_patch(backup_conf, patch)
+            return self.put(username, json.dumps(backup_conf))
+
+
+def is_patch(patch):
+    if not isinstance(patch, dict):
+        return False
+
+    for change in (patch.get("Added") or {}, patch.get("Removed") or {}):
+        if not isinstance(change, dict):
+            return False
+        for key, entries in change.items():
+            if not isinstance(entries, list) or not all(
+                isinstance(entry, str) for entry in entries
+            ):
+                return False
+
+    return True
@@ -1,9 +1,15 @@
+import collections
 import pathlib
+import queue
+import threading
 from tkinter import *
 from tkinter import ttk
 from typing import Literal
 
 import misc_tools as tools
+from FileScanner import FileScanner, ScanNode
+from PathTrie import PathTrie
+from ScanIndex import ScanIndex
 
 
 class DirectoryView:
@@ -34,13 +40,27 @@ class DirectoryView:
 
     INFO_COLUMNS = ("Name", "Size", "Selected")
 
+    ALL, SOME, NONE = range(3)
+    """How much of an item is selected, SOME shows as NOT_SELECTED"""
+    BATCH_SIZE = 500
+    """Items inserted per tick, enough to be quick without freezing the UI"""
+    TICK = 10
+
+    PLACEHOLDER = "placeholder:"
+    """
+	Prefix of the single child a folder has until it is opened, so that
+	Tk only ever holds the items that have been looked at
+	"""
+
     def __init__(self, parent):
         self.parent = parent
         self.last_selection = ()
         self.populating = False
         self.directories: list[str] = []
-        self.removed: set[str] = set()
-        self.deselected: set[str] = set()
+        self.removed = PathTrie()
+        self.scanner = FileScanner(ScanIndex())
+        """Base directories are scanned once and every size is looked up from that"""
+        self.deselected = PathTrie()
         """
 		UUID will be in self.deselected if:
 		- It is a deselected file 
@@ -50,6 +70,16 @@ class DirectoryView:
 		Where children of directories in self.deselected will not be
 		in self.deselected
 		"""
+        self.shown: dict[str, str] = {}
+        """The symbol last written to each row, so unchanged rows aren't set"""
+        self.scanned: queue.Queue[tuple[pathlib.Path, ScanNode | None]] = queue.Queue()
+        """Base directories the scanning threads are done with"""
+        self.scanning = 0
+        self.pending: collections.deque[pathlib.Path] = collections.deque()
+        """Children of opened folders waiting to be inserted"""
+        self.consuming = False
+        self.queued = 0
+        self.inserted = 0
 
         self.view = ttk.Frame(parent)
 
@@ -79,6 +109,11 @@ class DirectoryView:
         vert_scroll.grid(column=1, row=0, sticky="NSW", padx=(0, 10))
         hori_scroll.grid(column=0, row=1, sticky="NWE", pady=(0, 10))
 
+        # Only shown while items are being added
+        self.progress = ttk.Progressbar(self.view, mode="determinate")
+        self.progress.grid(column=0, row=2, sticky="WE", pady=(0, 10))
+        self.progress.grid_remove()
+
         self.view.rowconfigure(0, weight=1)
         self.view.columnconfigure(0, weight=1)
 
@@ -94,6 +129,9 @@ class DirectoryView:
         )
 
         self.dir_tree.bind("<<TreeviewSelect>>", func=self.update_last_selection)
+        self.dir_tree.bind(
+            "<<TreeviewOpen>>", func=lambda e: self.expand(self.dir_tree.focus())
+        )
 
     def edit_population_state(self):
         self.populating = not self.populating
@@ -123,7 +161,7 @@ class DirectoryView:
             return
 
         self.populating = True
-        self.view.after(1, self.__populate__, 0)
+        self.__scan__([pathlib.Path(directory) for directory in self.directories])
 
     def add_item(self, path: pathlib.Path, base: bool = False):
         uuid = path.as_posix()
@@ -136,21 +174,44 @@ class DirectoryView:
             except KeyError:
                 pass
 
-        if base and uuid not in self.directories:
-            self.directories.append(uuid)
+        if base:
+            if uuid not in self.directories:
+                self.directories.append(uuid)
+            # Scanned again to pick up anything that changed since it was
+            # last added, which can take a while so it's left to a thread
+            self.__scan__([path])
+            return
+
+        node = self.scanner.lookup(path)
+        if node is not None:
+            self.__insert__(path, node, base=False)
 
+    def __insert__(self, path: pathlib.Path, node: ScanNode, base: bool):
+        uuid = path.as_posix()
         text = str(path) if base else path.name
         parent = "" if base else path.parent.as_posix()
+        self.shown[uuid] = self.symbol_of(uuid)
         self.dir_tree.insert(
             parent,
             iid=uuid,
             index="end",
             text=text,
-            values=(self.update_size(path, unit="B"), self.SELECTED),
+            values=(self.update_size(path, unit="B"), self.shown[uuid]),
         )
 
-        if path.is_dir():
-            self.__add_children__(path)
+        # Children are only added once the folder is opened
+        if node.is_dir and node.count > 1:
+            self.dir_tree.insert(uuid, iid=self.PLACEHOLDER + uuid, index="end")
+
+    def expand(self, uuid: str):
+        placeholder = self.PLACEHOLDER + uuid
+        if not self.dir_tree.exists(placeholder):
+            # Rows under closed folders aren't kept up to date
+            self.__refresh__(uuid)
+            return
+
+        self.dir_tree.delete(placeholder)
+        self.__add_children__(pathlib.Path(uuid))
 
     def remove_item(self, uuid: str):
         if uuid == "":
@@ -158,108 +219,171 @@ class DirectoryView:
             return
 
         parent = self.dir_tree.parent(uuid)
+        for row in [uuid, *self.get_all_children(uuid)]:
+            self.shown.pop(row, None)
         self.dir_tree.delete(uuid)
         self.removed.add(uuid)
 
         if uuid in self.directories:
             self.directories.remove(uuid)
             self.removed.remove(uuid)
+            self.scanner.forget(pathlib.Path(uuid))
 
-        try:
-            self.deselected.remove(uuid)
-        except KeyError:
-            return
-
-        # Remove Children
-        self.deselected = set([i for i in self.deselected if uuid not in i])
-        self.removed = set([i for i in self.removed if uuid not in i])
+        # Nothing below a removed item needs remembering
+        self.remove_from_deselect(uuid)
+        self.deselected.clear_below(uuid)
+        self.removed.clear_below(uuid)
 
-        if self.get_all_children(parent) == []:
-            if parent == "":
-                self.directories = []
-                self.removed = set()
-                self.deselected = set()
-                return
-            self.deselected = set([i for i in self.deselected if parent not in i])
-            self.removed = set([i for i in self.removed if parent not in i])
+        if self.directories == []:
+            self.removed.clear()
+            self.deselected.clear()
+            return
 
-        self.__edit_parent_selection__(parent)
-        return
+        self.__refresh__(self.__collapse__(parent))
 
     # Wrapper for get_size but may be used for optimisations later
     def update_size(self, path: pathlib.Path, unit: Literal["iB", "B"]):
         return self.get_size(path, unit)
 
     def get_size(self, path: pathlib.Path, unit: Literal["B", "iB"]):
-        return tools.human_readable_file_size(tools.size_of(path), unit)
+        node = self.scanner.lookup(path)
+        size = node.size if node is not None else -1
+        return tools.human_readable_file_size(size, unit)
 
     def remove_from_deselect(self, uuid):
-        try:
-            self.deselected.remove(uuid)
-        except KeyError:
-            pass
+        self.deselected.discard(uuid)
 
     def select(self, uuid: str):
-        self.__edit_selection__(uuid, select=True)
-        self.remove_from_deselect(uuid)
+        if uuid == "":
+            self.deselected.clear()
+            self.__refresh__()
+        else:
+            self.__refresh__(self.__select__(uuid))
+
         self.view.event_generate("<<DeselectedUpdate>>")
 
     def deselect(self, uuid: str):
-        self.__edit_selection__(uuid, select=False)
-        self.deselected.add(uuid)
+        if uuid == "":
+            self.deselected = PathTrie(self.children_of(""))
+            self.__refresh__()
+        elif not self.deselected.covers(uuid):
+            # uuid covers everything deselected below it
+            self.deselected.clear_below(uuid)
+            self.deselected.add(uuid)
+            self.__refresh__(self.__collapse__(uuid))
+
         self.view.event_generate("<<DeselectedUpdate>>")
 
-    def __edit_selection__(self, uuid: str, select: bool):
-        new_symbol = self.SELECTED if select else self.NOT_SELECTED
-        self.dir_tree.set(uuid, column="Selected", value=new_symbol)
-        self.__edit_child_selection__(uuid, select)
+    def __select__(self, uuid: str):
+        """
+        Returns the highest item whose selection changed
+        """
+        self.deselected.clear_below(uuid)
+        above = self.deselected.covering(uuid)
+        if above is None:
+            return uuid
+
+        # A deselected folder above is split into the children that aren't
+        # on the way down to uuid
+        chain = [uuid]
+        while chain[-1] != above:
+            if chain[-1] == "":
+                # Above a base directory, which the tree doesn't show
+                return uuid
+            chain.append(self.parent_of(chain[-1]))
+
+        self.deselected.remove(above)
+        for folder, child in zip(chain[:0:-1], chain[-2::-1]):
+            for sibling in self.children_of(folder):
+                if sibling != child:
+                    self.deselected.add(sibling)
+
+        return above
+
+    def __collapse__(self, uuid: str):
+        """
+        Deselects the folders above uuid whose children are all deselected
+        and returns the highest item whose selection changed
+        """
+        folder = self.parent_of(uuid) if uuid in self.deselected else uuid
+        while folder != "":
+            children = self.children_of(folder)
+            if children == [] or any(c not in self.deselected for c in children):
+                break
 
-        parent_id = self.dir_tree.parent(uuid)
-        self.view.after(10, self.__edit_parent_selection__, parent_id)
+            for child in children:
+                self.deselected.discard(child)
+            self.deselected.add(folder)
+            uuid, folder = folder, self.parent_of(folder)
 
-    def __edit_parent_selection__(self, uuid: str):
-        original_selection = self.get_current_selection(uuid)
-        children = self.dir_tree.get_children(uuid)
-        all_selected = all(
-            map(lambda c: self.get_current_selection(c) == self.SELECTED, children)
-        )
+        return uuid
 
-        new_selection = self.SELECTED if all_selected else self.NOT_SELECTED
-        self.dir_tree.set(uuid, column="Selected", value=new_selection)
+    def parent_of(self, uuid: str):
+        return "" if uuid in self.directories else pathlib.Path(uuid).parent.as_posix()
 
-        if original_selection == new_selection or uuid == "":
-            self.view.after(10, self.__compute_deselected__, "")
-        else:
-            self.view.after(
-                10,
-                self.__edit_parent_selection__,
-                self.dir_tree.parent(uuid),
-            )
+    def children_of(self, uuid: str):
+        """
+        Returns the children of uuid from the scan whether or not they have
+        been added to the tree, leaving out removed ones
+        """
+        if uuid == "":
+            return [d for d in self.directories if d not in self.removed]
 
-        return
+        path = pathlib.Path(uuid)
+        node = self.scanner.lookup(path)
+        children = node.children if node is not None else None
+        uuids = [(path / name).as_posix() for name in children or {}]
 
-    def __compute_deselected__(self, root: str):
-        children: list = list(self.get_all_children(root))
+        return [c for c in uuids if c not in self.removed]
 
-        if self.get_current_selection(root) == self.SELECTED:
-            self.remove_from_deselect(root)
-            self.deselected = self.deselected.difference(children)
-            return
+    def symbol_of(self, uuid: str):
+        """
+        Works out the symbol from self.deselected so items added after
+        a selection change still get the right one
+        """
+        return self.SELECTED if self.state_of(uuid) == self.ALL else self.NOT_SELECTED
 
-        all_deselected = all(
-            map(lambda c: self.get_current_selection(c) == self.NOT_SELECTED, children)
-        )
+    def state_of(self, uuid: str):
+        # The trie counts what is deselected below every folder so this
+        # only walks uuid's parts
+        if self.deselected.covers(uuid):
+            return self.NONE
+        if self.deselected.has_below(uuid):
+            return self.SOME
+
+        return self.ALL
 
-        if all_deselected:
-            self.deselected.add(root)
-            self.deselected = self.deselected.difference(children)
-        elif not all_deselected:
-            self.remove_from_deselect(root)
-            # Compute deselected of children
-            for child in self.dir_tree.get_children(root):
-                self.view.after(10, self.__compute_deselected__, child)
+    def __refresh__(self, top: str = ""):
+        """
+        Brings the rows at and above top, and the visible rows below it,
+        up to date with self.deselected. Rows under closed folders are
+        updated when they are opened
+        """
+        if not self.dir_tree.exists(top):
+            top = ""
+
+        ancestor = top
+        while ancestor != "":
+            self.__mirror__(ancestor)
+            ancestor = self.dir_tree.parent(ancestor)
+
+        stack = [top]
+        while stack != []:
+            for child in self.dir_tree.get_children(stack.pop()):
+                if child.startswith(self.PLACEHOLDER):
+                    continue
+                self.__mirror__(child)
+                if self.dir_tree.tk.getboolean(self.dir_tree.item(child, "open")):
+                    stack.append(child)
+
+    def __mirror__(self, uuid: str):
+        if not self.dir_tree.exists(uuid):
+            return
 
-        return
+        symbol = self.symbol_of(uuid)
+        if self.shown.get(uuid) != symbol:
+            self.dir_tree.set(uuid, column="Selected", value=symbol)
+            self.shown[uuid] = symbol
 
     def get_all_children(self, root: str):
         children: list = list(self.dir_tree.get_children(root))
@@ -269,62 +393,86 @@ class DirectoryView:
 
         return children
 
-    def __edit_child_selection__(self, uuid: str, select: bool):
-        new_symbol = self.SELECTED if select else self.NOT_SELECTED
-        children = self.get_all_children(uuid)
-
-        # Converted to list so that map is evaluated as map uses lazy evaluation
-        list(
-            map(
-                lambda c: self.dir_tree.set(c, column="Selected", value=new_symbol),
-                children,
-            )
-        )
-
-        return
-
     def get_current_selection(self, uuid: str):
-        return self.dir_tree.set(uuid, column="Selected")
-
-    def __populate__(self, index):
-        try:
-            directory = self.directories[index]
-        except IndexError:
-            self.view.after(10, self.__populate_end_checker__)
-            return
-
-        path = pathlib.Path(directory)
-
-        if not path.exists():
-            self.directories.remove(directory)
-            self.view.after(10, self.__populate__, index)
+        return self.symbol_of(uuid)
+
+    def __scan__(self, paths: list[pathlib.Path]):
+        self.scanning += len(paths)
+        self.__queue__(len(paths))
+        threading.Thread(target=self.__produce__, args=(paths,), daemon=True).start()
+
+    def __produce__(self, paths: list[pathlib.Path]):
+        for path in paths:
+            self.scanned.put((path, self.scanner.read(path)))
+
+    def __queue__(self, count: int):
+        self.queued += count
+        self.progress.configure(maximum=self.queued, value=self.inserted)
+        if not self.consuming:
+            self.consuming = True
+            self.progress.grid()
+            self.view.after(self.TICK, self.__consume__)
+
+    def __consume__(self):
+        budget = self.BATCH_SIZE
+        while budget > 0 and self.scanning > 0:
+            try:
+                path, node = self.scanned.get_nowait()
+            except queue.Empty:
+                break
+
+            self.scanning -= 1
+            self.inserted += 1
+            budget -= 1
+            uuid = path.as_posix()
+            if uuid not in self.directories or self.dir_tree.exists(uuid):
+                # Removed or added twice while it was being scanned
+                continue
+            if node is None:
+                self.directories.remove(uuid)
+                continue
+
+            self.scanner.keep(path, node)
+            # Only the base node is added, its children wait until it is opened
+            self.__insert__(path, node, base=True)
+
+        while budget > 0 and len(self.pending) > 0:
+            path = self.pending.popleft()
+            self.inserted += 1
+            budget -= 1
+            if self.dir_tree.exists(path.parent.as_posix()):
+                self.add_item(path)
+
+        self.progress.configure(value=self.inserted)
+        if self.scanning == 0 and len(self.pending) == 0:
+            self.__finish__()
             return
 
-        # Add base node with children if directory
-        self.add_item(path, base=True)
-
-        self.view.after(10, self.__populate__, index + 1)
+        self.view.after(self.TICK, self.__consume__)
 
-    def __populate_end_checker__(self):
-        total_files = 0
-
-        for dir in self.directories:
-            total_files += tools.how_many_files_in(pathlib.Path(dir))
-
-        for dir in self.removed:
-            total_files -= tools.how_many_files_in(pathlib.Path(dir))
-
-        if total_files == len(self.get_all_children("")):
-            self.populating = False
-            for f in self.deselected:
-                self.view.after(10, self.deselect, f)
-            return
+    def __finish__(self):
+        self.consuming = False
+        self.populating = False
+        self.queued = 0
+        self.inserted = 0
+        self.progress.grid_remove()
+        self.__refresh__()
+        self.view.event_generate("<<PopulateDone>>")
 
-        self.view.after(10, self.__populate_end_checker__)
+    def count_of(self, path: pathlib.Path):
+        # Counts a missing path as 1 like misc_tools.how_many_files_in
+        node = self.scanner.lookup(path)
+        return node.count if node is not None else 1
 
     def __add_children__(self, path: pathlib.Path):
-        children = path.glob("./*")
+        node = self.scanner.lookup(path)
+        children = node.children if node is not None else None
 
-        for child in children:
-            self.view.after(10, self.add_item, child)
-        return
+        added = 0
+        for name in children or {}:
+            child = path / name
+            if child.as_posix() not in self.removed:
+                self.pending.append(child)
+                added += 1
+
+        self.__queue__(added)
@@ -0,0 +1,179 @@
+"""
+Scans a folder once with os.scandir and keeps the result as a tree
+
+Every folder in the tree knows its total size and how many files and
+folders it holds, so asking for them costs nothing after the scan.
+FileScanner keeps the trees it has scanned so that anything inside one of
+them is looked up instead of being walked again
+"""
+
+import os
+import pathlib
+import stat
+import threading
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from ScanIndex import ScanIndex
+
+
+class ScanNode:
+    __slots__ = ("name", "is_dir", "size", "count", "_children", "loader")
+
+    def __init__(self, name: str, is_dir: bool, size: int = 0):
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        """Bytes in the file or every file below the folder"""
+        self.count = 1
+        """Files and folders including itself, like misc_tools.how_many_files_in"""
+        self._children: dict[str, ScanNode] | None = {} if is_dir else None
+        self.loader: Callable[[ScanNode], None] | None = None
+        """Fills in the rest of the children the first time they're needed"""
+
+    @property
+    def children(self):
+        if self.loader is not None:
+            loader, self.loader = self.loader, None
+            loader(self)
+
+        return self._children
+
+    def find(self, parts: tuple[str, ...]):
+        node = self
+        for part in parts:
+            if node.children is None or part not in node.children:
+                return None
+            node = node.children[part]
+
+        return node
+
+    def descendants(self, path: pathlib.Path):
+        """
+        Yields the path of everything below this node, parents first
+        """
+        stack = [(self, path)]
+        while stack != []:
+            node, node_path = stack.pop()
+            for child in (node.children or {}).values():
+                child_path = node_path / child.name
+                yield child_path
+                if child.is_dir:
+                    stack.append((child, child_path))
+
+
+def scan(path: pathlib.Path) -> ScanNode | None:
+    """
+    Returns the tree under path or None if path doesn't exist
+    Folders that can't be read are counted as empty
+    """
+    try:
+        path_stat = path.stat()
+    except OSError:
+        return None
+
+    root = ScanNode(path.name or str(path), stat.S_ISDIR(path_stat.st_mode))
+    if not root.is_dir:
+        root.size = path_stat.st_size
+        return root
+
+    # Folders in the order they were scanned so parents come before children
+    scanned: list[ScanNode] = []
+    stack = [(root, str(path))]
+    while stack != []:
+        node, dir_path = stack.pop()
+        scanned.append(node)
+        children = node.children
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    # Symlinked folders aren't followed so loops can't happen
+                    if entry.is_dir(follow_symlinks=False):
+                        child = ScanNode(entry.name, True)
+                        stack.append((child, entry.path))
+                    else:
+                        child = ScanNode(entry.name, False)
+                        try:
+                            if entry.is_file():
+                                child.size = entry.stat().st_size
+                        except OSError:
+                            # Broken symlink or deleted since it was listed
+                            pass
+                    children[entry.name] = child
+        except OSError:
+            continue
+
+    add_up(scanned)
+    return root
+
+
+def add_up(scanned: list[ScanNode]):
+    """
+    Works out the size and count of every folder in scanned
+    Parents have to come before their children
+    """
+    # Children before parents so each folder only adds up its own children
+    for node in reversed(scanned):
+        for child in node.children.values():
+            node.size += child.size
+            node.count += child.count
+
+
+class FileScanner:
+    def __init__(self, index: "ScanIndex | None" = None):
+        self.roots: dict[pathlib.Path, ScanNode] = {}
+        # Backups look up sizes off the UI thread, the trees never change
+        # once scanned so only the roots need the lock
+        self.lock = threading.Lock()
+        self.index = index
+        """Makes scans only list the folders that changed since the last run"""
+
+    def scan(self, path: pathlib.Path):
+        """
+        Scans path again even if it was already scanned
+        """
+        return self.keep(path, self.read(path))
+
+    def read(self, path: pathlib.Path):
+        """
+        Scans path without keeping the result, so it can run on another thread
+        """
+        return self.index.scan(path) if self.index is not None else scan(path)
+
+    def keep(self, path: pathlib.Path, node: ScanNode | None):
+        """
+        Keeps a tree from read() for lookups, replacing any under path
+        """
+        with self.lock:
+            if node is None:
+                self.roots.pop(path, None)
+                return None
+
+            # A new root swallows the roots inside it
+            for root in list(self.roots):
+                if root.is_relative_to(path):
+                    del self.roots[root]
+            self.roots[path] = node
+
+        return node
+
+    def lookup(self, path: pathlib.Path):
+        """
+        Returns path's node from an earlier scan or scans it if there isn't one
+        """
+        # Comparing parts is much quicker than is_relative_to and relative_to
+        parts = path.parts
+        with self.lock:
+            roots = list(self.roots.items())
+        for root, root_node in roots:
+            root_length = len(root.parts)
+            if parts[:root_length] == root.parts:
+                node = root_node.find(parts[root_length:])
+                if node is not None:
+                    return node
+
+        return self.scan(path)
+
+    def forget(self, path: pathlib.Path):
+        with self.lock:
+            self.roots.pop(path, None)
@@ -0,0 +1,259 @@
+"""
+Backs up what backup.json selects without a window
+
+Runs the same backups as BackupWindow and prints progress every few
+seconds instead of showing it, so it works on servers without a display and
+from cron. Nothing here imports Tk
+"""
+
+import concurrent.futures
+import json
+import platform
+import queue
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from typing import TextIO
+
+import misc_tools as tools
+import settings
+from BackupSession import BackupSession
+from BackupSocket import RecievingError, SendingError
+from BandwidthScheduler import BandwidthScheduler
+from FileScanner import FileScanner
+from NativeTransfer import NativeBackupClient, TransferError, TransferStats
+from RsyncBackup import (
+    BackupError,
+    RsyncBackup,
+    RsyncProgress,
+    signal_running,
+    start_rsyncs,
+)
+from ScanIndex import ScanIndex
+
+PRINT_INTERVAL = 5
+"""Seconds between progress lines"""
+
+
+class HeadlessBackup:
+    def __init__(self, output: TextIO = sys.stdout):
+        self.output = output
+        self.timeout = settings.settings["TimeoutLength"]
+        self.scheduler = BandwidthScheduler.from_settings(settings.settings)
+        self.last_print = 0.0
+
+    def run(self, backup_all: bool = False):
+        """Returns 0 if everything was backed up, like an exit code"""
+        if settings.host_lookup is not None:
+            # There's nothing to do until the server's address is known
+            concurrent.futures.wait([settings.host_lookup], self.timeout)
+        host = settings.settings["Host"]
+        if host in (None, "no hostname", "socket.gaierror"):
+            print(f"Can't back up, the server's address is {host}", file=sys.stderr)
+            return 1
+        if settings.settings["Username"] == "no username":
+            print("Can't back up, there's no username in settings", file=sys.stderr)
+            return 1
+
+        self.session = BackupSession(
+            (host, settings.settings["Port"]),
+            username=settings.settings["Username"],
+            timeout=self.timeout,
+        )
+        try:
+            include_dirs, exclude_dirs = self.load_backup_conf(backup_all)
+            if include_dirs == []:
+                print("Nothing to back up", file=self.output)
+                return 0
+
+            if settings.settings["TransferMode"] == "native":
+                return self.__native_backup__(include_dirs, exclude_dirs)
+            return self.__rsync_backup__(include_dirs, exclude_dirs)
+        except (
+            OSError,
+            TransferError,
+            BackupError,
+            SendingError,
+            RecievingError,
+            ValueError,
+        ) as e:
+            print(f"Could not back up files to {host}: {e}", file=sys.stderr)
+            return 1
+        finally:
+            self.session.close()
+
+    def load_backup_conf(self, backup_all: bool):
+        """Returns the folders to back up and the ones to leave out"""
+        response = self.session.request("RequestBackupConf", IfNoneMatch="")
+        response = response.result(self.timeout)
+        remote_backup_conf = {}
+        if response["body"] != "":
+            remote_backup_conf = json.loads(response["body"])
+        backup_conf = settings.newest_backup_conf(
+            settings.read_backup_conf(), remote_backup_conf
+        )
+
+        include_dirs: list[str] = backup_conf.get("BackupDirectories") or []
+        exclude_dirs: list[str] = []
+        if not backup_all:
+            exclude_dirs.extend(backup_conf.get("DeselectedDirectories") or [])
+            exclude_dirs.extend(backup_conf.get("RemovedDirectories") or [])
+
+        return include_dirs, exclude_dirs
+
+    def __native_backup__(self, include_dirs: list[str], exclude_dirs: list[str]):
+        client = NativeBackupClient(
+            (settings.settings["Host"], settings.settings["Port"]),
+            username=settings.settings["Username"],
+            timeout=self.timeout,
+            bucket=self.scheduler.bucket(),
+        )
+        try:
+            stats = client.backup(
+                include_dirs, exclude_dirs, progress=self.__native_progress__
+            )
+        finally:
+            client.close()
+
+        print(f"Backed up to {settings.settings["Host"]}", file=self.output)
+        print(stats.summary(), file=self.output)
+        return 0
+
+    def __native_progress__(self, remote_path: str, stats: TransferStats):
+        now = time.monotonic()
+        if now - self.last_print < PRINT_INTERVAL:
+            return
+
+        self.last_print = now
+        sent = tools.human_readable_file_size(stats.bytes_sent)
+        print(
+            f"{stats.files_sent} of {stats.files_checked} files sent ({sent}), "
+            f"at {remote_path}",
+            file=self.output,
+            flush=True,
+        )
+
+    def __rsync_backup__(self, include_dirs: list[str], exclude_dirs: list[str]):
+        rsync_path = shutil.which("rsync")
+        if rsync_path is None:
+            print("Can't back up, rsync isn't installed", file=sys.stderr)
+            return 1
+
+        backup = RsyncBackup(
+            self.session,
+            rsync_path,
+            include_dirs,
+            exclude_dirs,
+            FileScanner(ScanIndex()).lookup,
+        )
+        completed = False
+        returncode = None
+        try:
+            backup.snapshot_begun(backup.begin().result(self.timeout))
+            plan = backup.prepare()
+            if plan is not None:
+                print(
+                    f"{plan.files} files to back up "
+                    f"({tools.human_readable_file_size(plan.bytes)})",
+                    file=self.output,
+                    flush=True,
+                )
+
+            returncode = self.__transfer__(
+                backup.rsync_commands,
+                plan.files if plan is not None else None,
+                plan.bytes if plan is not None else None,
+            )
+            completed = returncode == 0
+        finally:
+            # Only a snapshot the server began has to be ended
+            if backup.snapshot != "":
+                backup.end(completed).result(self.timeout)
+
+        if not completed:
+            print(f"rsync exited with {returncode}", file=sys.stderr)
+            return 1
+
+        print(f"Backed up to {settings.settings["Host"]}", file=self.output)
+        return 0
+
+    def __transfer__(
+        self,
+        rsync_commands: list[list[str]],
+        total_to_backup: int | None,
+        bytes_to_backup: int | None,
+    ):
+        """
+        Runs every rsync at once and prints their combined progress,
+        returning the first failing exit code or 0
+        """
+        records: queue.Queue[tuple] = queue.Queue()
+        processes = start_rsyncs(rsync_commands, records)
+        progress = RsyncProgress(len(processes))
+        while not progress.finished:
+            try:
+                progress.add(records.get(timeout=PRINT_INTERVAL))
+            except queue.Empty:
+                pass
+
+            measured = progress.measure(PRINT_INTERVAL)
+            if measured is None:
+                continue
+
+            speed, sent_speed, seconds = measured
+            self.__print_progress__(
+                progress.files_done,
+                total_to_backup,
+                progress.bytes_done,
+                bytes_to_backup,
+                speed,
+            )
+            self.__throttle__(processes, sent_speed, seconds)
+            # Neither printing nor a pause counts against the next measurement
+            progress.restart_measure()
+
+        for process in processes:
+            if process.wait() != 0:
+                return process.returncode
+
+        return 0
+
+    def __print_progress__(
+        self,
+        files_done: int,
+        total_to_backup: int | None,
+        bytes_done: int,
+        bytes_to_backup: int | None,
+        speed: float,
+    ):
+        files = f"{files_done}"
+        done = tools.human_readable_file_size(bytes_done)
+        if total_to_backup is not None and bytes_to_backup is not None:
+            files += f" / {total_to_backup}"
+            done += f" / {tools.human_readable_file_size(bytes_to_backup)}"
+
+        print(
+            f"{files} files, {done} ({tools.human_readable_file_size(int(speed))}/s)",
+            file=self.output,
+            flush=True,
+        )
+
+    def __throttle__(
+        self,
+        processes: list[subprocess.Popen],
+        sent_speed: float,
+        seconds: float,
+    ):
+        # Like RsyncTracker, for caps that start after rsync got its --bwlimit
+        if platform.system() == "Windows":
+            return
+
+        pause = self.scheduler.pause_for(sent_speed, seconds)
+        if pause <= 0:
+            return
+
+        signal_running(processes, signal.SIGSTOP)
+        time.sleep(pause)
+        signal_running(processes, signal.SIGCONT)
@@ -0,0 +1,77 @@
+"""
+Looks up the server's hostname without holding up startup
+
+Addresses are kept in host_cache.json between runs. A cached address is used
+straight away while a new lookup runs on a thread, and one that's younger
+than CACHE_TTL isn't looked up again at all. When a lookup fails the cached
+address is kept however old it is, since servers rarely move
+"""
+
+import concurrent.futures
+import json
+import pathlib
+import socket
+import threading
+import time
+
+import misc_tools as tools
+
+HOST_CACHE = "host_cache.json"
+CACHE_TTL = 60 * 60
+"""Seconds an address is trusted, getaddrinfo doesn't say how long DNS would"""
+
+
+class HostResolver:
+    def __init__(self, path: pathlib.Path | str = HOST_CACHE):
+        self.path = pathlib.Path(path)
+        self.lock = threading.Lock()
+        self.cache: dict[str, dict] = {}
+        """Hostname to its Address and when it was Resolved"""
+        try:
+            self.cache = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            pass
+
+    def cached(self, hostname: str) -> str | None:
+        with self.lock:
+            entry = self.cache.get(hostname) or {}
+        return entry.get("Address")
+
+    def is_fresh(self, hostname: str):
+        with self.lock:
+            entry = self.cache.get(hostname) or {}
+        return time.time() - entry.get("Resolved", 0) < CACHE_TTL
+
+    def resolve(self, hostname: str):
+        """Looks hostname up, blocking, and remembers the address"""
+        address = socket.gethostbyname(hostname)
+        with self.lock:
+            self.cache[hostname] = {"Address": address, "Resolved": time.time()}
+            contents = json.dumps(self.cache)
+        try:
+            tools.atomic_write(self.path, contents)
+        except OSError:
+            # Only costs a lookup next time
+            pass
+
+        return address
+
+    def lookup(self, hostname: str):
+        """
+        Returns a Future for hostname's address, which is already done if
+        the cached address is fresh
+        """
+        future: concurrent.futures.Future[str] = concurrent.futures.Future()
+        address = self.cached(hostname)
+        if address is not None and self.is_fresh(hostname):
+            future.set_result(address)
+            return future
+
+        def run():
+            try:
+                future.set_result(self.resolve(hostname))
+            except OSError as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name="HostResolver", daemon=True).start()
+        return future
@@ -0,0 +1,589 @@
+"""
+Backing up without rsync, over a BackupSocket to backup_server.py
+
+Files are split into content defined chunks, so an edit in the middle of a
+file only changes the chunks around the edit (see find_cut). Only the chunks
+that the server's ChunkStore lacks are sent, straight from disk with sendfile.
+A file's chunks are offered a batch at a time as they're cut, so the server
+is never left waiting on a whole big file being read
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import pathlib
+import platform
+import random
+import time
+from typing import BinaryIO, Callable, Iterator, override
+
+import misc_tools as tools
+from BandwidthScheduler import TokenBucket
+from BackupSocket import (
+    MESSAGE_DATA,
+    MESSAGE_RESPONSE,
+    BackupSocket,
+    RecievingError,
+    Request,
+    make_request,
+)
+from ChangeJournal import changed_files, removed_paths
+from ChunkStore import ChunkStore
+from Compression import CODECS, looks_incompressible
+from SnapshotStore import SnapshotStore, link_unchanged
+
+MIN_CHUNK_SIZE = 16 * 1024
+AVG_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+READ_SIZE = 4 * 1024 * 1024
+"""Bytes read from disk at once when chunking"""
+STATUS_BATCH = 512
+"""Files whose status is asked for in one FileStatus request"""
+PATCH_BATCH = 256
+"""
+Chunks offered per round trip, at most 64 MiB of the file so each batch is
+cut and sent well within the server's connection timeout
+"""
+
+ANCHOR_RANDOM = random.Random(0x616E_6368)
+"""Seeded so that the client and server cut files in the same places"""
+ANCHOR_TABLE = bytes(ANCHOR_RANDOM.getrandbits(1) for _ in range(256))
+"""Turns every byte into a 0 or 1 with bytes.translate"""
+AVG_BITS = AVG_CHUNK_SIZE.bit_length() - 1
+HARD_ANCHOR = bytes(ANCHOR_RANDOM.getrandbits(1) for _ in range(AVG_BITS + 1))
+"""Searched for before AVG_CHUNK_SIZE. Being longer it's less likely to be found"""
+EASY_ANCHOR = HARD_ANCHOR[: AVG_BITS - 1]
+"""Searched for after AVG_CHUNK_SIZE so chunks end up close to the average size"""
+
+
+class TransferError(Exception):
+    """
+    Raised when the server refuses or fails part of a native backup
+    """
+
+    def __init__(self, message=""):
+        if message == "":
+            message = "TRANSFER FAILED"
+        self.message = message
+        super().__init__(message)
+
+    @override
+    def __str__(self):
+        return self.message
+
+
+class TransferStats:
+    def __init__(self):
+        self.files_checked = 0
+        self.files_sent = 0
+        self.bytes_changed = 0
+        """Size of every file that had to be sent"""
+        self.bytes_sent = 0
+        """File data that actually went over the network"""
+        self.started = time.perf_counter()
+        self.finished = self.started
+
+    def elapsed(self):
+        return max(self.finished - self.started, 1e-9)
+
+    def summary(self):
+        sent = tools.human_readable_file_size(self.bytes_sent)
+        changed = tools.human_readable_file_size(self.bytes_changed)
+        speed = tools.human_readable_file_size(int(self.bytes_changed / self.elapsed()))
+
+        return (
+            f"{self.files_sent} of {self.files_checked} files changed ({changed}), "
+            f"sent {sent} in {self.elapsed():.1f}s ({speed}/s)"
+        )
+
+
+def find_cut(anchor_bits: bytes, start: int, end: int):
+    """
+    Returns where the chunk starting at start ends
+
+    anchor_bits is the file's data put through ANCHOR_TABLE. A chunk ends
+    right after the anchor pattern, which depends only on the bytes just
+    before it, so inserting data only moves the cuts near the insertion.
+    Searching with bytes.find keeps the scanning out of Python loops
+
+    anchor_bits[start:end] must hold at least MAX_CHUNK_SIZE bytes unless
+    it's the end of the file
+    """
+    length = end - start
+    if length <= MIN_CHUNK_SIZE:
+        return end
+
+    normal = start + min(length, AVG_CHUNK_SIZE)
+    limit = start + min(length, MAX_CHUNK_SIZE)
+
+    # Anchors may start before MIN_CHUNK_SIZE as long as they end after it
+    search_from = start + MIN_CHUNK_SIZE - len(HARD_ANCHOR)
+    found = anchor_bits.find(HARD_ANCHOR, search_from, normal)
+    if found != -1:
+        return found + len(HARD_ANCHOR)
+
+    search_from = normal - len(EASY_ANCHOR)
+    found = anchor_bits.find(EASY_ANCHOR, search_from, limit)
+    if found != -1:
+        return found + len(EASY_ANCHOR)
+
+    return limit
+
+
+def iter_chunks(file: BinaryIO) -> Iterator[tuple[int, int, bytes]]:
+    """
+    Yields the offset, length and SHA-256 digest of every chunk in file
+    """
+    buffer = bytearray()
+    anchor_bits = b""
+    buffer_offset = 0
+    position = 0
+    end_of_file = False
+
+    while True:
+        if not end_of_file and len(buffer) - position < MAX_CHUNK_SIZE:
+            del buffer[:position]
+            buffer_offset += position
+            position = 0
+
+            data = file.read(READ_SIZE)
+            if data == b"":
+                end_of_file = True
+            buffer += data
+            anchor_bits = buffer.translate(ANCHOR_TABLE)
+            continue
+
+        if position == len(buffer):
+            return
+
+        cut = find_cut(anchor_bits, position, len(buffer))
+        with memoryview(buffer) as view:
+            digest = hashlib.sha256(view[position:cut]).digest()
+
+        yield buffer_offset + position, cut - position, digest
+        position = cut
+
+
+def remote_path_of(path: pathlib.Path):
+    # Same layout as rsync's so both kinds of backup land in the same place
+    if platform.system() == "Windows":
+        return tools.win_to_rsync_readable_posix(path)
+
+    return path.as_posix()
+
+
+def selection_of(include_dirs: list[str], exclude_dirs: list[str]):
+    """
+    Identifies what a backup includes and excludes, whatever the order
+    """
+    selection = json.dumps([sorted(include_dirs), sorted(exclude_dirs)])
+    return hashlib.sha256(selection.encode()).hexdigest()
+
+
+class NativeBackupClient:
+    def __init__(
+        self,
+        address: tuple[str, int],
+        username: str,
+        timeout: float | None = None,
+        compression: bool = True,
+        bucket: TokenBucket | None = None,
+    ):
+        self.username = username
+        self.bucket = bucket
+        """Holds the sender to the bandwidth cap, if there is one"""
+        self.host = address[0]
+        self.snapshot = ""
+        self.previous = ""
+        self.client = BackupSocket()
+        self.client.settimeout(timeout)
+        self.client.connect(address)
+
+        if compression:
+            response = self.request("NegotiateCompression", Codecs=list(CODECS))
+            self.client.use_codec(response["metadata"]["Codec"])
+
+    def close(self):
+        self.client.close()
+
+    def request(self, command: str, body: str = "", **metadata) -> Request:
+        request = make_request(
+            body, sender=self.username, reciever=self.host, Command=command, **metadata
+        )
+        self.client.send_prefix(request)
+        return self.expect_ok()
+
+    def expect_ok(self) -> Request:
+        response = self.client.recieve_prefix()
+        status = response["metadata"].get("Status")
+        if status != "OK":
+            raise TransferError(f"Server replied {status} {response["body"]}".strip())
+
+        return response
+
+    def backup(
+        self,
+        include_dirs: list[str],
+        exclude_dirs: list[str],
+        progress: Callable[[str, TransferStats], None] | None = None,
+        changes: tuple[set[str], set[str]] | None = None,
+    ):
+        """
+        changes are the paths that changed and were removed since the last
+        backup, from a ChangeJournal. Without them every file is checked
+        """
+        stats = TransferStats()
+        excluded = set(exclude_dirs)
+
+        # A cloned snapshot already has everything from the previous one, if
+        # that was a backup of the same folders
+        response = self.request(
+            "BeginSnapshot",
+            Kind="native",
+            Clone=changes is not None,
+            Selection=selection_of(include_dirs, exclude_dirs),
+        )
+        self.snapshot = response["metadata"]["Snapshot"]
+        self.previous = response["metadata"]["Previous"]
+        if not response["metadata"].get("Cloned"):
+            changes = None
+
+        completed = False
+        try:
+            if changes is None:
+                files = self.__walk__(include_dirs, excluded)
+            else:
+                files = self.__journaled__(changes, include_dirs, exclude_dirs)
+
+            batch: list[tuple[pathlib.Path, str, os.stat_result]] = []
+            for path, file_stat in files:
+                batch.append((path, remote_path_of(path), file_stat))
+                if len(batch) == STATUS_BATCH:
+                    self.__send_batch__(batch, stats, progress)
+                    batch = []
+
+            self.__send_batch__(batch, stats, progress)
+            completed = True
+        finally:
+            # An unfinished snapshot is kept but never used as a previous one
+            self.request(
+                "EndSnapshot",
+                Kind="native",
+                Snapshot=self.snapshot,
+                Completed=completed,
+            )
+
+        stats.finished = time.perf_counter()
+        return stats
+
+    def __journaled__(
+        self,
+        changes: tuple[set[str], set[str]],
+        include_dirs: list[str],
+        exclude_dirs: list[str],
+    ):
+        changed, removed = changes
+        removed_list = removed_paths(removed, include_dirs, exclude_dirs)
+        if removed_list != []:
+            self.request(
+                "RemovePaths",
+                json.dumps([remote_path_of(pathlib.Path(p)) for p in removed_list]),
+                Kind="native",
+                Snapshot=self.snapshot,
+            )
+
+        for path in changed_files(changed, include_dirs, exclude_dirs):
+            try:
+                yield pathlib.Path(path), os.stat(path)
+            except OSError:
+                # Removed again since it was checked
+                continue
+
+    def __walk__(self, include_dirs: list[str], excluded: set[str]):
+        for include_dir in include_dirs:
+            root = pathlib.Path(include_dir)
+            if root.as_posix() in excluded:
+                continue
+
+            if root.is_file():
+                yield root, root.stat()
+                continue
+
+            for dir_path, dir_names, file_names in os.walk(root):
+                dir_path = pathlib.Path(dir_path)
+                # Pruning here stops os.walk from going into excluded folders
+                dir_names[:] = [
+                    name
+                    for name in dir_names
+                    if (dir_path / name).as_posix() not in excluded
+                ]
+
+                for name in file_names:
+                    path = dir_path / name
+                    if path.as_posix() in excluded:
+                        continue
+                    try:
+                        yield path, path.stat()
+                    except OSError:
+                        # Deleted or unreadable since it was listed
+                        continue
+
+    def __send_batch__(
+        self,
+        batch: list[tuple[pathlib.Path, str, os.stat_result]],
+        stats: TransferStats,
+        progress: Callable[[str, TransferStats], None] | None,
+    ):
+        if batch == []:
+            return
+
+        file_list = [
+            [remote_path, file_stat.st_size, file_stat.st_mtime_ns]
+            for _, remote_path, file_stat in batch
+        ]
+        response = self.request(
+            "FileStatus",
+            json.dumps(file_list),
+            Snapshot=self.snapshot,
+            Previous=self.previous,
+        )
+        changed: dict[str, str] = json.loads(response["body"])
+        stats.files_checked += len(batch)
+
+        for path, remote_path, file_stat in batch:
+            if remote_path not in changed:
+                continue
+
+            # Even new files are sent as chunks since the server might
+            # already have some of them from other files or clients
+            self.patch_file(path, remote_path, file_stat, stats)
+
+            stats.files_sent += 1
+            stats.bytes_changed += file_stat.st_size
+            if progress is not None:
+                progress(remote_path, stats)
+
+    def patch_file(
+        self,
+        path: pathlib.Path,
+        remote_path: str,
+        file_stat: os.stat_result,
+        stats: TransferStats,
+    ):
+        # Sending moves the file's position, so chunks are cut from a second
+        # handle that only ever reads forward
+        with open(path, mode="rb") as chunked, open(path, mode="rb") as file:
+            # Chunks that won't compress skip Python entirely through sendfile
+            compress = self.client.compression is not None
+            compress = compress and not looks_incompressible(path, file)
+            chunks = iter_chunks(chunked)
+            command = "PatchFile"
+            while True:
+                batch = list(itertools.islice(chunks, PATCH_BATCH))
+                last = len(batch) < PATCH_BATCH
+                chunk_list = [[digest.hex(), length] for _, length, digest in batch]
+                response = self.request(
+                    command,
+                    json.dumps(chunk_list),
+                    Path=remote_path,
+                    Size=file_stat.st_size,
+                    MTime=file_stat.st_mtime_ns,
+                    Snapshot=self.snapshot,
+                    Last=last,
+                )
+                for index in json.loads(response["body"]):
+                    offset, length, _ = batch[index]
+                    self.__send_chunk__(file, offset, length, compress, stats)
+
+                if last:
+                    break
+                command = "PatchChunks"
+
+        self.expect_ok()
+
+    def __send_chunk__(
+        self,
+        file: BinaryIO,
+        offset: int,
+        length: int,
+        compress: bool,
+        stats: TransferStats,
+    ):
+        if not compress:
+            self.client.send_file_frame(file, offset, length)
+            sent = length
+        else:
+            file.seek(offset)
+            data = file.read(length)
+            sent = self.client.send_frame(MESSAGE_DATA, data, compress=True)
+
+        stats.bytes_sent += sent
+        if self.bucket is not None:
+            self.bucket.consume(sent)
+
+
+def restore_file(store: ChunkStore, manifest: dict, destination: pathlib.Path):
+    """
+    Rebuilds a backed up file from its manifest
+    """
+    destination.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(destination, mode="wb") as restored:
+        for digest, _ in manifest["Chunks"]:
+            restored.write(store.get(bytes.fromhex(digest)))
+
+    mtime_ns = manifest["MTime"]
+    os.utime(destination, ns=(mtime_ns, mtime_ns))
+
+
+class TransferHandler:
+    """
+    The server's side of NativeBackupClient
+
+    Chunks go into a ChunkStore shared by every client. What a backed up file
+    is made of is written to a manifest at path inside the run's snapshot.
+    Manifests of unchanged files are hard linked from the previous snapshot
+    """
+
+    def __init__(self, store: ChunkStore, snapshots: SnapshotStore):
+        self.store = store
+        self.snapshots = snapshots
+
+    def manifest_path_of(self, username: str, snapshot: str, remote_path: str):
+        parts = pathlib.PurePosixPath(remote_path).parts
+        parts = [part for part in parts if part != "/"]
+        if parts == [] or ".." in parts:
+            raise TransferError(f"Refusing to write to {remote_path}")
+
+        try:
+            return self.snapshots.path_of(username, snapshot).joinpath(*parts)
+        except ValueError as e:
+            raise TransferError(str(e))
+
+    def handle_request(self, request: Request, client: BackupSocket) -> Request:
+        command = request["metadata"].get("Command")
+        username = request["sender"]
+
+        try:
+            match command:
+                case "FileStatus":
+                    body = self.file_status(request)
+                case "PatchFile":
+                    body = self.patch_file(request, client)
+                case _:
+                    return make_request(reciever=username, Status="UnknownCommand")
+        except TransferError as e:
+            return make_request(str(e), reciever=username, Status="TransferFailed")
+
+        return make_request(body, reciever=username, Status="OK")
+
+    def file_status(self, request: Request):
+        username = request["sender"]
+        # Once per batch instead of once per file for the files sent since the last one
+        self.store.commit()
+        snapshot = request["metadata"]["Snapshot"]
+        previous = request["metadata"].get("Previous") or ""
+        changed: dict[str, str] = {}
+
+        for remote_path, size, mtime_ns in json.loads(request["body"]):
+            if previous == "":
+                changed[remote_path] = "Missing"
+                continue
+
+            previous_path = self.manifest_path_of(username, previous, remote_path)
+            try:
+                manifest = json.loads(previous_path.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                changed[remote_path] = "Missing"
+                continue
+
+            # Compared to the second like rsync as not every filesystem keeps ns
+            same_mtime = manifest["MTime"] // 10**9 == mtime_ns // 10**9
+            if manifest["Size"] != size or not same_mtime:
+                changed[remote_path] = "Changed"
+                continue
+
+            current_path = self.manifest_path_of(username, snapshot, remote_path)
+            link_unchanged(previous_path, current_path)
+
+        return json.dumps(changed)
+
+    def patch_file(self, request: Request, client: BackupSocket):
+        """
+        Takes a file's chunks a batch at a time. Each batch is answered with
+        the chunks to send, and the last reply comes once the file is stored.
+        A failure is only replied to where the client waits for a reply, so
+        the chunks it's already sending are read and thrown away first
+        """
+        metadata = request["metadata"]
+        manifest_path = self.manifest_path_of(
+            request["sender"], metadata["Snapshot"], metadata["Path"]
+        )
+        chunk_list: list[tuple[str, int]] = []
+        # Each chunk only needs to be sent once even if the file repeats it
+        seen = set()
+        failure = None
+
+        batch_request = request
+        while True:
+            batch: list[tuple[str, int]] = json.loads(batch_request["body"])
+            chunk_list.extend(batch)
+            missing = []
+            for index, (digest, _) in enumerate(batch):
+                if digest not in seen and not self.store.contains(
+                    bytes.fromhex(digest)
+                ):
+                    missing.append(index)
+                seen.add(digest)
+
+            response = make_request(
+                json.dumps(missing),
+                reciever=request["sender"],
+                Status="OK",
+                RequestID=batch_request["metadata"].get("RequestID"),
+            )
+            client.send_prefix(response, MESSAGE_RESPONSE)
+
+            for index in missing:
+                message_type, _, body = client.recieve_frame()
+                if message_type != MESSAGE_DATA:
+                    # Out of step with the client, nothing after this can be trusted
+                    raise RecievingError("Expected chunk data")
+                if failure is not None:
+                    continue
+
+                digest = hashlib.sha256(body).digest()
+                if digest.hex() != batch[index][0]:
+                    failure = "Chunk changed while it was sent"
+                    continue
+                self.store.put(digest, body)
+
+            if batch_request["metadata"].get("Last"):
+                break
+
+            batch_request = client.recieve_prefix()
+            if batch_request["metadata"].get("Command") != "PatchChunks":
+                raise RecievingError("Expected the rest of the file's chunks")
+            if failure is not None:
+                # Replied to in place of the next batch
+                raise TransferError(failure)
+
+        if failure is not None:
+            raise TransferError(failure)
+        if sum(length for _, length in chunk_list) != metadata["Size"]:
+            raise TransferError("File size doesn't match")
+
+        # The chunks are made durable by the next FileStatus or EndSnapshot,
+        # and a snapshot is only used as a previous one after EndSnapshot
+        self.store.add_logical(metadata["Size"])
+
+        manifest = {
+            "Size": metadata["Size"],
+            "MTime": metadata["MTime"],
+            "Chunks": chunk_list,
+        }
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        tools.atomic_write(manifest_path, json.dumps(manifest))
+
+        return ""
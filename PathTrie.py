@@ -0,0 +1,135 @@
+"""
+A set of paths stored as a tree of their parts
+
+Besides what a set does, it can tell whether a path or any folder above it
+is in the set, whether anything below a path is, and drop everything below
+a path. Each of those only walks the path's parts so they cost the same
+however many paths are in the set. Paths are POSIX style strings like the
+ones DirectoryView uses for its items
+"""
+
+from typing import Iterable, Iterator
+
+
+class TrieNode:
+    __slots__ = ("children", "path", "count")
+
+    def __init__(self):
+        self.children: dict[str, TrieNode] = {}
+        self.path: str | None = None
+        """The path as it was added, if this node is in the set"""
+        self.count = 0
+        """Paths in the set at or below this node"""
+
+
+def parts_of(path: str):
+    # "/a/b" splits into "", "a" and "b" so "/" is above every absolute path
+    return path.rstrip("/").split("/")
+
+
+class PathTrie:
+    def __init__(self, paths: Iterable[str] = ()):
+        self.root = TrieNode()
+        for path in paths:
+            self.add(path)
+
+    def __len__(self):
+        return self.root.count
+
+    def __contains__(self, path: str):
+        node = self.__find__(path)
+        return node is not None and node.path is not None
+
+    def __iter__(self) -> Iterator[str]:
+        stack = [self.root]
+        while stack != []:
+            node = stack.pop()
+            if node.path is not None:
+                yield node.path
+            stack.extend(node.children.values())
+
+    def add(self, path: str):
+        nodes = [self.root]
+        for part in parts_of(path):
+            nodes.append(nodes[-1].children.setdefault(part, TrieNode()))
+
+        if nodes[-1].path is not None:
+            return
+        nodes[-1].path = path
+        for node in nodes:
+            node.count += 1
+
+    def remove(self, path: str):
+        if path not in self:
+            raise KeyError(path)
+        self.discard(path)
+
+    def discard(self, path: str):
+        nodes = self.__path_to__(path)
+        if nodes is None or nodes[-1].path is None:
+            return
+
+        nodes[-1].path = None
+        self.__uncount__(path, nodes, 1)
+
+    def clear(self):
+        self.root = TrieNode()
+
+    def clear_below(self, path: str):
+        """Removes every path below path, leaving path itself"""
+        nodes = self.__path_to__(path)
+        if nodes is None:
+            return
+
+        below = nodes[-1].count - (nodes[-1].path is not None)
+        nodes[-1].children = {}
+        self.__uncount__(path, nodes, below)
+
+    def covering(self, path: str):
+        """
+        Returns path or the closest folder above it that is in the set,
+        or None if there isn't one
+        """
+        covering = None
+        node = self.root
+        for part in parts_of(path):
+            node = node.children.get(part)
+            if node is None:
+                break
+            if node.path is not None:
+                covering = node.path
+
+        return covering
+
+    def covers(self, path: str):
+        return self.covering(path) is not None
+
+    def has_below(self, path: str):
+        node = self.__find__(path)
+        return node is not None and node.count > (node.path is not None)
+
+    def __find__(self, path: str):
+        nodes = self.__path_to__(path)
+        return nodes[-1] if nodes is not None else None
+
+    def __path_to__(self, path: str):
+        """Returns the nodes from the root down to path's node"""
+        nodes = [self.root]
+        for part in parts_of(path):
+            node = nodes[-1].children.get(part)
+            if node is None:
+                return None
+            nodes.append(node)
+
+        return nodes
+
+    def __uncount__(self, path: str, nodes: list[TrieNode], removed: int):
+        for node in nodes:
+            node.count -= removed
+
+        # Nodes with nothing left at or below them are dropped
+        parts = parts_of(path)
+        for index in range(len(nodes) - 1, 0, -1):
+            if nodes[index].count != 0:
+                break
+            del nodes[index - 1].children[parts[index - 1]]
@@ -0,0 +1,316 @@
+"""
+The steps of an rsync backup, shared by BackupWindow and HeadlessBackup
+
+An RsyncBackup asks the server for a snapshot, plans the transfer with a dry
+run against the previous snapshot, has the server link the roots that
+didn't change, splits the rest into shards with an rsync each and tells the
+server whether the snapshot was completed. The steps are separate methods
+so the window can run the slow ones off the UI thread and carry on with
+after(), while HeadlessBackup calls them in order.
+RsyncProgress adds up what the running rsyncs print for both of them.
+Nothing here imports Tk
+"""
+
+import concurrent.futures
+import json
+import os
+import pathlib
+import platform
+import queue
+import subprocess
+import threading
+import time
+from typing import IO, Callable, cast, override
+
+import misc_tools as tools
+import settings
+from BackupSession import BackupSession
+from BackupSocket import RecievingError, Request, SendingError
+from BandwidthScheduler import BandwidthScheduler
+from FileScanner import ScanNode
+from PathTrie import PathTrie
+from RsyncPlan import (
+    RsyncPlan,
+    base_command,
+    parse_record,
+    plan_transfer,
+    rsync_form,
+    write_path_list,
+)
+
+
+class BackupError(Exception):
+    """
+    Raised when the server refuses to start an rsync backup
+    """
+
+    def __init__(self, message=""):
+        if message == "":
+            message = "BACKUP FAILED"
+        self.message = message
+        super().__init__(message)
+
+    @override
+    def __str__(self):
+        return self.message
+
+
+class RsyncBackup:
+    def __init__(
+        self,
+        session: BackupSession,
+        rsync_path: str,
+        include_dirs: list[str],
+        exclude_dirs: list[str],
+        lookup: Callable[[pathlib.Path], ScanNode | None],
+    ):
+        self.session = session
+        self.rsync_path = rsync_path
+        self.include_dirs = include_dirs
+        self.exclude_dirs = exclude_dirs
+        self.lookup = lookup
+        """Where the sizes the roots are sharded by come from"""
+        self.scheduler = BandwidthScheduler.from_settings(settings.settings)
+        self.snapshot = ""
+        self.previous = ""
+        self.destination = ""
+        self.rsync_command: list[str] = []
+        self.plan_command: list[str] = []
+        self.rsync_commands: list[list[str]] = []
+        """One rsync per shard, all reported as a single backup"""
+        self.temp_files: list[pathlib.Path] = []
+
+    def begin(self) -> concurrent.futures.Future[Request]:
+        """
+        Asks the server for a snapshot to back up into, the reply goes to
+        snapshot_begun()
+        """
+        return self.session.request("BeginSnapshot", Kind="rsync")
+
+    def snapshot_begun(self, response: Request):
+        status = response["metadata"].get("Status")
+        if status != "OK":
+            raise BackupError(f"Server replied {status}")
+
+        metadata = response["metadata"]
+        self.snapshot = metadata["Snapshot"]
+        self.previous = metadata["Previous"]
+        rsync_user = settings.settings.get("ServerUser") or "user"
+        server = f"{rsync_user}@{settings.settings["Host"]}"
+        self.destination = f"{server}:{metadata["Path"]}"
+
+        exclude_file = self.__write_list__(self.exclude_dirs, "ExcludeFrom.tmp")
+        self.rsync_command = base_command(
+            self.rsync_path, settings.settings["SSHPort"], exclude_file
+        )
+
+        # Compared with the previous snapshot, which is what --link-dest makes
+        # the transfer compare with. Without one it's the empty snapshot.
+        # Deleting shows which roots lost files, it's only a dry run
+        plan_file = self.__write_list__(self.include_dirs, "FilesFromPlan.tmp")
+        plan_path = metadata.get("PreviousPath") or metadata["Path"]
+        self.plan_command = [
+            *self.rsync_command,
+            "--delete",
+            "--delete-excluded",
+            f"--files-from={plan_file}",
+            "/",
+            f"{server}:{plan_path}",
+        ]
+
+        # Files that didn't change are hard linked to the previous snapshot
+        if self.previous != "":
+            self.rsync_command.append(f"--link-dest=../{self.previous}")
+
+    def prepare(self) -> RsyncPlan | None:
+        """
+        Plans the transfer and makes rsync_commands, returning the plan or
+        None if the dry run failed. Both read every file, so call it off the
+        UI thread
+        """
+        try:
+            plan = plan_transfer(self.plan_command, self.include_dirs)
+        except OSError:
+            plan = None
+
+        roots = self.include_dirs
+        if plan is not None and self.previous != "":
+            roots = self.__link_unchanged__(plan)
+
+        # Each shard gets its own rsync so checksumming and SSH aren't
+        # limited to one core and one stream
+        shards = tools.shard_paths(
+            self.lookup, roots, settings.settings["ParallelStreams"]
+        )
+        bandwidth_limit = self.scheduler.rsync_limit(len(shards))
+        self.rsync_commands = []
+        for index, shard in enumerate(shards):
+            include_file = self.__write_list__(shard, f"FilesFrom{index}.tmp")
+            self.rsync_commands.append(
+                [
+                    *self.rsync_command,
+                    "--info=progress2",
+                    *bandwidth_limit,
+                    f"--files-from={include_file}",
+                    "/",
+                    self.destination,
+                ]
+            )
+
+        return plan
+
+    def __link_unchanged__(self, plan: RsyncPlan):
+        """
+        Has the server link the roots the dry run had nothing to do in from
+        the previous snapshot, returning the roots that still have to be sent
+        """
+        # A root that's gone would come back from the previous snapshot, and
+        # one above or below another would be linked and sent both
+        included = PathTrie(self.include_dirs)
+        unchanged = [
+            root
+            for root in self.include_dirs
+            if root not in plan.roots
+            and os.path.lexists(root)
+            and not included.has_below(root)
+            and not included.covers(root.rstrip("/").rpartition("/")[0])
+        ]
+        if unchanged == []:
+            return self.include_dirs
+
+        try:
+            response = self.session.request(
+                "LinkPaths",
+                json.dumps(list(map(rsync_form, unchanged))),
+                Kind="rsync",
+                Snapshot=self.snapshot,
+            ).result()
+        except (OSError, SendingError, RecievingError):
+            return self.include_dirs
+        if response["metadata"].get("Status") != "OK":
+            return self.include_dirs
+
+        return [root for root in self.include_dirs if root not in unchanged]
+
+    def end(self, completed: bool) -> concurrent.futures.Future[Request]:
+        for temp_file in self.temp_files:
+            temp_file.unlink(missing_ok=True)
+        self.temp_files = []
+
+        # Unfinished snapshots are never linked against by the next run
+        return self.session.request(
+            "EndSnapshot", Kind="rsync", Snapshot=self.snapshot, Completed=completed
+        )
+
+    def __write_list__(self, paths: list[str], name: str):
+        path = write_path_list(paths, name)
+        self.temp_files.append(path)
+        if platform.system() == "Windows":
+            return tools.win_to_rsync_readable_posix(path)
+
+        return path.as_posix()
+
+
+def start_rsyncs(rsync_commands: list[list[str]], records: queue.Queue):
+    """
+    Starts every rsync at once with a thread that puts what it prints into
+    records, and ("Ended", index) once it has exited
+    """
+    processes = [
+        subprocess.Popen(
+            rsync_command,
+            text=True,
+            encoding="utf-8",
+            errors="replace",
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        for rsync_command in rsync_commands
+    ]
+
+    # One reader per stream for the whole run, text mode turns the \r
+    # progress2 ends its lines with into line breaks
+    for index, process in enumerate(processes):
+        threading.Thread(
+            target=read_output, args=(index, process, records), daemon=True
+        ).start()
+
+    return processes
+
+
+def read_output(index: int, process: subprocess.Popen, records: queue.Queue):
+    for line in cast(IO[str], process.stdout):
+        record = parse_record(index, line)
+        if record is not None:
+            records.put(record)
+
+    process.wait()
+    records.put(("Ended", index))
+
+
+def signal_running(processes: list[subprocess.Popen], signal_number: int):
+    for process in processes:
+        if process.poll() is None:
+            process.send_signal(signal_number)
+
+
+class RsyncProgress:
+    """
+    What every stream of a backup has done so far
+    """
+
+    def __init__(self, streams: int):
+        self.file_bytes = [0] * streams
+        """Bytes of every file each stream finished"""
+        self.progress_bytes = [0] * streams
+        """Bytes done according to each stream's progress2 lines"""
+        self.total_sent = 0
+        """Bytes rsync sent over the network for the files it finished"""
+        self.files_done = 0
+        self.ended = 0
+        self.current_file = "-"
+        self.last_measure = (time.monotonic(), 0, 0)
+
+    @property
+    def bytes_done(self):
+        # progress2 counts inside big files so it's ahead of finished files
+        return sum(map(max, self.file_bytes, self.progress_bytes))
+
+    @property
+    def finished(self):
+        return self.ended == len(self.file_bytes)
+
+    def add(self, record: tuple):
+        match record:
+            case ("File", index, current_file, length, sent):
+                self.files_done += 1
+                self.file_bytes[index] += length
+                self.total_sent += sent
+                self.current_file = current_file
+            case ("Progress", index, progress_bytes):
+                self.progress_bytes[index] = progress_bytes
+            case ("Ended", _):
+                self.ended += 1
+
+    def measure(self, interval: float):
+        """
+        Returns the backup speed, the speed over the network and the seconds
+        they were measured over, or None if that's less than interval
+        """
+        now = time.monotonic()
+        last_time, last_bytes, last_sent = self.last_measure
+        seconds = now - last_time
+        if seconds < interval:
+            return None
+
+        self.last_measure = (now, self.bytes_done, self.total_sent)
+        speed = (self.bytes_done - last_bytes) / seconds
+        # The cap is on what goes over the network, which compression and
+        # rsync's delta transfer keep well below the bytes backed up
+        sent_speed = (self.total_sent - last_sent) / seconds
+        return speed, sent_speed, seconds
+
+    def restart_measure(self):
+        """Leaves a pause out of the next measurement"""
+        self.last_measure = (time.monotonic(), self.bytes_done, self.total_sent)
@@ -0,0 +1,171 @@
+"""
+Works out what an rsync backup will send before it sends anything
+
+The backup's own command is run with --dry-run against the previous
+snapshot, which the real transfer hard links unchanged files to with
+--link-dest. Every file it would send is one the backup sends, so adding
+them up gives the real number of files and bytes to send instead of an
+estimate from the local folders. Roots it has nothing to do in don't have
+to be sent at all
+
+The command every rsync backup starts from and the parsing of what it prints
+live here too, so that backing up without a window doesn't need Tk
+"""
+
+import pathlib
+import platform
+import re
+import subprocess
+
+import misc_tools as tools
+from Compression import INCOMPRESSIBLE_SUFFIXES
+from PathTrie import PathTrie
+
+OUT_FORMAT = "%i|%f|%l|%b"
+"""Itemized changes, file name, file length and bytes actually sent"""
+PARTIAL_TRANSFER_CODES = (0, 23, 24)
+"""Exit codes after which the output still lists everything rsync looked at"""
+PROGRESS2 = re.compile(r"^\s*([\d,.]+)\s+\d+%\s+\S+/s\s+\S+")
+"""An --info=progress2 line, starting with the bytes done in the whole run"""
+
+
+def base_command(rsync_path: str, ssh_port: int, exclude_file: pathlib.Path | str):
+    """
+    Returns the options every rsync of a backup uses, printing with OUT_FORMAT
+    """
+    # Compressing media and archives again only burns CPU
+    skip_compress = "/".join(
+        sorted(suffix.lstrip(".") for suffix in INCOMPRESSIBLE_SUFFIXES)
+    )
+    return [
+        rsync_path,
+        "-e",
+        f"ssh -p {ssh_port}",
+        "--archive",
+        "--recursive",
+        "--compress",
+        f"--skip-compress={skip_compress}",
+        "--partial",
+        f"--exclude-from={exclude_file}",
+        f"--out-format={OUT_FORMAT}",
+    ]
+
+
+def parse_line(line: str):
+    """
+    Returns the itemized changes, name, length and bytes sent of a line
+    printed with OUT_FORMAT, or None if it isn't one
+    """
+    fields = line.rstrip("\n").split("|")
+    if len(fields) < 4:
+        return None
+
+    # File names can have | in them so everything between is the name
+    try:
+        length, sent = int(fields[-2]), int(fields[-1])
+    except ValueError:
+        return None
+
+    return fields[0].strip(), "|".join(fields[1:-2]), length, sent
+
+
+def is_sent_file(itemized: str):
+    # "<f..." is a file being sent to the server
+    return itemized[:2] == "<f"
+
+
+def parse_record(index: int, line: str):
+    """
+    Returns the record for a line of output from stream index, or None for
+    rsync's other messages
+    """
+    progress = PROGRESS2.match(line)
+    if progress is not None:
+        progress_bytes = int(re.sub(r"[,.]", "", progress.group(1)))
+        return ("Progress", index, progress_bytes)
+
+    parsed = parse_line(line)
+    if parsed is None:
+        return None
+
+    itemized, current_file, length, sent = parsed
+    if not is_sent_file(itemized):
+        return None
+
+    if platform.system() == "Windows":
+        current_file = tools.rsync_posix_to_win(current_file)
+    current_file = tools.pretty_path(pathlib.Path(current_file))
+    return ("File", index, current_file, length, sent)
+
+
+def rsync_form(path: str):
+    """Returns path the way rsync prints and reads it"""
+    if platform.system() == "Windows":
+        path = tools.win_to_rsync_readable_posix(pathlib.Path(path))
+
+    return path.rstrip("/") or "/"
+
+
+class RsyncPlan:
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.roots: set[str] = set()
+        """Roots rsync has anything to do in, deleting included"""
+
+    def add(self, root: str | None, itemized: str, length: int):
+        # Without --itemize-changes twice only items that change are printed
+        if root is not None:
+            self.roots.add(root)
+        if is_sent_file(itemized):
+            self.files += 1
+            self.bytes += length
+
+
+def write_path_list(paths: list[str], name: str):
+    """
+    Writes paths one per line in rsync's form for --files-from and
+    --exclude-from, returning where the list was written
+    """
+    if platform.system() == "Windows":
+        paths = list(map(tools.win_to_rsync_readable_posix, map(pathlib.Path, paths)))
+
+    with open(name, mode="w") as path_list:
+        path_list.write("\n".join(paths))
+
+    return pathlib.Path(name).resolve()
+
+
+def plan_transfer(rsync_command: list[str], roots: list[str]):
+    """
+    Runs rsync_command, which has to print with OUT_FORMAT, as a dry run and
+    returns what it would send and which of roots it has anything to do in.
+    Returns None if rsync failed
+    """
+    # rsync prints paths in its own form, which differs on Windows
+    rsync_roots = {rsync_form(root): root for root in roots}
+    trie = PathTrie(rsync_roots)
+
+    plan = RsyncPlan()
+    process = subprocess.Popen(
+        [rsync_command[0], "--dry-run", *rsync_command[1:]],
+        text=True,
+        encoding="utf-8",
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    # Streamed so huge plans don't have to fit in memory as text
+    for line in process.stdout or []:
+        parsed = parse_line(line)
+        if parsed is None:
+            continue
+
+        itemized, name, length, _ = parsed
+        root = trie.covering("/" + name.lstrip("/"))
+        plan.add(rsync_roots[root] if root is not None else None, itemized, length)
+
+    if process.wait() not in PARTIAL_TRANSFER_CODES:
+        return None
+
+    return plan
@@ -1,21 +1,43 @@
-import concurrent.futures
 import datetime
-import pathlib
 import platform
-import subprocess
+import queue
+import signal
 from tkinter import *
 from tkinter import messagebox, ttk
-from typing import IO, cast
 
 import misc_tools as tools
+from BandwidthScheduler import BandwidthScheduler
+from RsyncBackup import RsyncProgress, signal_running, start_rsyncs
+
+UPDATE_INTERVAL = 250
+"""Milliseconds between draining the readers, which is all the UI does"""
+MAX_RECORDS = 5000
+"""Records handled per update so a burst of small files can't freeze the UI"""
+SPEED_SMOOTHING = 0.3
 
 
 class RsyncTracker:
     def __init__(
-        self, parent: Widget, HOST: str, rsync_command: list[str], total_to_backup: int
+        self,
+        parent: Widget,
+        HOST: str,
+        rsync_commands: list[list[str]],
+        total_to_backup: int,
+        bytes_to_backup: int | None = None,
+        scheduler: BandwidthScheduler | None = None,
     ):
         self.total_to_backup = total_to_backup
-        self.rsync_command = rsync_command
+        self.bytes_to_backup = bytes_to_backup
+        """From the plan, drives the progress bar when it's known"""
+        self.rsync_commands = rsync_commands
+        """One rsync per shard, all reported as a single backup"""
+        self.records: queue.Queue[tuple] = queue.Queue()
+        """What the reader threads parsed, drained by update_ui"""
+        self.progress = RsyncProgress(len(rsync_commands))
+        self.speed = 0.0
+        self.scheduler = scheduler
+        """Caps that can start after the rsyncs got their --bwlimit"""
+        self.paused = False
         self.HOST = HOST
 
         self.window = Toplevel(parent)
@@ -24,16 +46,17 @@ class RsyncTracker:
         progress_frame = ttk.Frame(self.window)
 
         self.backed_up = IntVar()
+        self.bytes_backed_up = IntVar()
         self.progress_bar = ttk.Progressbar(
             progress_frame,
             orient="horizontal",
             length=500,
             mode="determinate",
-            maximum=self.total_to_backup,
-            variable=self.backed_up,
+            maximum=self.bytes_to_backup or self.total_to_backup,
+            variable=(self.bytes_backed_up if self.bytes_to_backup else self.backed_up),
         )
 
-        self.backup_item = StringVar(value="-")
+        self.backup_item = StringVar(value=self.progress.current_file)
         backup_item_label = ttk.Label(
             progress_frame, textvariable=self.backup_item, justify="left"
         )
@@ -50,27 +73,13 @@ class RsyncTracker:
         backup_item_label.grid(column=0, row=0, sticky="SW", padx=5, pady=5)
         backup_speed_label.grid(column=0, row=2, sticky="SW", padx=5, pady=5)
 
-        self.running: bool = False
-
         self.window.update_idletasks()
         self.start_rsync()
 
     def start_rsync(self):
-        self.process = subprocess.Popen(
-            self.rsync_command,
-            text=True,
-            encoding="utf-8",
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-        )
-
-        self.stdout = cast(IO[str], self.process.stdout)
-
-        self.poller()
-        self.latest_lines = []
-        self.read_output()
-        self.window.after(10, self.update_ui, datetime.datetime.now())
+        self.processes = start_rsyncs(self.rsync_commands, self.records)
+        self.progress.restart_measure()
+        self.window.after(UPDATE_INTERVAL, self.update_ui)
         return
 
     def exit(self):
@@ -81,80 +90,71 @@ class RsyncTracker:
         )
         self.window.event_generate("<<RsyncCompleted>>")
 
-    # TODO: Make the current file actually the current file
-    def update_ui(self, last_backup: datetime.datetime, done: bool = False):
-        if self.latest_lines != []:
-            info = self.parse_output(self.latest_lines)
+    @property
+    def returncode(self):
+        """0 once every rsync has finished successfully"""
+        for process in self.processes:
+            if process.returncode != 0:
+                return process.returncode
 
-            now = datetime.datetime.now()
-            time_between_backup = now - last_backup
-            time_between_backup = time_between_backup.total_seconds()
-            sending_speed = info["TotalSent"] // time_between_backup
-            sending_speed = tools.human_readable_file_size(sending_speed)
+        return 0
 
-            self.backup_speed.set(f"{sending_speed}/s")
-            self.backup_item.set(
-                f"{info["CurrentFile"]} ({self.backed_up.get()} / {self.total_to_backup})"
-            )
-            self.backed_up.set(self.backed_up.get() + info["AmountBackedUp"])
+    def update_ui(self):
+        for _ in range(MAX_RECORDS):
+            try:
+                self.progress.add(self.records.get_nowait())
+            except queue.Empty:
+                break
 
-            if not done:
-                self.latest_lines = []
-                self.read_output()
+        self.backed_up.set(self.progress.files_done)
+        self.bytes_backed_up.set(self.progress.bytes_done)
+        self.__update_speed__()
 
-        if done:
+        if self.progress.finished and self.records.empty():
             self.backed_up.set(self.total_to_backup)
+            self.bytes_backed_up.set(self.bytes_to_backup or 0)
             self.exit()
             return
 
-        self.window.after(50, self.update_ui, last_backup, not self.running)
-
-    def parse_output(self, lines: list[str]):
-        info = {}
-        current_file = self.get_file_sent(lines[-1])
-        if platform.system() == "Windows":
-            current_file = tools.rsync_posix_to_win(current_file)
-
-        current_file = tools.pretty_path(pathlib.Path(current_file))
-
-        total_sent = sum(map(self.get_bytes_sent, lines))
+        self.window.after(UPDATE_INTERVAL, self.update_ui)
 
-        info["CurrentFile"] = current_file
-        info["AmountBackedUp"] = len(lines)
-        info["TotalSent"] = total_sent
-
-        return info
-
-    def get_file_sent(self, line: str):
-        return "|".join(line.split(sep="|")[1:-1])
-
-    def get_bytes_sent(self, line: str):
-        return int(line.split(sep="|")[-1])
-
-    def read_output(self):
-        executor = concurrent.futures.ThreadPoolExecutor()
-        future = executor.submit(self.__read_output__)
+    def __update_speed__(self):
+        measured = self.progress.measure(1)
+        if measured is None:
+            return
 
-        self.window.after(
-            10, tools.non_blocking_executor_shutdown, self.window, executor, future
+        # Smoothed so one slow second doesn't swing the estimate around
+        speed, sent_speed, seconds = measured
+        self.speed += SPEED_SMOOTHING * (speed - self.speed)
+        self.__throttle__(sent_speed, seconds)
+
+        readout = f"{tools.human_readable_file_size(int(self.speed))}/s"
+        if self.bytes_to_backup and self.speed > 0:
+            left = max(self.bytes_to_backup - self.progress.bytes_done, 0) / self.speed
+            readout += f", {datetime.timedelta(seconds=int(left))} left"
+        self.backup_speed.set(readout)
+        self.backup_item.set(
+            f"{self.progress.current_file} "
+            f"({self.progress.files_done} / {self.total_to_backup})"
         )
 
-    def __readlines__(self):
-        yield self.stdout.readline()
-
-    def __read_output__(self):
-        if not self.running:
+    def __throttle__(self, speed: float, seconds: float):
+        """
+        Pauses the rsyncs for as long as they got ahead of the cap, which
+        only happens when a window with a lower cap starts mid backup
+        """
+        if self.scheduler is None or self.paused or platform.system() == "Windows":
             return
 
-        new_lines = []
-        for line in self.__readlines__():
-            if line == "":
-                break
-            new_lines.append(line.strip())
+        pause = self.scheduler.pause_for(speed, seconds)
+        if pause <= 0:
+            return
 
-        self.latest_lines = new_lines
-        return
+        self.paused = True
+        signal_running(self.processes, signal.SIGSTOP)
+        self.window.after(int(pause * 1000), self.__resume__)
 
-    def poller(self):
-        self.running = self.process.poll() == None
-        self.window.after(10, self.poller)
+    def __resume__(self):
+        signal_running(self.processes, signal.SIGCONT)
+        self.paused = False
+        self.progress.restart_measure()
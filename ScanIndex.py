@@ -0,0 +1,245 @@
+"""
+An on-disk index of every scanned folder so restarts don't scan everything again
+
+Adding, removing or renaming anything in a folder changes the folder's
+mtime, so a folder whose mtime and inode match the index is taken from the
+index instead of the disk. A rescan then costs one stat() per folder plus a
+scandir() of the folders that changed. The files in unchanged folders are
+only read from the index once something asks for them.
+
+Files edited in place don't change their folder's mtime, so their sizes can
+be stale until something else in the folder changes. Counts are always
+exact, and backups check every file themselves, so only the sizes shown
+are affected
+"""
+
+import os
+import pathlib
+import sqlite3
+import stat
+import threading
+import time
+
+from FileScanner import ScanNode
+
+SCAN_INDEX = "scan_index.sqlite3"
+RACY_SECONDS = 2
+"""
+Folders changed this close to being scanned aren't trusted next time, since
+a change in the same mtime tick wouldn't show up as a new mtime
+"""
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    files_size INTEGER NOT NULL,
+    files_count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    PRIMARY KEY (folder, name)
+) WITHOUT ROWID;
+"""
+"""
+files_size and files_count only cover the folder's own files, not the ones
+in folders below it. Anything that isn't a folder is stored as a file
+"""
+
+
+class ScanIndex:
+    def __init__(self, path: pathlib.Path | str = SCAN_INDEX):
+        self.path = pathlib.Path(path)
+        self.local = threading.local()
+        self.database.executescript(SCHEMA)
+        self.folders_scanned = 0
+        """Folders that had to be listed from the disk in the last scan"""
+
+    @property
+    def database(self) -> sqlite3.Connection:
+        # Connections can't be shared between threads, and with WAL one
+        # thread can read while another scans
+        database = getattr(self.local, "database", None)
+        if database is None:
+            database = sqlite3.connect(self.path)
+            # The index can always be rebuilt so durability isn't worth fsyncs
+            database.execute("PRAGMA journal_mode=WAL")
+            database.execute("PRAGMA synchronous=NORMAL")
+            self.local.database = database
+
+        return database
+
+    def close(self):
+        """Closes the calling thread's connection"""
+        database = getattr(self.local, "database", None)
+        if database is not None:
+            database.close()
+            self.local.database = None
+
+    def scan(self, path: pathlib.Path) -> ScanNode | None:
+        """
+        Same as FileScanner.scan but only lists folders that changed since
+        the last time they were scanned
+        """
+        self.folders_scanned = 0
+        try:
+            path_stat = path.stat()
+        except OSError:
+            with self.database:
+                self.__forget__(str(path))
+            return None
+
+        root = ScanNode(path.name or str(path), stat.S_ISDIR(path_stat.st_mode))
+        if not root.is_dir:
+            root.size = path_stat.st_size
+            return root
+
+        known, subfolders = self.__load__(str(path))
+        # Folders with the folders directly in them, parents first
+        scanned: list[tuple[ScanNode, list[ScanNode]]] = []
+        stack = [(root, str(path), path_stat)]
+        with self.database:
+            while stack != []:
+                node, dir_path, dir_stat = stack.pop()
+                record = known.get(dir_path)
+                unchanged = (dir_stat.st_mtime_ns, dir_stat.st_ino)
+                if record is not None and record[:2] == unchanged:
+                    folders = self.__from_index__(
+                        node, dir_path, record, subfolders.get(dir_path, [])
+                    )
+                else:
+                    folders = self.__list__(node, dir_path, dir_stat, subfolders)
+
+                scanned.append((node, [child for child, _ in folders]))
+                for child, child_path in folders:
+                    try:
+                        stack.append((child, child_path, os.stat(child_path)))
+                    except OSError:
+                        # Gone since it was listed, it'll be noticed next time
+                        pass
+
+        # Children before parents so each folder only adds up its own folders
+        for node, folders in reversed(scanned):
+            for child in folders:
+                node.size += child.size
+                node.count += child.count
+
+        return root
+
+    def __load__(self, dir_path: str):
+        """
+        Returns what the index knows about the folders at or below dir_path
+        and the names of the folders in each of them
+        """
+        # One query for the whole tree is far quicker than one per folder
+        known: dict[str, tuple[int, int, int, int]] = {}
+        subfolders: dict[str, list[str]] = {}
+        for path, *record in self.database.execute(
+            "SELECT * FROM folders WHERE path = ? OR (path >= ? AND path < ?)",
+            (dir_path, *self.__below__(dir_path)),
+        ):
+            known[path] = tuple(record)
+            parent, name = os.path.split(path)
+            subfolders.setdefault(parent, []).append(name)
+
+        return known, subfolders
+
+    def __from_index__(
+        self,
+        node: ScanNode,
+        dir_path: str,
+        record: tuple[int, int, int, int],
+        subfolders: list[str],
+    ):
+        _, _, files_size, files_count = record
+        node.size += files_size
+        node.count += files_count
+        node.loader = lambda node: self.__load_files__(node, dir_path)
+
+        folders = []
+        for name in subfolders:
+            child = ScanNode(name, True)
+            node._children[name] = child
+            folders.append((child, os.path.join(dir_path, name)))
+
+        return folders
+
+    def __load_files__(self, node: ScanNode, dir_path: str):
+        for name, size in self.database.execute(
+            "SELECT name, size FROM files WHERE folder = ?", (dir_path,)
+        ):
+            node._children[name] = ScanNode(name, False, size)
+
+    def __list__(
+        self,
+        node: ScanNode,
+        dir_path: str,
+        dir_stat: os.stat_result,
+        subfolders: dict[str, list[str]],
+    ):
+        self.folders_scanned += 1
+        folders = []
+        rows = []
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        child = ScanNode(entry.name, True)
+                        folders.append((child, entry.path))
+                        node.children[entry.name] = child
+                        continue
+
+                    size = mtime_ns = inode = 0
+                    try:
+                        entry_stat = entry.stat(follow_symlinks=False)
+                        mtime_ns, inode = entry_stat.st_mtime_ns, entry_stat.st_ino
+                        if entry.is_file():
+                            size = entry.stat().st_size
+                    except OSError:
+                        # Broken symlink or deleted since it was listed
+                        pass
+
+                    node.children[entry.name] = ScanNode(entry.name, False, size)
+                    node.size += size
+                    node.count += 1
+                    rows.append((dir_path, entry.name, size, mtime_ns, inode))
+        except OSError:
+            pass
+
+        # Folders that are gone take everything the index had below them along
+        for name in subfolders.get(dir_path, []):
+            child = node.children.get(name)
+            if child is None or not child.is_dir:
+                self.__forget__(os.path.join(dir_path, name))
+
+        self.database.execute("DELETE FROM files WHERE folder = ?", (dir_path,))
+        self.database.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)", rows)
+        mtime_ns = dir_stat.st_mtime_ns
+        if time.time() - mtime_ns / 10**9 < RACY_SECONDS:
+            mtime_ns = -1
+        self.database.execute(
+            "INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, ?)",
+            (dir_path, mtime_ns, dir_stat.st_ino, node.size, node.count - 1),
+        )
+
+        return folders
+
+    def __below__(self, dir_path: str):
+        # Everything below dir_path sorts between "dir_path/" and "dir_path0"
+        prefix = dir_path.rstrip(os.sep)
+        return prefix + os.sep, prefix + chr(ord(os.sep) + 1)
+
+    def __forget__(self, dir_path: str):
+        below = self.__below__(dir_path)
+        self.database.execute(
+            "DELETE FROM files WHERE folder = ? OR (folder >= ? AND folder < ?)",
+            (dir_path, *below),
+        )
+        self.database.execute(
+            "DELETE FROM folders WHERE path = ? OR (path >= ? AND path < ?)",
+            (dir_path, *below),
+        )
@@ -0,0 +1,224 @@
+"""
+Point in time snapshots of every backup run
+
+Each run backs up into its own folder at root/Username/Snapshot. Anything
+that didn't change since the previous snapshot is hard linked to the
+previous snapshot's copy, so a new snapshot only takes up the space of what
+changed. rsync does that itself with --link-dest, native backups link their
+manifests through link_unchanged() or start as a clone of the previous
+snapshot when they only send what changed
+
+Every user's snapshots are listed in root/Username/snapshots.json so that
+listing them never has to walk the snapshots themselves
+"""
+
+import datetime
+import json
+import os
+import pathlib
+import shutil
+import threading
+import urllib.parse
+
+import misc_tools as tools
+
+SNAPSHOT_INDEX = "snapshots.json"
+
+
+class SnapshotStore:
+    def __init__(self, root: pathlib.Path, kind: str):
+        self.root = root
+        self.kind = kind
+        self.lock = threading.Lock()
+
+    def user_dir(self, username: str):
+        # Usernames come from the network so they can't be trusted as folder names
+        dir_name = urllib.parse.quote(username, safe="")
+        if dir_name == "" or dir_name.startswith("."):
+            dir_name = f"_{dir_name}"
+
+        return self.root / dir_name
+
+    def path_of(self, username: str, snapshot: str):
+        if snapshot in ("", ".", "..") or "/" in snapshot or "\\" in snapshot:
+            raise ValueError(f"{snapshot} is not a snapshot")
+
+        return self.user_dir(username) / snapshot
+
+    def snapshots_of(self, username: str) -> list[dict]:
+        index_path = self.user_dir(username) / SNAPSHOT_INDEX
+        try:
+            return json.loads(index_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return []
+
+    def list_all(self) -> dict[str, list[dict]]:
+        if not self.root.exists():
+            return {}
+
+        snapshots = {}
+        for user_dir in sorted(self.root.iterdir()):
+            if (user_dir / SNAPSHOT_INDEX).exists():
+                username = urllib.parse.unquote(user_dir.name)
+                snapshots[username] = self.snapshots_of(username)
+
+        return snapshots
+
+    def latest(self, username: str):
+        completed = [s for s in self.snapshots_of(username) if s["Completed"]]
+        return completed[-1]["Name"] if completed != [] else ""
+
+    def begin(self, username: str, clone: bool = False, selection: str = ""):
+        """
+        Creates a new snapshot and returns its name, the name of the snapshot
+        it should link unchanged files to ("" if there isn't one) and whether
+        it was cloned
+
+        With clone the new snapshot starts out as a hard linked copy of the
+        previous one, for clients that only send what changed. Only safe for
+        snapshots whose files are replaced rather than changed in place.
+        selection identifies what the client backs up, and a snapshot is only
+        cloned from one with the same selection as it wouldn't have the rest
+        """
+        with self.lock:
+            snapshots = self.snapshots_of(username)
+            now = datetime.datetime.now(datetime.timezone.utc)
+            # Sorts by time and is a valid folder name everywhere
+            base_name = now.strftime("%Y-%m-%dT%H-%M-%S")
+            taken = {snapshot["Name"] for snapshot in snapshots}
+            name = base_name
+            suffix = 1
+            while name in taken:
+                name = f"{base_name}-{suffix}"
+                suffix += 1
+
+            previous = self.latest(username)
+            previous_selection = next(
+                (s.get("Selection", "") for s in snapshots if s["Name"] == previous),
+                "",
+            )
+            clone = (
+                clone
+                and previous != ""
+                and selection != ""
+                and selection == previous_selection
+            )
+            self.path_of(username, name).mkdir(parents=True)
+            snapshots.append(
+                {
+                    "Name": name,
+                    "Kind": self.kind,
+                    "Started": tools.datetime_to_ISO8601(now),
+                    "Previous": previous,
+                    "Selection": selection,
+                    "Completed": False,
+                }
+            )
+            self.__write_index__(username, snapshots)
+
+        # Linking walks the whole previous snapshot, which mustn't hold up
+        # other users. Nothing uses a snapshot that isn't completed meanwhile
+        if clone:
+            link_tree(self.path_of(username, previous), self.path_of(username, name))
+
+        return name, previous, clone
+
+    def in_progress(self, username: str, snapshot: str):
+        with self.lock:
+            return any(
+                entry["Name"] == snapshot and not entry["Completed"]
+                for entry in self.snapshots_of(username)
+            )
+
+    def complete(self, username: str, snapshot: str, completed: bool = True):
+        with self.lock:
+            snapshots = self.snapshots_of(username)
+            for entry in snapshots:
+                if entry["Name"] == snapshot:
+                    entry["Completed"] = completed
+            self.__write_index__(username, snapshots)
+
+    def remove(self, username: str, snapshot: str, remote_paths: list[str]):
+        """
+        Removes files that were deleted since the snapshot was cloned
+        Raises ValueError unless the snapshot is still in progress
+        """
+        if not self.in_progress(username, snapshot):
+            raise ValueError(f"{snapshot} isn't a snapshot in progress")
+
+        snapshot_dir = self.path_of(username, snapshot)
+        for remote_path in remote_paths:
+            path = snapshot_dir.joinpath(*parts_of(remote_path))
+            if path.is_dir() and not path.is_symlink():
+                shutil.rmtree(path)
+            else:
+                path.unlink(missing_ok=True)
+
+    def link_previous(self, username: str, snapshot: str, remote_paths: list[str]):
+        """
+        Links paths that didn't change from the previous snapshot, so they
+        don't have to be sent again
+        Raises ValueError unless the snapshot is still in progress
+        """
+        if not self.in_progress(username, snapshot):
+            raise ValueError(f"{snapshot} isn't a snapshot in progress")
+
+        entry = next(s for s in self.snapshots_of(username) if s["Name"] == snapshot)
+        if entry["Previous"] == "":
+            raise ValueError(f"{snapshot} has no previous snapshot")
+
+        previous_dir = self.path_of(username, entry["Previous"])
+        snapshot_dir = self.path_of(username, snapshot)
+        for remote_path in remote_paths:
+            parts = parts_of(remote_path)
+            previous = previous_dir.joinpath(*parts)
+            if previous.is_dir() and not previous.is_symlink():
+                link_tree(previous, snapshot_dir.joinpath(*parts))
+            elif previous.exists() or previous.is_symlink():
+                link_unchanged(previous, snapshot_dir.joinpath(*parts))
+
+    def __write_index__(self, username: str, snapshots: list[dict]):
+        tools.atomic_write(
+            self.user_dir(username) / SNAPSHOT_INDEX, json.dumps(snapshots, indent=1)
+        )
+
+
+def parts_of(remote_path: str):
+    """
+    Returns the parts of a path from the client, which has to stay inside
+    the snapshot
+    """
+    parts = pathlib.PurePosixPath(remote_path).parts
+    parts = [part for part in parts if part != "/"]
+    if parts == [] or ".." in parts:
+        raise ValueError(f"{remote_path} is outside the snapshot")
+
+    return parts
+
+
+def link_unchanged(previous: pathlib.Path, current: pathlib.Path):
+    """
+    Makes current share previous' copy instead of storing it again
+    """
+    current.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(previous, current, follow_symlinks=False)
+    except FileExistsError:
+        return
+    except OSError:
+        # Too many links to one file or a filesystem without hard links
+        shutil.copy2(previous, current, follow_symlinks=False)
+
+
+def link_tree(previous: pathlib.Path, current: pathlib.Path):
+    """
+    Links every file under previous into the same place under current
+    """
+    for dir_path, dir_names, file_names in os.walk(previous):
+        dir_path = pathlib.Path(dir_path)
+        target_dir = current / dir_path.relative_to(previous)
+        target_dir.mkdir(parents=True, exist_ok=True)
+        # os.walk lists symlinks to folders as folders but doesn't go into them
+        links = [name for name in dir_names if (dir_path / name).is_symlink()]
+        for name in file_names + links:
+            link_unchanged(dir_path / name, target_dir / name)
@@ -1,58 +1,50 @@
-from tkinter import *
-from tkinter import messagebox
+"""
+Starts the Backup-inator client
 
-import settings
-from BackupWindow import BackupWindow
-
-
-class ClientWindow:
-    def __init__(self):
-        self.root = Tk()
+With no arguments the usual window opens. --headless backs up what
+backup.json selects and prints its progress instead, so it works on servers
+without a display and from cron. Tk is only imported for the window, which
+keeps headless runs quick to start
+"""
 
-        self.root.option_add("*tearOff", FALSE)
-        self.root.title("Backup-inator")
-        self.root.minsize(width=800, height=400)
+# Imported first so startup is timed from as early as possible
+import startup_timing
 
-        self.root.columnconfigure(index=0, weight=1)
-        self.root.rowconfigure(index=0, weight=1)
+import argparse
+import sys
 
-        menubar = Menu(self.root)
-        self.root["menu"] = menubar
-
-        self.backup_win = BackupWindow(self.root, menubar)
-        if settings.settings["Host"] == "socket.gaierror":
-            messagebox.showerror(
-                title="getaddrinfo failed",
-                message="Failed to get the server's IP",
-                detail="Please check if the server exists",
-            )
+import settings
 
-        if settings.settings["Host"] == "no hostname":
-            messagebox.showerror(
-                title="No hostname in settings",
-                message="No hostname listed in settings",
-                detail="Please enter a hostname into settings",
-            )
 
-        # TODO: Let them type in their username instead of just the error message
-        if settings.settings["Username"] == "no username":
-            messagebox.showerror(
-                title="No username in settings",
-                message="No username listed in settings",
-                detail="Please enter a username into settings",
-            )
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--headless", action="store_true", help="Back up without opening a window"
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="With --headless, also back up deselected items",
+    )
+    parser.add_argument(
+        "--timings", action="store_true", help="Print how long startup takes"
+    )
+    args = parser.parse_args()
+    startup_timing.enabled = args.timings
 
-        # TODO: Check if any setting var is missing and set it up
+    settings.load()
+    startup_timing.mark("Settings loaded")
+    if args.headless:
+        from HeadlessBackup import HeadlessBackup
 
-    def run(self):
-        self.root.mainloop()
+        return HeadlessBackup().run(backup_all=args.all)
 
+    from ClientWindow import ClientWindow
 
-def main():
-    settings.load()
     client_win = ClientWindow()
     client_win.run()
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
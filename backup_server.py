@@ -1,63 +1,299 @@
+import concurrent.futures
 import json
 import pathlib
 import platform
 import socket
+import threading
 
-import socket_io as sio
+from BackupSocket import (
+    MESSAGE_RESPONSE,
+    BackupSocket,
+    RecievingError,
+    Request,
+    SendingError,
+    make_request,
+)
+from ChunkStore import ChunkStore
+from Compression import negotiate
+from ConfigStore import CONFIG_DIR, ConfigStore
+from NativeTransfer import TransferHandler
+from SnapshotStore import SnapshotStore
 
+PORT = 9999
+MAX_WORKERS = 32
+"""Amount of clients that are served at the same time"""
+MAX_PENDING = 64
+"""
+Amount of accepted clients that can wait for a free worker
+Once this is full the server stops accepting until a worker is free,
+leaving the rest of the clients in the listen backlog
+"""
+CONNECTION_TIMEOUT = 30
+"""Seconds a client can stay silent before it is disconnected"""
+SLOT_WAIT = 1
+"""Seconds between checks for shutdown while every slot is taken"""
+BACKUP_ROOT = pathlib.Path("~/Backups/").expanduser()
+"""Where rsync backs up to, one snapshot folder per run"""
+STORE_ROOT = pathlib.Path("~/BackupStore/").expanduser()
+"""Where the chunks and manifests of native backups are kept"""
 
-def main():
-    port = 9999
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    if platform.system() != "Windows":
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-    server.bind(("", port))
-    server.listen(1)  # TODO: Change when I add silmultaneous connections
+class BackupServer:
+    def __init__(
+        self,
+        address: tuple[str, int] = ("", PORT),
+        max_workers: int = MAX_WORKERS,
+        max_pending: int = MAX_PENDING,
+        timeout: float = CONNECTION_TIMEOUT,
+        config_dir: pathlib.Path | str = CONFIG_DIR,
+        store_root: pathlib.Path = STORE_ROOT,
+        backup_root: pathlib.Path = BACKUP_ROOT,
+    ):
+        self.timeout = timeout
+        self.running = False
+        self.configs = ConfigStore(config_dir)
+        self.chunks = ChunkStore(store_root / "chunks")
+        self.snapshots = {
+            "rsync": SnapshotStore(backup_root, kind="rsync"),
+            "native": SnapshotStore(store_root / "snapshots", kind="native"),
+        }
+        self.transfers = TransferHandler(self.chunks, self.snapshots["native"])
+
+        self.server = BackupSocket(socket_type="server")
+        if platform.system() != "Windows":
+            self.server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(address)
+        self.server.listen(max_pending)
+        self.address: tuple[str, int] = self.server.socket.getsockname()
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(max_workers + max_pending)
+
+    def serve_forever(self):
+        self.running = True
+
+        while self.running:
+            # Backpressure: don't accept anyone new until there's space for them
+            if not self.slots.acquire(timeout=SLOT_WAIT):
+                continue
+            if not self.running:
+                self.slots.release()
+                break
+
+            try:
+                client, client_address = self.server.accept()
+            except OSError:
+                # Listening socket was closed by shutdown()
+                self.slots.release()
+                break
+
+            client.settimeout(self.timeout)
+            future = self.executor.submit(self.handle_client, client, client_address)
+            future.add_done_callback(lambda _: self.slots.release())
+
+        return
+
+    def shutdown(self):
+        self.running = False
+        # close() also wakes up any worker blocked on recv
+        for client in list(self.server.client_list.values()):
+            client.close()
+        self.server.close()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.chunks.close()
+
+    def handle_client(self, client: BackupSocket, client_address):
+        # Kind, Username and name of the snapshots begun on this connection
+        began: set[tuple[str, str, str]] = set()
+        try:
+            while self.running:
+                try:
+                    request = client.recieve_prefix()
+                except (RecievingError, TimeoutError, ConnectionError):
+                    break
+                except ValueError:
+                    # Not JSON or not UTF-8, nothing can be replied to
+                    break
+
+                client.send_prefix(
+                    self.respond(request, client, began), MESSAGE_RESPONSE
+                )
+        except (SendingError, RecievingError, TimeoutError, ConnectionError):
+            pass
+        finally:
+            client.close()
+            self.server.client_list.pop(client_address, None)
 
-    while True:
-        client, client_address = server.accept()
-        command = sio.recv_delim(client, client_address)
+        return
+
+    def respond(
+        self, request: Request, client: BackupSocket, began: set[tuple[str, str, str]]
+    ):
+        try:
+            response = self.handle_request(request, client, began)
+            # Lets clients with several requests in flight match up responses
+            response["metadata"]["RequestID"] = request["metadata"].get("RequestID")
+        except (KeyError, ValueError, TypeError, AttributeError):
+            # Missing or mistyped fields, the connection itself is still fine
+            response = make_request(Status="BadRequest")
+            metadata = request.get("metadata") if isinstance(request, dict) else None
+            if isinstance(metadata, dict):
+                response["metadata"]["RequestID"] = metadata.get("RequestID")
+
+        return response
+
+    def handle_request(
+        self, request: Request, client: BackupSocket, began: set[tuple[str, str, str]]
+    ) -> Request:
+        command = request["metadata"].get("Command")
+
+        username = request["sender"]
 
         match command:
             case "RequestBackupConf":
-                msg = load_backup_conf()
-                sio.send(client, msg, type="delim")
+                config = self.configs.lookup(username)
+                if config.version != "" and config.version == request["metadata"].get(
+                    "IfNoneMatch"
+                ):
+                    return make_request(
+                        reciever=username, Status="NotModified", Version=config.version
+                    )
+                return make_request(
+                    config.contents,
+                    reciever=username,
+                    Status="OK",
+                    Version=config.version,
+                )
+            case "PatchBackupConf":
+                base_version = request["metadata"].get("BaseVersion") or ""
+                try:
+                    version = self.configs.patch(
+                        username, base_version, json.loads(request["body"])
+                    )
+                except ValueError:
+                    return make_request(reciever=username, Status="BadRequest")
+
+                if version is None:
+                    # The client falls back to sending the whole config
+                    return make_request(reciever=username, Status="Conflict")
+                return make_request(reciever=username, Status="OK", Version=version)
             case "UpdateBackupConf":
-                update_backup_conf(client, client_address[0])
-            case _:
-                pass
+                try:
+                    version = self.configs.put(username, request["body"])
+                except ValueError:
+                    return make_request(reciever=username, Status="BadRequest")
+                return make_request(reciever=username, Status="OK", Version=version)
+            case "NegotiateCompression":
+                codec = negotiate(request["metadata"].get("Codecs") or [])
+                # Replies are never compressed so the codec can be switched before this one
+                client.use_codec(codec)
+                return make_request(reciever=username, Status="OK", Codec=codec)
+            case "BeginSnapshot":
+                snapshots = self.snapshots.get(request["metadata"].get("Kind"))
+                if snapshots is None:
+                    return make_request(reciever=username, Status="BadRequest")
 
-        client.shutdown(socket.SHUT_RDWR)
-        client.close()
+                # rsync changes attributes in place, which would reach every
+                # older snapshot through the links, so it uses --link-dest
+                clone = (
+                    bool(request["metadata"].get("Clone")) and snapshots.kind != "rsync"
+                )
+                name, previous, cloned = snapshots.begin(
+                    username,
+                    clone=clone,
+                    selection=str(request["metadata"].get("Selection", "")),
+                )
+                began.add((snapshots.kind, username, name))
+                previous_path = ""
+                if previous != "":
+                    previous_path = home_relative(snapshots.path_of(username, previous))
+                return make_request(
+                    reciever=username,
+                    Status="OK",
+                    Snapshot=name,
+                    Previous=previous,
+                    Cloned=cloned,
+                    Path=home_relative(snapshots.path_of(username, name)),
+                    PreviousPath=previous_path,
+                )
+            case "RemovePaths":
+                snapshots = self.snapshots.get(request["metadata"].get("Kind"))
+                # Only a snapshot this connection is still writing can lose files
+                snapshot = request["metadata"]["Snapshot"]
+                if (
+                    snapshots is None
+                    or (snapshots.kind, username, snapshot) not in began
+                ):
+                    return make_request(reciever=username, Status="BadRequest")
 
-    return
+                try:
+                    snapshots.remove(
+                        username,
+                        snapshot,
+                        json.loads(request["body"]),
+                    )
+                except (json.JSONDecodeError, ValueError):
+                    return make_request(reciever=username, Status="BadRequest")
+                body = ""
+            case "LinkPaths":
+                snapshots = self.snapshots.get(request["metadata"].get("Kind"))
+                snapshot = request["metadata"]["Snapshot"]
+                if (
+                    snapshots is None
+                    or (snapshots.kind, username, snapshot) not in began
+                ):
+                    return make_request(reciever=username, Status="BadRequest")
 
+                try:
+                    snapshots.link_previous(
+                        username,
+                        snapshot,
+                        json.loads(request["body"]),
+                    )
+                except (json.JSONDecodeError, ValueError):
+                    return make_request(reciever=username, Status="BadRequest")
+                body = ""
+            case "EndSnapshot":
+                snapshots = self.snapshots.get(request["metadata"].get("Kind"))
+                if snapshots is None:
+                    return make_request(reciever=username, Status="BadRequest")
 
-def load_backup_conf():
-    if pathlib.Path("backup.json").exists():
-        backup_json = open("backup.json", mode="r")
-    else:
-        backup_json = open("backup_json", mode="x")
-    backup_json.close()
+                if request["metadata"].get("Kind") == "native":
+                    # Every chunk the snapshot's manifests point at has to be durable
+                    self.chunks.commit()
+                snapshots.complete(
+                    username,
+                    request["metadata"]["Snapshot"],
+                    completed=bool(request["metadata"].get("Completed")),
+                )
+                body = ""
+            case "FileStatus" | "PatchFile":
+                return self.transfers.handle_request(request, client)
+            case _:
+                return make_request(reciever=username, Status="UnknownCommand")
 
-    backup_conf = ""
-    with open("backup.json", mode="r") as backup_json:
-        backup_conf = "".join([line for line in backup_json])
+        return make_request(body, reciever=username, Status="OK")
 
-    return backup_conf
 
+# Paths under the home folder are sent as ~/... since that's where rsync's
+# ssh session starts, whatever the home folder is called on this machine
+def home_relative(path: pathlib.Path):
+    try:
+        return f"~/{path.relative_to(pathlib.Path.home()).as_posix()}/"
+    except ValueError:
+        return f"{path.as_posix()}/"
 
-def update_backup_conf(client: socket.socket, client_ip: str):
-    json_string = sio.recv_delim(client, client_ip)
-    backup_conf = json.loads(json_string)
 
-    with open("backup.json", mode="w") as backup_json:
-        json.dump(backup_conf, backup_json)
+def main():
+    server = BackupServer()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
 
     return
 
 
 if __name__ == "__main__":
     main()
-
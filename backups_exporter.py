@@ -1,24 +1,499 @@
 """
 A program to export backups created by Backup-inator
 This is only meant to be used on the device running backup_server.py
+
+The latest completed snapshot of every user (or the ones picked with --user
+and --snapshot) is copied into DEST/Username/Snapshot/ by several workers at
+once, or streamed into a tar archive with --tar. An interrupted copy picks
+up where it stopped when the same command is run again
 """
 
+import argparse
+import bz2
+import concurrent.futures
+import errno
+import gzip
+import io
+import json
+import lzma
+import os
 import pathlib
+import stat
 import sys
+import tarfile
+import threading
+import time
+from typing import BinaryIO, Iterator
+
+import misc_tools as tools
+from backup_server import BACKUP_ROOT, STORE_ROOT
+from ChunkStore import ChunkStore
+from NativeTransfer import restore_file
+from SnapshotStore import SnapshotStore
+
+COPY_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+COPY_SIZE = 8 * 1024 * 1024
+"""Most bytes moved by one copy_file_range/sendfile/read call"""
+PART_SUFFIX = ".part"
+"""Files are copied under this suffix and renamed once they're whole"""
+COMPRESSORS = {
+    "gz": lambda file: gzip.GzipFile(fileobj=file, mode="wb", compresslevel=6),
+    "bz2": lambda file: bz2.BZ2File(file, mode="wb", compresslevel=9),
+    "xz": lambda file: lzma.LZMAFile(file, mode="wb", preset=6),
+}
+# Errors that mean the fast path isn't available for these files, not that
+# the copy failed
+UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+
+
+class ExportStats:
+    def __init__(self):
+        self.files = 0
+        self.skipped = 0
+        """Files a previous export already finished"""
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self.finished = self.started
+        self.lock = threading.Lock()
+
+    def add(self, size: int, skipped: bool = False):
+        with self.lock:
+            self.files += 1
+            self.skipped += skipped
+            self.bytes += size
+
+    def elapsed(self):
+        return max(self.finished - self.started, 1e-9)
+
+    def summary(self):
+        size = tools.human_readable_file_size(self.bytes)
+        mb_per_second = self.bytes / 1_000_000 / self.elapsed()
+        files_per_second = self.files / self.elapsed()
+        summary = (
+            f"Exported {self.files} files ({size}) in {self.elapsed():.1f}s: "
+            f"{mb_per_second:.1f} MB/s, {files_per_second:.0f} files/s"
+        )
+        if self.skipped > 0:
+            summary += f" ({self.skipped} already exported)"
+
+        return summary
+
+
+class ManifestReader(io.RawIOBase):
+    """
+    Reads a natively backed up file straight out of the ChunkStore
+    """
+
+    def __init__(self, store: ChunkStore, manifest: dict):
+        self.store = store
+        self.chunks = iter(manifest["Chunks"])
+        self.current = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self.current) == 0:
+            try:
+                digest, _ = next(self.chunks)
+            except StopIteration:
+                return 0
+            self.current = memoryview(self.store.get(bytes.fromhex(digest)))
+
+        length = min(len(buffer), len(self.current))
+        buffer[:length] = self.current[:length]
+        self.current = self.current[length:]
+        return length
+
+
+class ArchiveWriter:
+    """
+    Lets tarfile write to a pipe in its normal mode, which only ever asks
+    where it is. Its stream mode copies its whole buffer on every write
+    """
+
+    def __init__(self, output: BinaryIO):
+        self.output = output
+        self.position = 0
+
+    def write(self, data: bytes):
+        self.output.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+
+def copy_range(source_fd: int, destination_fd: int, offset: int, size: int):
+    """
+    Copies source[offset:size] to the same place in destination
+    Returns how far it got, which is less than size if source shrank
+    """
+    # copy_file_range and sendfile keep the data inside the kernel, and
+    # copy_file_range can share blocks outright on filesystems with reflinks
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < size:
+                count = min(COPY_SIZE, size - offset)
+                copied = os.copy_file_range(
+                    source_fd, destination_fd, count, offset, offset
+                )
+                if copied == 0:
+                    return offset
+                offset += copied
+            return offset
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+
+    os.lseek(destination_fd, offset, os.SEEK_SET)
+    if sys.platform == "linux":
+        try:
+            while offset < size:
+                count = min(COPY_SIZE, size - offset)
+                copied = os.sendfile(destination_fd, source_fd, offset, count)
+                if copied == 0:
+                    return offset
+                offset += copied
+            return offset
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+
+    os.lseek(source_fd, offset, os.SEEK_SET)
+    os.lseek(destination_fd, offset, os.SEEK_SET)
+    while offset < size:
+        data = os.read(source_fd, min(COPY_SIZE, size - offset))
+        if data == b"":
+            return offset
+
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(destination_fd, view) :]
+        offset += len(data)
+
+    return offset
+
+
+def already_exported(destination: pathlib.Path, size: int, mtime_ns: int):
+    try:
+        exported = destination.stat()
+    except FileNotFoundError:
+        return False
+
+    # Compared to the second like rsync as not every filesystem keeps ns
+    same_mtime = exported.st_mtime_ns // 10**9 == mtime_ns // 10**9
+    return exported.st_size == size and same_mtime
+
+
+def copy_file(
+    source: pathlib.Path, destination: pathlib.Path, source_stat, resume: bool
+):
+    """
+    Copies source to destination and returns how many bytes that took
+    With resume what an interrupted export left in destination.part is kept.
+    That's only safe for completed snapshots since they don't change anymore
+    """
+    part = destination.with_name(f"{destination.name}{PART_SUFFIX}")
+    flags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+    if not resume:
+        flags |= os.O_TRUNC
+    source_fd = os.open(source, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        part_fd = os.open(part, flags, 0o600)
+        try:
+            offset = min(os.fstat(part_fd).st_size, source_stat.st_size)
+            copied_to = copy_range(source_fd, part_fd, offset, source_stat.st_size)
+            os.ftruncate(part_fd, copied_to)
+            # Through the fd where possible to skip looking up part again
+            target = part_fd if os.utime in os.supports_fd else part
+            os.chmod(target, stat.S_IMODE(source_stat.st_mode))
+            os.utime(target, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        finally:
+            os.close(part_fd)
+    finally:
+        os.close(source_fd)
+
+    os.replace(part, destination)
+
+    return copied_to - offset
+
+
+def restore_native(store: ChunkStore, manifest_path: pathlib.Path, destination):
+    manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    if already_exported(destination, manifest["Size"], manifest["MTime"]):
+        return 0
+
+    part = destination.with_name(f"{destination.name}{PART_SUFFIX}")
+    restore_file(store, manifest, part)
+    os.replace(part, destination)
+    return manifest["Size"]
+
+
+def pick_snapshots(
+    snapshots: SnapshotStore, username: str = "", snapshot: str = ""
+) -> list[tuple[str, str, pathlib.Path, bool]]:
+    """
+    Returns the Username, name and folder of every snapshot to export and
+    whether it's completed
+    """
+    picked = []
+    every_user = snapshots.list_all()
+    users = [username] if username != "" else list(every_user)
+    for user in users:
+        name = snapshot or snapshots.latest(user)
+        if name == "":
+            print(f"{user} has no completed snapshots", file=sys.stderr)
+            continue
+        entry = next((e for e in every_user.get(user, []) if e["Name"] == name), None)
+        if entry is None:
+            print(f"{user} has no snapshot named {name}", file=sys.stderr)
+            continue
+        picked.append((user, name, snapshots.path_of(user, name), entry["Completed"]))
+
+    legacy = every_user == {} and username == "" and snapshot == ""
+    if legacy and snapshots.kind == "rsync":
+        # Backups made before snapshots went straight into the backup root
+        # and can still be written to by a running backup
+        picked.append(("", "", snapshots.root, False))
+
+    return picked
+
+
+def walk(root: pathlib.Path) -> Iterator[tuple[pathlib.Path, str, os.stat_result]]:
+    """
+    Yields every file, symlink and empty folder under root with its path
+    relative to root
+    """
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        relative_dir = pathlib.Path(dir_path).relative_to(root)
+        if dir_names == [] and file_names == [] and relative_dir.parts != ():
+            yield pathlib.Path(dir_path), relative_dir.as_posix(), os.lstat(dir_path)
+
+        # os.walk lists symlinks to folders as folders but doesn't go into them
+        links = [name for name in dir_names if os.path.islink(f"{dir_path}/{name}")]
+        for file_name in sorted(file_names + links):
+            path = pathlib.Path(dir_path, file_name)
+            if file_name.endswith(PART_SUFFIX):
+                continue
+            file_stat = path.lstat()
+            if stat.S_ISREG(file_stat.st_mode) or stat.S_ISLNK(file_stat.st_mode):
+                yield path, (relative_dir / file_name).as_posix(), file_stat
+
+
+def export_to_dir(
+    picked: list[tuple[str, str, pathlib.Path, bool]],
+    dest: pathlib.Path,
+    store: ChunkStore | None,
+    workers: int = COPY_WORKERS,
+):
+    stats = ExportStats()
+    in_flight: set[concurrent.futures.Future] = set()
+
+    def finish(done: set[concurrent.futures.Future]):
+        for future in done:
+            # Raises whatever went wrong copying that file
+            future.result()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for username, name, snapshot_dir, completed in picked:
+            export_dir = dest.joinpath(*[part for part in (username, name) if part])
+            made_dir = None
+            for path, relative_path, file_stat in walk(snapshot_dir):
+                destination = export_dir / relative_path
+                # walk() goes one folder at a time
+                if destination.parent != made_dir:
+                    destination.parent.mkdir(parents=True, exist_ok=True)
+                    made_dir = destination.parent
+                in_flight.add(
+                    executor.submit(
+                        export_file,
+                        store,
+                        path,
+                        destination,
+                        file_stat,
+                        stats,
+                        completed,
+                    )
+                )
+
+                # Walking is far quicker than copying so don't queue every file
+                if len(in_flight) >= workers * 4:
+                    done, in_flight = concurrent.futures.wait(
+                        in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    finish(done)
+
+        finish(concurrent.futures.wait(in_flight).done)
+
+    stats.finished = time.perf_counter()
+    return stats
+
+
+def export_file(
+    store: ChunkStore | None,
+    source: pathlib.Path,
+    destination: pathlib.Path,
+    source_stat: os.stat_result,
+    stats: ExportStats,
+    resume: bool = False,
+):
+    if stat.S_ISDIR(source_stat.st_mode):
+        destination.mkdir(exist_ok=True)
+        return
+    if stat.S_ISLNK(source_stat.st_mode):
+        stats.add(0, skipped=not export_symlink(source, destination))
+        return
+
+    if store is not None:
+        copied = restore_native(store, source, destination)
+        stats.add(copied, skipped=copied == 0)
+        return
+
+    if already_exported(destination, source_stat.st_size, source_stat.st_mtime_ns):
+        stats.add(0, skipped=True)
+        return
+
+    stats.add(copy_file(source, destination, source_stat, resume))
+
+
+def export_symlink(source: pathlib.Path, destination: pathlib.Path):
+    """
+    Makes destination a symlink to where source points, returning False if
+    it already was one
+    """
+    target = os.readlink(source)
+    if destination.is_symlink():
+        if os.readlink(destination) == target:
+            return False
+        destination.unlink()
+
+    os.symlink(target, destination)
+    return True
+
+
+def export_to_tar(
+    picked: list[tuple[str, str, pathlib.Path, bool]],
+    output: BinaryIO,
+    store: ChunkStore | None,
+    compression: str = "",
+):
+    """
+    Streams the snapshots into a tar archive without ever seeking output
+    Archives are written in one pass so they can't be resumed
+    """
+    stats = ExportStats()
+    compressed = COMPRESSORS[compression](output) if compression else output
+
+    writer = ArchiveWriter(compressed)
+    with tarfile.open(fileobj=writer, mode="w", copybufsize=COPY_SIZE) as tar:
+        for username, name, snapshot_dir, _ in picked:
+            prefix = "/".join(part for part in (username, name) if part)
+            for path, relative_path, file_stat in walk(snapshot_dir):
+                arcname = f"{prefix}/{relative_path}" if prefix else relative_path
+                if stat.S_ISLNK(file_stat.st_mode):
+                    info = tarfile.TarInfo(arcname)
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = os.readlink(path)
+                    info.mtime = int(file_stat.st_mtime)
+                    info.mode = stat.S_IMODE(file_stat.st_mode)
+                    tar.addfile(info)
+                    stats.add(0)
+                    continue
+                if stat.S_ISDIR(file_stat.st_mode):
+                    tar.add(path, arcname=arcname, recursive=False)
+                    continue
+                if store is None:
+                    tar.add(path, arcname=arcname, recursive=False)
+                    stats.add(file_stat.st_size)
+                    continue
+
+                manifest = json.loads(path.read_text(encoding="utf-8"))
+                info = tarfile.TarInfo(arcname)
+                info.size = manifest["Size"]
+                info.mtime = manifest["MTime"] // 10**9
+                info.mode = 0o644
+                tar.addfile(info, io.BufferedReader(ManifestReader(store, manifest)))
+                stats.add(info.size)
+
+    if compressed is not output:
+        compressed.close()
+    output.flush()
+
+    stats.finished = time.perf_counter()
+    return stats
+
+
+def main(
+    dest: pathlib.Path,
+    kind: str = "rsync",
+    username: str = "",
+    snapshot: str = "",
+    tar: bool = False,
+    compression: str = "",
+    workers: int = COPY_WORKERS,
+):
+    store = None
+    if kind == "native":
+        snapshots = SnapshotStore(STORE_ROOT / "snapshots", kind="native")
+        # The server might be writing to it at the same time
+        store = ChunkStore(STORE_ROOT / "chunks", read_only=True)
+    else:
+        snapshots = SnapshotStore(BACKUP_ROOT, kind="rsync")
 
+    picked = pick_snapshots(snapshots, username, snapshot)
+    if picked == []:
+        print("Nothing to export", file=sys.stderr)
+        return 1
 
-def main(dest: pathlib.Path):
-    backup_src = pathlib.Path("~/Backup/").resolve()
+    try:
+        if not tar:
+            stats = export_to_dir(picked, dest, store, workers)
+        elif dest.as_posix() == "-":
+            stats = export_to_tar(picked, sys.stdout.buffer, store, compression)
+        else:
+            with open(dest, mode="wb") as output:
+                stats = export_to_tar(picked, output, store, compression)
+    finally:
+        if store is not None:
+            store.close()
 
+    # stdout might be the archive
+    print(stats.summary(), file=sys.stderr)
     return 0
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("USAGE: backups_exporter.py [FULL DESTINATION PATH]")
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "dest",
+        type=pathlib.Path,
+        help="Folder to export into, or the archive to write with --tar (- for stdout)",
+    )
+    parser.add_argument("--kind", choices=["rsync", "native"], default="rsync")
+    parser.add_argument("--user", default="", help="Only export this user's backups")
+    parser.add_argument(
+        "--snapshot", default="", help="Snapshot to export instead of the latest"
+    )
+    parser.add_argument("--tar", action="store_true", help="Stream a tar archive")
+    parser.add_argument("--compress", choices=list(COMPRESSORS), default="")
+    parser.add_argument("--workers", type=int, default=COPY_WORKERS)
+    args = parser.parse_args()
 
-    dest = pathlib.Path(sys.argv[1].strip())
-    if not dest.exists():
-        print(f"{dest} does not exist!")
+    if not args.tar and not args.dest.exists():
+        print(f"{args.dest} does not exist!")
+        sys.exit(1)
 
-    main(dest)
+    sys.exit(
+        main(
+            args.dest,
+            kind=args.kind,
+            username=args.user,
+            snapshot=args.snapshot,
+            tar=args.tar,
+            compression=args.compress,
+            workers=args.workers,
+        )
+    )
@@ -0,0 +1,370 @@
+"""
+Benchmarks for Backup-inator
+Everything runs over loopback or in a temporary directory so it is safe to run anywhere
+
+USAGE: benchmarks.py [BENCHMARK]
+"""
+
+import os
+import pathlib
+import sys
+import tempfile
+import threading
+import time
+
+from BackupSocket import BackupSocket, make_request
+
+
+def percentile(samples: list[float], percent: float):
+    if samples == []:
+        return 0.0
+
+    ordered = sorted(samples)
+    index = round((len(ordered) - 1) * percent / 100)
+    return ordered[index]
+
+
+def bench_server(client_counts=(1, 4, 16, 64), requests_per_client=100):
+    import backup_server
+
+    workdir = tempfile.TemporaryDirectory()
+    os.chdir(workdir.name)
+    server = backup_server.BackupServer(
+        address=("127.0.0.1", 0), store_root=pathlib.Path("BackupStore")
+    )
+    server.configs.put("bench", '{"BackupDirectories": []}')
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    def simulated_client(latencies: list[float]):
+        for _ in range(requests_per_client):
+            start = time.perf_counter()
+            client = BackupSocket()
+            client.connect(server.address)
+            client.send_prefix(
+                make_request(sender="bench", Command="RequestBackupConf")
+            )
+            client.recieve_prefix()
+            client.close()
+            latencies.append(time.perf_counter() - start)
+
+    print(f"{'clients':>8} {'req/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for client_count in client_counts:
+        latencies: list[float] = []
+        clients = [
+            threading.Thread(target=simulated_client, args=(latencies,))
+            for _ in range(client_count)
+        ]
+
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.perf_counter() - start
+
+        requests_per_sec = len(latencies) / elapsed
+        p50 = percentile(latencies, 50) * 1000
+        p99 = percentile(latencies, 99) * 1000
+        print(f"{client_count:>8} {requests_per_sec:>10.0f} {p50:>8.2f} {p99:>8.2f}")
+
+    server.shutdown()
+    os.chdir(pathlib.Path(__file__).parent)
+    workdir.cleanup()
+
+
+def bench_recieve(frame_sizes_mb=(1, 4, 16), frames=8):
+    server = BackupSocket(socket_type="server")
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+
+    sender = BackupSocket()
+    sender.connect(server.socket.getsockname())
+    reciever, _ = server.accept()
+
+    print(f"{'frame MB':>8} {'MB/s':>10} {'ms/frame':>10}")
+    for size_mb in frame_sizes_mb:
+        request = make_request("x" * (size_mb * 1_000_000))
+
+        def send_frames():
+            for _ in range(frames):
+                sender.send_delim(request)
+
+        sending_thread = threading.Thread(target=send_frames)
+        start = time.perf_counter()
+        sending_thread.start()
+        for _ in range(frames):
+            reciever.recieve_delim()
+        elapsed = time.perf_counter() - start
+        sending_thread.join()
+
+        throughput = size_mb * frames / elapsed
+        print(f"{size_mb:>8} {throughput:>10.1f} {elapsed / frames * 1000:>10.2f}")
+
+    sender.close()
+    reciever.close()
+    server.close()
+
+
+def bench_framing(body_sizes=(64, 1024, 65536), messages=20000):
+    import json
+    import socket
+
+    from BackupSocket import FRAME_HEADER, MESSAGE_DATA
+
+    sending_end, recieving_end = socket.socketpair()
+    sender = BackupSocket(init_socket=False)
+    sender.socket = sending_end
+    reciever = BackupSocket(init_socket=False)
+    reciever.socket = recieving_end
+
+    def delim_round(request):
+        sender.send_delim(request)
+        reciever.recieve_delim()
+
+    def prefix_round(request):
+        sender.send_prefix(request)
+        reciever.recieve_prefix()
+
+    def raw_round(request):
+        sender.send_frame(MESSAGE_DATA, request["body"].encode())
+        reciever.recieve_frame()
+
+    print(f"{'body B':>8} {'path':>7} {'overhead B':>11} {'us/msg':>8}")
+    for body_size in body_sizes:
+        request = make_request("x" * body_size, sender="bench", Command="Bench")
+        json_length = len(json.dumps(request).encode())
+        overheads = {
+            "delim": json_length + 1 - body_size,
+            "prefix": json_length + FRAME_HEADER.size - body_size,
+            "raw": FRAME_HEADER.size,
+        }
+
+        for path, one_round in (
+            ("delim", delim_round),
+            ("prefix", prefix_round),
+            ("raw", raw_round),
+        ):
+            start = time.perf_counter()
+            for _ in range(messages):
+                one_round(request)
+            elapsed = time.perf_counter() - start
+
+            micro_secs = elapsed / messages * 1_000_000
+            print(f"{body_size:>8} {path:>7} {overheads[path]:>11} {micro_secs:>8.2f}")
+
+    sender.close()
+    reciever.close()
+
+
+def bench_native(file_count=16, file_size_mb=4):
+    import backup_server
+    import NativeTransfer
+
+    workdir = tempfile.TemporaryDirectory()
+    source = pathlib.Path(workdir.name) / "source"
+    source.mkdir()
+    for index in range(file_count):
+        (source / f"file{index}.bin").write_bytes(os.urandom(file_size_mb * 1_000_000))
+
+    with open(source / "file0.bin", mode="rb") as file:
+        start = time.perf_counter()
+        chunks = list(NativeTransfer.iter_chunks(file))
+        elapsed = time.perf_counter() - start
+    print(f"chunking: {file_size_mb / elapsed:.1f} MB/s, {len(chunks)} chunks")
+
+    server = backup_server.BackupServer(
+        address=("127.0.0.1", 0),
+        config_dir=pathlib.Path(workdir.name) / "BackupConfs",
+        store_root=pathlib.Path(workdir.name) / "BackupStore",
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def run(label: str):
+        client = NativeTransfer.NativeBackupClient(server.address, "bench")
+        stats = client.backup([source.as_posix()], [])
+        client.close()
+        print(f"{label:>14}: {stats.summary()}")
+
+    run("first backup")
+    run("unchanged")
+
+    # Inserting bytes shifts everything after them, which is what
+    # content defined chunking is meant to cope with
+    edited = source / "file0.bin"
+    contents = edited.read_bytes()
+    middle = len(contents) // 2
+    edited.write_bytes(contents[:middle] + b"inserted" + contents[middle:])
+    run("one file edit")
+
+    # A second client backing up the same files shouldn't store anything new
+    client = NativeTransfer.NativeBackupClient(server.address, "bench2")
+    stats = client.backup([source.as_posix()], [])
+    client.close()
+    print(f"{'other client':>14}: {stats.summary()}")
+    print(f"dedup ratio: {server.chunks.dedup_ratio():.2f}")
+
+    server.shutdown()
+    workdir.cleanup()
+
+
+def bench_chunk_store(chunk_counts=(10_000, 1_000_000), lookups=100_000):
+    import random
+
+    from ChunkStore import ChunkStore
+
+    print(
+        f"{'chunks':>10} {'index MB':>9} {'hit p50':>8} {'hit p99':>8} {'miss p99':>9} us"
+    )
+    for chunk_count in chunk_counts:
+        workdir = tempfile.TemporaryDirectory()
+        store = ChunkStore(pathlib.Path(workdir.name))
+
+        digests = sorted(os.urandom(32) for _ in range(chunk_count))
+        store.write_index([(digest, 0, 0, 0) for digest in digests])
+        index_size = store.index_path.stat().st_size / 1_000_000
+
+        def time_lookups(targets: list[bytes]):
+            latencies = []
+            for digest in targets:
+                start = time.perf_counter()
+                store.lookup(digest)
+                latencies.append(time.perf_counter() - start)
+            return latencies
+
+        hits = time_lookups(random.choices(digests, k=lookups))
+        misses = time_lookups([os.urandom(32) for _ in range(lookups)])
+        print(
+            f"{chunk_count:>10} {index_size:>9.1f} "
+            f"{percentile(hits, 50) * 1e6:>8.2f} {percentile(hits, 99) * 1e6:>8.2f} "
+            f"{percentile(misses, 99) * 1e6:>9.2f}"
+        )
+
+        store.close()
+        workdir.cleanup()
+
+
+def bench_export(file_counts=(16, 10_000), total_mb=256):
+    import backups_exporter
+    from SnapshotStore import SnapshotStore
+
+    for file_count in file_counts:
+        workdir = tempfile.TemporaryDirectory()
+        snapshots = SnapshotStore(pathlib.Path(workdir.name) / "Backups", "rsync")
+        name, _, _ = snapshots.begin("bench")
+        snapshot_dir = snapshots.path_of("bench", name)
+        file_size = total_mb * 1_000_000 // file_count
+        for index in range(file_count):
+            (snapshot_dir / f"file{index}.bin").write_bytes(os.urandom(file_size))
+        snapshots.complete("bench", name)
+        picked = backups_exporter.pick_snapshots(snapshots)
+
+        for workers in (1, backups_exporter.COPY_WORKERS):
+            dest = pathlib.Path(workdir.name) / f"export{workers}"
+            stats = backups_exporter.export_to_dir(picked, dest, None, workers)
+            print(f"{file_count:>6} files, {workers:>2} workers: {stats.summary()}")
+
+        with open(pathlib.Path(workdir.name) / "export.tar", mode="wb") as output:
+            stats = backups_exporter.export_to_tar(picked, output, None)
+        print(f"{file_count:>6} files, tar: {stats.summary()}")
+
+        workdir.cleanup()
+
+
+def make_tree(root: pathlib.Path, file_count: int, fanout: int = 10, per_dir=100):
+    """
+    Makes file_count small files spread over folders fanout wide
+    """
+    made = 0
+    dirs = [root]
+    while made < file_count:
+        parent = dirs.pop(0)
+        for index in range(min(per_dir, file_count - made)):
+            (parent / f"file{index}").write_bytes(b"x" * (index % 512))
+        made += min(per_dir, file_count - made)
+        for index in range(fanout):
+            child = parent / f"dir{index}"
+            child.mkdir()
+            dirs.append(child)
+
+
+def bench_scan(file_counts=(10_000, 1_000_000), legacy_up_to=10_000):
+    from FileScanner import FileScanner, scan
+    from ScanIndex import ScanIndex
+
+    for file_count in file_counts:
+        workdir = tempfile.TemporaryDirectory()
+        root = pathlib.Path(workdir.name)
+        make_tree(root, file_count)
+
+        start = time.perf_counter()
+        node = scan(root)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{file_count:>8} files: scan {elapsed:.2f}s "
+            f"({node.count / elapsed:.0f} entries/s, {node.size} B)"
+        )
+
+        # Backdated so the index doesn't treat the new folders as racy
+        for folder in node.descendants(root):
+            os.utime(folder, (time.time() - 60, time.time() - 60))
+        os.utime(root, (time.time() - 60, time.time() - 60))
+        index = ScanIndex(pathlib.Path(workdir.name + ".sqlite3"))
+        for label in ("index cold", "index warm"):
+            start = time.perf_counter()
+            index.scan(root)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{'':>15}{label} {elapsed:.2f}s, "
+                f"listed {index.folders_scanned} folders from disk"
+            )
+        index.close()
+        pathlib.Path(workdir.name + ".sqlite3").unlink()
+
+        # What DirectoryView does: the size of every folder in the tree
+        folders = [path for path in node.descendants(root) if path.is_dir()]
+        scanner = FileScanner()
+        scanner.scan(root)
+        start = time.perf_counter()
+        for folder in folders:
+            scanner.lookup(folder).size
+        elapsed = time.perf_counter() - start
+        print(f"{'':>15}{len(folders)} folder sizes from the scan {elapsed:.2f}s")
+
+        if file_count <= legacy_up_to:
+            # How sizes used to be worked out, walking the tree again per folder
+            start = time.perf_counter()
+            for folder in folders:
+                sum(f.stat().st_size for f in folder.glob("**/*") if f.is_file())
+            elapsed = time.perf_counter() - start
+            print(f"{'':>15}{len(folders)} folder sizes by glob {elapsed:.2f}s")
+
+        workdir.cleanup()
+
+
+BENCHMARKS = {
+    "server": bench_server,
+    "recieve": bench_recieve,
+    "framing": bench_framing,
+    "native": bench_native,
+    "chunkstore": bench_chunk_store,
+    "export": bench_export,
+    "scan": bench_scan,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"USAGE: benchmarks.py [{' | '.join(BENCHMARKS)}]")
+            return 1
+
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
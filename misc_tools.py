@@ -5,11 +5,15 @@ too specific to be in their own standalone file
 
 import concurrent.futures
 import datetime
+import heapq
 import math
+import os
 import pathlib
 import platform
-from tkinter import *
-from typing import Literal
+import tempfile
+from typing import Callable, Literal
+
+from FileScanner import ScanNode, scan
 
 
 def non_blocking_executor_shutdown(
@@ -63,6 +67,67 @@ def pretty_path(path: pathlib.Path):
     return pretty_str
 
 
+# Writes to a temporary file next to path and renames it over path so that
+# readers only ever see the old or the new contents, never a half written file
+def atomic_write(path: pathlib.Path, contents: str):
+    temp_fd, temp_path = tempfile.mkstemp(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(temp_fd, mode="w", encoding="utf-8") as temp_file:
+            temp_file.write(contents)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        pathlib.Path(temp_path).unlink(missing_ok=True)
+        raise
+
+
+BACKUP_CONF_LISTS = ("BackupDirectories", "DeselectedDirectories", "RemovedDirectories")
+
+
+# Works out which entries were added to or removed from each list in backup.json
+def diff_backup_conf(old: dict, new: dict):
+    patch = {"LastModified": new.get("LastModified"), "Added": {}, "Removed": {}}
+
+    for key in BACKUP_CONF_LISTS:
+        old_entries = old.get(key) or []
+        new_entries = new.get(key) or []
+        old_set = set(old_entries)
+        new_set = set(new_entries)
+
+        added = [entry for entry in new_entries if entry not in old_set]
+        removed = [entry for entry in old_entries if entry not in new_set]
+        if added != []:
+            patch["Added"][key] = added
+        if removed != []:
+            patch["Removed"][key] = removed
+
+    return patch
+
+
+def apply_backup_conf_patch(backup_conf: dict, patch: dict):
+    patched = dict(backup_conf)
+
+    for key in BACKUP_CONF_LISTS:
+        removed = set((patch.get("Removed") or {}).get(key) or [])
+        entries = [
+            entry for entry in backup_conf.get(key) or [] if entry not in removed
+        ]
+
+        present = set(entries)
+        entries.extend(
+            entry
+            for entry in (patch.get("Added") or {}).get(key) or []
+            if entry not in present
+        )
+        patched[key] = entries
+
+    patched["LastModified"] = patch.get("LastModified")
+    return patched
+
+
 def datetime_to_ISO8601(when: datetime.datetime):
     return when.strftime("%Y-%m-%dT%H:%M:%S")
 
@@ -88,22 +153,75 @@ def human_readable_file_size(size: int, unit: Literal["B", "iB"] = "B"):
 
 
 # Get all children files of path
+# These scan path again on every call, keep a FileScanner to reuse a scan
 def descendants_of(path: pathlib.Path):
-    return list(path.glob("**/*"))
+    node = scan(path)
+    return list(node.descendants(path)) if node is not None else []
 
 
-# Includes directories and files. Count includes itself
+# Includes directories and files. Count includes itself, even if it doesn't exist
 def how_many_files_in(dir: pathlib.Path):
-    if dir.is_file():
-        return 1
-
-    return len(descendants_of(dir)) + 1
+    node = scan(dir)
+    return node.count if node is not None else 1
 
 
 def size_of(file: pathlib.Path):
-    if file.is_dir():
-        return sum(f.stat().st_size for f in file.glob("**/*") if f.is_file())
-    elif file.is_file():
-        return file.stat().st_size
+    node = scan(file)
+    return node.size if node is not None else -1
 
-    return -1
+
+# Biggest first onto the lightest shard, never worse than 4/3 of the best split
+def shard_by_size(sizes: dict[str, int], shards: int):
+    heap = [(0, index, []) for index in range(shards)]
+    for path in sorted(sizes, key=lambda p: sizes[p], reverse=True):
+        total, index, shard = heapq.heappop(heap)
+        shard.append(path)
+        heapq.heappush(heap, (total + sizes[path], index, shard))
+
+    heap.sort(key=lambda entry: entry[1])
+    return [shard for _, _, shard in heap if shard != []]
+
+
+def shard_paths(
+    lookup: Callable[[pathlib.Path], ScanNode | None],
+    include_dirs: list[str],
+    streams: int,
+):
+    """
+    Splits include_dirs into at most streams lists of about the same size,
+    looking up sizes with lookup. Folders that are split are scanned again
+    so the lists cover everything in them as it is now
+    """
+    if streams <= 1:
+        return [include_dirs]
+
+    sizes = {}
+    for path in include_dirs:
+        node = lookup(pathlib.Path(path))
+        sizes[path] = node.size if node is not None else 0
+
+    # Folders bigger than a fair share are split into their children so
+    # one big folder doesn't end up in a single stream
+    fair_share = sum(sizes.values()) / streams
+    # A looked up tree can be out of date, and rsync would skip children
+    # that are new since and fail on ones that are gone
+    folders: list[tuple[str, ScanNode | None]] = [
+        (path, None) for path in sizes if sizes[path] > fair_share
+    ]
+    while folders != []:
+        folder, node = folders.pop()
+        if node is None:
+            node = scan(pathlib.Path(folder))
+        if node is None or not node.children:
+            continue
+
+        del sizes[folder]
+        for name, child in node.children.items():
+            path = (pathlib.Path(folder) / name).as_posix()
+            sizes[path] = child.size
+            if child.size > fair_share:
+                # Already scanned along with its parent
+                folders.append((path, child))
+
+    # An empty list still needs one rsync to finish the snapshot
+    return shard_by_size(sizes, streams) or [[]]
@@ -6,21 +6,29 @@ Includes:
 3. Loading different config files during runtime
 """
 
+import concurrent.futures
 import json
 import pathlib
-import socket
+
+from HostResolver import HostResolver
 
 settings: dict = {}
 """
 These settings will always be set and can be 
 retrieved safely by using settings["SETTING"]:
 1. Username
-2. Host
+2. Host (Hostname's address once host_lookup is done, if UseHostname)
 3. Port
 4. TimeoutLength
 5. RemoteUpdateInterval
 6. SSHPort
+7. TransferMode ("rsync" or "native")
+8. ParallelStreams (rsync processes a backup is split across)
+9. BandwidthLimit (KiB/s, 0 for no cap)
+10. BandwidthWindows (times of day with their own cap, see BandwidthScheduler)
 """
+host_lookup: concurrent.futures.Future | None = None
+"""Looks up Hostname in the background, Host is updated once it's done"""
 
 
 def load():
@@ -43,20 +51,63 @@ def load():
         hostname = settings.get("Hostname")
         if hostname is None:
             settings["Host"] = "no hostname"
-            hostname = ""
-
-        try:
-            settings["Host"] = socket.gethostbyname(hostname)
-        except socket.gaierror:
-            settings["Host"] = "socket.gaierror"
+        else:
+            resolve_host(hostname)
 
     settings["TimeoutLength"] = settings.get("TimeoutLength") or 300
-    settings["RemoteUpdateInterval"] = settings.get("TimeoutLength") or 5
+    settings["RemoteUpdateInterval"] = settings.get("RemoteUpdateInterval") or 5
     settings["SSHPort"] = settings.get("SSHPort") or 22
+    settings["TransferMode"] = settings.get("TransferMode") or "rsync"
+    settings["ParallelStreams"] = settings.get("ParallelStreams") or 1
+    settings["BandwidthLimit"] = settings.get("BandwidthLimit") or 0
+    settings["BandwidthWindows"] = settings.get("BandwidthWindows") or []
 
     return
 
 
+def resolve_host(hostname: str):
+    global host_lookup
+
+    # Connecting to the hostname itself works until the lookup is done, and
+    # a cached address skips DNS altogether
+    resolver = HostResolver()
+    cached = resolver.cached(hostname)
+    settings["Host"] = cached or hostname
+
+    # Only done once Host is updated, so whoever waits on it sees the address
+    done: concurrent.futures.Future[str] = concurrent.futures.Future()
+    host_lookup = done
+
+    def use_address(lookup: concurrent.futures.Future):
+        if lookup.exception() is None:
+            settings["Host"] = lookup.result()
+        elif cached is None:
+            settings["Host"] = "socket.gaierror"
+        done.set_result(settings["Host"])
+
+    resolver.lookup(hostname).add_done_callback(use_address)
+
+
+def read_backup_conf():
+    """Returns the contents of backup.json, or {} if it's empty or broken"""
+    try:
+        with open("backup.json", mode="r") as backup_json:
+            return json.load(backup_json)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def newest_backup_conf(local_backup_conf: dict, remote_backup_conf: dict):
+    """Picks whichever backup.json was modified last, the local one on a tie"""
+    remote_last_modified = remote_backup_conf.get("LastModified") or ""
+    local_last_modified = local_backup_conf.get("LastModified")
+
+    if local_last_modified is not None and local_last_modified >= remote_last_modified:
+        return local_backup_conf
+
+    return remote_backup_conf
+
+
 def save():
     with open("settings.json", mode="w") as settings_file:
         json.dump(settings, settings_file)
@@ -0,0 +1,23 @@
+"""
+Records how long the client takes to get through startup
+
+Each mark() is timed from when this module was imported, which
+backup_client.py does first. With --timings every mark is printed to stderr
+as it happens, so the time until the window responds shows as Interactive
+"""
+
+import sys
+import time
+
+STARTED = time.perf_counter()
+
+enabled = False
+marks: list[tuple[str, float]] = []
+"""What happened and the seconds since STARTED it happened at"""
+
+
+def mark(name: str):
+    elapsed = time.perf_counter() - STARTED
+    marks.append((name, elapsed))
+    if enabled:
+        print(f"[startup] {name}: {elapsed * 1000:.0f} ms", file=sys.stderr)
@@ -0,0 +1,114 @@
+import os
+import pathlib
+import tempfile
+import threading
+import time
+import unittest
+
+import backup_server
+from ChangeJournal import ChangeJournal
+from NativeTransfer import NativeBackupClient
+from SnapshotStore import parts_of
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        time.sleep(0.01)
+
+
+@unittest.skipUnless(ChangeJournal.available(), "needs inotify")
+class ChangeJournalTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.root = pathlib.Path(temp_dir.name).resolve()
+        self.server = backup_server.BackupServer(
+            address=("127.0.0.1", 0),
+            store_root=self.root / "store",
+            backup_root=self.root / "backups",
+        )
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.shutdown)
+        self.journal = ChangeJournal()
+        self.addCleanup(self.journal.close)
+
+        self.a = self.root / "src" / "a"
+        self.b = self.root / "src" / "b"
+        self.a.mkdir(parents=True)
+        (self.a / "f").write_text("f")
+
+    def watch(self, *roots: pathlib.Path):
+        self.journal.watch_only([root.as_posix() for root in roots])
+        wait_for(lambda: self.journal.pending == 0)
+
+    def backup(self, *roots: pathlib.Path, changes=None):
+        client = NativeBackupClient(self.server.address, "user")
+        try:
+            client.backup([root.as_posix() for root in roots], [], changes=changes)
+        finally:
+            client.close()
+
+    def latest_has(self, path: pathlib.Path):
+        snapshots = self.server.snapshots["native"]
+        latest = snapshots.latest("user")
+        snapshot_dir = snapshots.path_of("user", latest)
+        return snapshot_dir.joinpath(*parts_of(path.as_posix())).exists()
+
+    def test_root_added_after_start(self):
+        self.watch(self.a)
+        self.assertIsNone(self.journal.take([self.a.as_posix()], []))
+        self.backup(self.a)
+
+        self.b.mkdir()
+        (self.b / "g").write_text("g")
+        self.watch(self.a, self.b)
+        (self.a / "f").write_text("changed")
+        wait_for(lambda: (self.a / "f").as_posix() in self.journal.changed)
+
+        changes = self.journal.take([self.a.as_posix(), self.b.as_posix()], [])
+        self.assertIsNone(changes)
+        self.backup(self.a, self.b, changes=changes)
+        self.assertTrue(self.latest_has(self.b / "g"))
+
+    def test_server_clones_only_the_same_selection(self):
+        self.backup(self.a)
+        self.b.mkdir()
+        (self.b / "g").write_text("g")
+
+        # Even a client that asks for a clone gets a full backup
+        self.backup(self.a, self.b, changes=(set(), set()))
+        self.assertTrue(self.latest_has(self.b / "g"))
+        self.assertTrue(self.latest_has(self.a / "f"))
+
+    def test_take_keeps_other_roots(self):
+        self.b.mkdir()
+        self.watch(self.a, self.b)
+        roots = [self.a.as_posix(), self.b.as_posix()]
+        self.journal.take(roots, [])
+
+        (self.a / "f").write_text("changed")
+        (self.b / "g").write_text("g")
+        a_file, b_file = (self.a / "f").as_posix(), (self.b / "g").as_posix()
+        wait_for(lambda: {a_file, b_file} <= self.journal.changed)
+
+        self.journal.take([self.a.as_posix()], [])
+        self.assertEqual(self.journal.changed, {b_file})
+
+    def test_same_selection_uses_the_journal(self):
+        self.watch(self.a)
+        roots = [self.a.as_posix()]
+        self.journal.take(roots, [])
+
+        (self.a / "f").write_text("changed")
+        wait_for(lambda: (self.a / "f").as_posix() in self.journal.changed)
+        self.assertEqual(
+            self.journal.take(roots, []), ({(self.a / "f").as_posix()}, set())
+        )
+        self.assertIsNone(self.journal.take(roots, [os.path.join(roots[0], "x")]))
+
+
+if __name__ == "__main__":
+    unittest.main()
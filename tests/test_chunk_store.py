@@ -0,0 +1,121 @@
+import hashlib
+import io
+import os
+import pathlib
+import tempfile
+import unittest
+
+import ChunkStore
+from ChunkStore import INDEX_RECORD
+
+
+def chunk(data: bytes):
+    return hashlib.sha256(data).digest(), data
+
+
+class ChunkStoreTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.root = pathlib.Path(temp_dir.name)
+        self.chunks = dict(chunk(os.urandom(64)) for _ in range(1000))
+
+    def open(self, **kwargs):
+        store = ChunkStore.ChunkStore(self.root, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def put_all(self, store: ChunkStore.ChunkStore, chunks: dict[bytes, bytes]):
+        for digest, data in chunks.items():
+            self.assertTrue(store.put(digest, data))
+        store.commit()
+
+    def assert_stored(self, store: ChunkStore.ChunkStore, chunks: dict):
+        for digest, data in chunks.items():
+            self.assertEqual(store.get(digest), data)
+
+    def test_compact_merges_log_into_index(self):
+        store = self.open()
+        first = dict(list(self.chunks.items())[:600])
+        self.put_all(store, first)
+        store.compact()
+        self.assertEqual(store.index_count, 600)
+        self.assertEqual(store.recent, {})
+
+        # The second merge goes through the existing index as well
+        second = dict(list(self.chunks.items())[600:])
+        self.put_all(store, second)
+        store.compact()
+        self.assertEqual(store.index_count, 1000)
+        self.assert_stored(store, self.chunks)
+
+    def test_lookup_after_compaction(self):
+        store = self.open()
+        self.put_all(store, self.chunks)
+        store.compact()
+
+        for digest in self.chunks:
+            self.assertTrue(store.contains(digest))
+        # Digests next to stored ones in the fan-out and binary search
+        for digest in self.chunks:
+            missing = digest[:-1] + bytes([digest[-1] ^ 1])
+            if missing not in self.chunks:
+                self.assertIsNone(store.lookup(missing))
+        self.assertIsNone(store.lookup(b"\0" * 32))
+        self.assertIsNone(store.lookup(b"\xff" * 32))
+
+    def test_reopened_store_finds_index_and_log(self):
+        store = self.open()
+        items = list(self.chunks.items())
+        self.put_all(store, dict(items[:500]))
+        store.compact()
+        self.put_all(store, dict(items[500:]))
+        store.close()
+
+        reopened = self.open()
+        self.assertEqual(reopened.index_count, 500)
+        self.assertEqual(len(reopened.recent), 500)
+        self.assert_stored(reopened, self.chunks)
+
+    def test_merged_log_left_by_a_crash_is_deduplicated(self):
+        store = self.open()
+        self.put_all(store, self.chunks)
+        store.compact()
+        # As if the server stopped between swapping in the index and
+        # removing the log it was merged from
+        records = b"".join(
+            INDEX_RECORD.pack(digest, *store.lookup(digest))
+            for digest in list(self.chunks)[:50]
+        )
+        store.close()
+        (self.root / "index.log.merging").write_bytes(records)
+
+        reopened = self.open()
+        self.assertEqual(len(reopened.recent), 50)
+        reopened.compact()
+        self.assertEqual(reopened.index_count, 1000)
+        self.assertFalse((self.root / "index.log.merging").exists())
+        self.assert_stored(reopened, self.chunks)
+
+    def test_duplicate_put_is_not_stored_again(self):
+        store = self.open()
+        self.put_all(store, self.chunks)
+        store.compact()
+        digest, data = next(iter(self.chunks.items()))
+        self.assertFalse(store.put(digest, data))
+        self.assertEqual(store.stats["Chunks"], 1000)
+
+    def test_read_only_store(self):
+        store = self.open()
+        self.put_all(store, self.chunks)
+        store.close()
+
+        reader = self.open(read_only=True)
+        self.assert_stored(reader, self.chunks)
+        digest, data = chunk(b"new")
+        with self.assertRaises(io.UnsupportedOperation):
+            reader.put(digest, data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+
+from PathTrie import PathTrie
+
+
+class PathTrieTest(unittest.TestCase):
+    def test_sibling_prefix_is_not_covered(self):
+        trie = PathTrie(["/a/b"])
+        self.assertTrue(trie.covers("/a/b"))
+        self.assertTrue(trie.covers("/a/b/c"))
+        self.assertFalse(trie.covers("/a/bc"))
+        self.assertFalse(trie.covers("/a/bc/d"))
+        self.assertFalse(trie.covers("/a"))
+
+    def test_covering_is_the_closest_folder(self):
+        trie = PathTrie(["/a", "/a/b", "/a/bc"])
+        self.assertEqual(trie.covering("/a/b/c"), "/a/b")
+        self.assertEqual(trie.covering("/a/bc/d"), "/a/bc")
+        self.assertEqual(trie.covering("/a/bd"), "/a")
+        self.assertIsNone(trie.covering("/b"))
+
+    def test_has_below_ignores_siblings(self):
+        trie = PathTrie(["/a/bc"])
+        self.assertFalse(trie.has_below("/a/b"))
+        self.assertTrue(trie.has_below("/a"))
+
+        trie.add("/a/b/c")
+        self.assertTrue(trie.has_below("/a/b"))
+        self.assertFalse(trie.has_below("/a/bc"))
+
+    def test_clear_below_keeps_siblings(self):
+        trie = PathTrie(["/a/b", "/a/b/c", "/a/b/d/e", "/a/bc"])
+        trie.clear_below("/a/b")
+        self.assertEqual(sorted(trie), ["/a/b", "/a/bc"])
+        self.assertEqual(len(trie), 2)
+
+    def test_discard_keeps_counts(self):
+        trie = PathTrie(["/a/b", "/a/bc"])
+        trie.discard("/a/b")
+        trie.discard("/a/b")
+        self.assertNotIn("/a/b", trie)
+        self.assertIn("/a/bc", trie)
+        self.assertEqual(len(trie), 1)
+        self.assertTrue(trie.has_below("/a"))
+
+        trie.remove("/a/bc")
+        self.assertEqual(len(trie), 0)
+        self.assertFalse(trie.has_below("/a"))
+        with self.assertRaises(KeyError):
+            trie.remove("/a/bc")
+
+    def test_trailing_slash(self):
+        trie = PathTrie(["/a/b/"])
+        self.assertTrue(trie.covers("/a/b/c"))
+        self.assertFalse(trie.covers("/a/bc"))
+
+
+if __name__ == "__main__":
+    unittest.main()